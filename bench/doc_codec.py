@@ -0,0 +1,165 @@
+""" Benchmark the storage codecs for Canvas and Curation documents.
+
+    For every codec a synthetic index is written to a fresh SQLite DB, after
+    which the DB file size and the latency of some /api requests are
+    reported.
+
+    usage (from the repository root):
+
+        $ python3 -m bench.doc_codec [<num_curations> [<canvases_per_cur>]]
+"""
+
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from canvasindexer.codec import CODECS
+
+LABELS = ['テーマ', '性別', '向き', '制作年', '所蔵', '原典']
+VALUES = ['値{}'.format(i) for i in range(25)] + ['男', '女', 'face', 'left']
+REQUESTS = [
+    '/api?select=canvas&where=face&limit=100',
+    '/api?select=canvas&where_metadata_label=性別&where_metadata_value=男'
+    '&limit=1000',
+    '/api?select=curation&where_metadata_label=性別&where_metadata_value=女',
+    '/api?select=curation&where=値1',
+    ]
+
+
+def random_metadata(rnd, n):
+    return [{'label': rnd.choice(LABELS), 'value': rnd.choice(VALUES)}
+            for _ in range(n)]
+
+
+def populate(db, codec_name, num_curations, canvases_per_cur, seed=0):
+    """ Write a synthetic index with documents shaped like the ones the
+        crawler creates.
+    """
+
+    from canvasindexer.models import (Term, Canvas, Curation, CurationHit,
+                                      TermCanvasAssoc, TermCurationAssoc)
+
+    rnd = random.Random(seed)
+    terms = {}
+    for label in LABELS:
+        for value in VALUES:
+            term = Term(term=value, qualifier=label)
+            db.session.add(term)
+            terms[(label, value)] = term
+    db.session.flush()
+    for c in range(num_curations):
+        cur_url = 'http://example.org/curation/{}.json'.format(c)
+        man_url = 'http://example.org/manifest/{}/manifest.json'.format(c)
+        cur_db = Curation(curation_uri=cur_url)
+        cur_doc = {
+            'curationUrl': cur_url,
+            'curationLabel': 'キュレーション {}'.format(c),
+            'curationThumbnail': None,
+            'totalImages': canvases_per_cur,
+            'crawledAt': '2019-01-01T00:00:00.000000',
+            }
+        db.session.add(cur_db)
+        db.session.flush()
+        seen = set()
+        for i in range(canvases_per_cur):
+            can_id = 'http://example.org/iiif/{}/canvas/p{}'.format(c, i + 1)
+            fragment = 'xywh={},{},{},{}'.format(*[rnd.randint(0, 2000)
+                                                   for _ in range(4)])
+            metadata = random_metadata(rnd, rnd.randint(2, 5))
+            can_doc = {
+                'manifestUrl': man_url,
+                'manifestLabel': '絵本 {}'.format(c),
+                'canvas': 'http://example.org/iiif/{}/p{}/info.json'.format(
+                    c, i + 1),
+                'canvasId': can_id,
+                'canvasCursorIndex': None,
+                'canvasLabel': '{}'.format(i + 1),
+                'canvasThumbnail': ('http://example.org/iiif/{}/p{}/{}/!200,20'
+                                    '0/0/default.jpg').format(c, i + 1,
+                                                              fragment[5:]),
+                'canvasIndex': i + 1,
+                'fragment': fragment,
+                'metadata': metadata,
+                }
+            if cur_doc['curationThumbnail'] is None:
+                cur_doc['curationThumbnail'] = can_doc['canvasThumbnail']
+            can_db = Canvas(canvas_uri='{}#{}'.format(can_id, fragment))
+            can_db.set_doc(can_doc, codec_name)
+            db.session.add(can_db)
+            hit_db = CurationHit(curation_id=cur_db.id,
+                                 hit_type='canvas',
+                                 canvas_id=can_id,
+                                 fragment=fragment,
+                                 canvas_index=i + 1,
+                                 thumbnail=can_doc['canvasThumbnail'])
+            db.session.add(hit_db)
+            db.session.flush()
+            for md in metadata:
+                key = (md['label'], md['value'])
+                if (can_db.id, key) in seen:
+                    continue
+                seen.add((can_db.id, key))
+                db.session.add(TermCanvasAssoc(term_id=terms[key].id,
+                                               canvas_id=can_db.id,
+                                               metadata_type='canvas',
+                                               actor='human'))
+                if key in seen:
+                    continue
+                seen.add(key)
+                db.session.add(TermCurationAssoc(term_id=terms[key].id,
+                                                 curation_hit_id=hit_db.id,
+                                                 metadata_type='curation',
+                                                 actor='human'))
+        cur_db.set_doc(cur_doc, codec_name)
+        db.session.commit()
+
+
+def run(codec_name, num_curations, canvases_per_cur, repeat=5):
+    tmp_dir = tempfile.mkdtemp(prefix='ci_bench_')
+    db_path = os.path.join(tmp_dir, 'index.db')
+    with open(os.path.join(tmp_dir, 'config.ini'), 'w') as f:
+        f.write('[shared]\ndb_uri = sqlite:///{}\n'.format(db_path))
+        f.write('generation_file = {}\n'.format(os.path.join(tmp_dir,
+                                                             'gen.json')))
+        f.write('doc_codec = {}\n'.format(codec_name))
+        f.write('[crawler]\ninterval = -1\nlog_file = {}\n'.format(
+            os.path.join(tmp_dir, 'log.txt')))
+    os.chdir(tmp_dir)
+
+    from canvasindexer import create_app
+    from canvasindexer.models import db
+    from canvasindexer.startup import wait_for_db
+    app = create_app()
+    wait_for_db(app)
+    with app.app_context():
+        t = time.time()
+        populate(db, codec_name, num_curations, canvases_per_cur)
+        build_time = time.time() - t
+    client = app.test_client()
+    latencies = {}
+    for url in REQUESTS:
+        times = []
+        for _ in range(repeat):
+            t = time.time()
+            resp = client.get(url)
+            resp.get_data()
+            times.append(time.time() - t)
+        latencies[url] = statistics.median(times) * 1000
+    return os.path.getsize(db_path), build_time, latencies
+
+
+if __name__ == '__main__':
+    num_curations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    canvases_per_cur = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print('{} curations with {} canvases each'.format(num_curations,
+                                                      canvases_per_cur))
+    for codec_name in sorted(CODECS):
+        size, build_time, latencies = run(codec_name, num_curations,
+                                          canvases_per_cur)
+        print('\ncodec: {}'.format(codec_name))
+        print('  DB size:    {:.1f} MiB'.format(size / 1024 / 1024))
+        print('  build time: {:.1f} s'.format(build_time))
+        for url, ms in latencies.items():
+            print('  {:8.1f} ms  {}'.format(ms, url))
@@ -0,0 +1,112 @@
+""" Benchmark the DB indexes created by migration 1 (see
+    canvasindexer.migrations).
+
+    A synthetic index is written to a fresh SQLite DB. The indexes are then
+    dropped to measure the queries of the API, the facet list and the delete
+    path as they performed before, and created again through the migration
+    to measure them after.
+
+    usage (from the repository root):
+
+        $ python3 -m bench.indexes [<num_curations> [<canvases_per_cur>]]
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+REQUESTS = [
+    '/api?select=canvas&where_metadata_label=性別&where_metadata_value=男'
+    '&where_agent=human&from=canvas&limit=100',
+    '/api?select=canvas&where=face&limit=100',
+    '/api?select=curation&where_metadata_label=性別&where_metadata_value=女',
+    '/api?select=canvas&where_metadata_label=向き&where_metadata_value=left'
+    '&facets=true&limit=10',
+    ]
+
+
+def median_ms(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.time()
+        func()
+        times.append(time.time() - t)
+    return statistics.median(times) * 1000
+
+
+def measure(app, client, first_cur, num_deletes, repeat):
+    from canvasindexer.crawler.crawler import (build_facet_list,
+                                               process_curation_delete)
+    from canvasindexer.models import db, Canvas, TermCanvasAssoc
+    latencies = {}
+    for url in REQUESTS:
+        latencies[url] = median_ms(lambda: client.get(url).get_data(),
+                                   repeat)
+    with app.app_context():
+        latencies['build_facet_list()'] = median_ms(build_facet_list, repeat)
+        cp_map = {'upward': {}, 'downward': {}}
+
+        def delete_curations():
+            for c in range(first_cur, first_cur + num_deletes):
+                activity = {'id': 'bench', 'object': {
+                    '@id': 'http://example.org/curation/{}.json'.format(c)}}
+                process_curation_delete(cp_map, activity)
+        latencies['delete {} curations'.format(num_deletes)] = median_ms(
+                                                        delete_curations, 1)
+        canvas_ids = [c_id for (c_id,) in Canvas.query.with_entities(
+                        Canvas.id).order_by(Canvas.id).limit(num_deletes)]
+
+        def delete_canvas_assocs():
+            for canvas_id in canvas_ids:
+                db.session.query(TermCanvasAssoc).filter(
+                    TermCanvasAssoc.canvas_id == canvas_id).delete()
+            db.session.rollback()
+        latencies['delete assocs of {} canvases'.format(num_deletes)] = \
+            median_ms(delete_canvas_assocs, repeat)
+    return latencies
+
+
+def run(num_curations, canvases_per_cur, num_deletes=20, repeat=9):
+    tmp_dir = tempfile.mkdtemp(prefix='ci_bench_')
+    db_path = os.path.join(tmp_dir, 'index.db')
+    with open(os.path.join(tmp_dir, 'config.ini'), 'w') as f:
+        f.write('[shared]\ndb_uri = sqlite:///{}\n'.format(db_path))
+        f.write('generation_file = {}\n'.format(os.path.join(tmp_dir,
+                                                             'gen.json')))
+        f.write('[crawler]\ninterval = -1\nlog_file = {}\n'.format(
+            os.path.join(tmp_dir, 'log.txt')))
+    os.chdir(tmp_dir)
+
+    from bench.doc_codec import populate
+    from canvasindexer import create_app
+    from canvasindexer.models import db
+    from canvasindexer.migrations import create_missing_indexes
+    from canvasindexer.startup import wait_for_db
+    app = create_app()
+    wait_for_db(app)
+    with app.app_context():
+        populate(db, 'json', num_curations, canvases_per_cur)
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(bind=db.engine)
+        db.engine.execute('ANALYZE')
+    client = app.test_client()
+    before = measure(app, client, 0, num_deletes, repeat)
+    with app.app_context():
+        create_missing_indexes(log=lambda msg: None)
+    after = measure(app, client, num_deletes, num_deletes, repeat)
+    return before, after
+
+
+if __name__ == '__main__':
+    num_curations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    canvases_per_cur = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print('{} curations with {} canvases each'.format(num_curations,
+                                                      canvases_per_cur))
+    before, after = run(num_curations, canvases_per_cur)
+    print('\n  without     with indexes')
+    for key in before:
+        print('  {:8.1f} ms {:8.1f} ms  {}'.format(before[key], after[key],
+                                                   key))
@@ -0,0 +1,205 @@
+""" Benchmark the search API on synthetic indexes of different sizes.
+
+    For every size a synthetic index (see bench.synthetic) is written to a
+    fresh SQLite DB in a new interpreter, so that sizes don't influence each
+    other's memory use. Then /api is requested for every combination of
+    select, from, where (none, a common term, a rare term, a label value
+    pair), where_agent and limit, as well as /facets and /parents. Reported
+    are the p50, p95 and p99 latencies per request and per endpoint, the
+    peak memory allocated by Python while answering a request and the
+    maximum resident set size of the process.
+
+    usage (from the repository root):
+
+        $ python3 -m bench.search [--engine <db|memory|snapshot>] \
+[--repeat <n>] [<num_canvases>,<num_curations>,<num_terms> ...]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import product
+
+HIDDEN_LABEL = '内部識別子'
+SELECTS = ['curation', 'canvas']
+FROMS = ['curation,canvas', 'canvas', 'curation']
+WHERE_AGENTS = ['human,machine', 'machine']
+LIMITS = [10, 1000]
+PERCENTILES = [50, 95, 99]
+
+
+def request_matrix(info):
+    """ Return the URLs to request as a list of (endpoint, URL) pairs.
+    """
+
+    common_label, common_value = info['common_term']
+    rare_label, rare_value = info['rare_term']
+    wheres = ['',
+              'where={}'.format(common_value),
+              'where={}'.format(rare_value),
+              'where_metadata_label={}&where_metadata_value={}'.format(
+                  common_label or rare_label,
+                  common_value if common_label else rare_value)]
+    urls = []
+    for select, vrom, where, agent, limit in product(SELECTS, FROMS, wheres,
+                                                     WHERE_AGENTS, LIMITS):
+        params = ['select={}'.format(select), 'from={}'.format(vrom), where,
+                  'where_agent={}'.format(agent), 'limit={}'.format(limit)]
+        urls.append(('/api', '/api?' + '&'.join(p for p in params if p)))
+    urls.append(('/facets', '/facets'))
+    urls.append(('/parents', '/parents?canvas={}&xywh={}'.format(
+                    info['sample_canvas'], info['sample_xywh'])))
+    urls.append(('/parents', '/parents?canvas={}'.format(
+                    info['sample_canvas'])))
+    return urls
+
+
+def percentile(sorted_values, p):
+    """ Nearest rank percentile.
+    """
+
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(times):
+    times = sorted(times)
+    return [percentile(times, p) * 1000 for p in PERCENTILES]
+
+
+def max_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(size, engine, repeat):
+    """ Build an index of the given size and measure it (in this process).
+    """
+
+    num_canvases, num_curations, num_terms = size
+    tmp_dir = tempfile.mkdtemp(prefix='ci_bench_')
+    with open(os.path.join(tmp_dir, 'config.ini'), 'w') as f:
+        f.write('[shared]\ndb_uri = sqlite:///{}\n'.format(
+            os.path.join(tmp_dir, 'index.db')))
+        f.write('generation_file = {}\n'.format(os.path.join(tmp_dir,
+                                                             'gen.json')))
+        f.write('snapshot_file = {}\n'.format(os.path.join(tmp_dir,
+                                                           'snap.bin')))
+        f.write('[crawler]\ninterval = -1\nlog_file = {}\n'.format(
+            os.path.join(tmp_dir, 'log.txt')))
+        f.write('[api]\nsearch_engine = {}\n'.format(engine))
+        f.write('facet_label_hide = {}\n'.format(HIDDEN_LABEL))
+    os.chdir(tmp_dir)
+
+    from bench.synthetic import populate_index
+    from canvasindexer import create_app
+    from canvasindexer.api.snapshot import publish_index
+    from canvasindexer.models import db
+    from canvasindexer.startup import wait_for_db
+    app = create_app()
+    wait_for_db(app)
+    with app.app_context():
+        t = time.time()
+        info = populate_index(db, app.cfg, num_canvases, num_curations,
+                              num_terms)
+        publish_index(app.cfg)
+        build_time = time.time() - t
+    rss_built = max_rss_mib()
+
+    client = app.test_client()
+    urls = request_matrix(info)
+    # first request (loads the search engine's data structures)
+    t = time.time()
+    client.get(urls[0][1]).get_data()
+    first_ms = (time.time() - t) * 1000
+    results = []
+    for endpoint, url in urls:
+        times = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            resp = client.get(url)
+            resp.get_data()
+            times.append(time.perf_counter() - t)
+        if resp.status_code != 200:
+            raise Exception('{} returned {}'.format(url, resp.status_code))
+        tracemalloc.start()
+        client.get(url).get_data()
+        peak_kib = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+        results.append({'endpoint': endpoint, 'url': url, 'times': times,
+                        'peak_kib': peak_kib})
+    return {'size': size, 'build_time': build_time, 'first_ms': first_ms,
+            'rss_built': rss_built, 'rss': max_rss_mib(),
+            'db_size': os.path.getsize(os.path.join(tmp_dir, 'index.db')),
+            'results': results}
+
+
+def report(run_result):
+    print('\n{} canvases, {} curations, {} terms'.format(
+                                                    *run_result['size']))
+    print('  DB size:      {:.1f} MiB'.format(
+                                    run_result['db_size'] / 1024 / 1024))
+    print('  build time:   {:.1f} s'.format(run_result['build_time']))
+    print('  first /api:   {:.1f} ms'.format(run_result['first_ms']))
+    print('  max RSS:      {:.1f} MiB after build, {:.1f} MiB at end'.format(
+                                run_result['rss_built'], run_result['rss']))
+    print('  {:>8} {:>8} {:>8} {:>9}  request'.format(
+            *['p{} ms'.format(p) for p in PERCENTILES] + ['peak KiB']))
+    for res in run_result['results']:
+        print('  {:8.1f} {:8.1f} {:8.1f} {:9.0f}  {}'.format(
+            *summarize(res['times']) + [res['peak_kib'], res['url']]))
+
+
+def report_endpoints(run_results):
+    """ Compare the sizes by endpoint.
+    """
+
+    print('\nper endpoint (p50 / p95 / p99 ms, max peak KiB)')
+    for endpoint in ['/api', '/facets', '/parents']:
+        print('  {}'.format(endpoint))
+        for run_result in run_results:
+            results = [r for r in run_result['results']
+                       if r['endpoint'] == endpoint]
+            times = [t for r in results for t in r['times']]
+            print('    {:>24}  {:8.1f} {:8.1f} {:8.1f} {:9.0f}'.format(
+                '{},{},{}'.format(*run_result['size']),
+                *summarize(times) + [max(r['peak_kib'] for r in results)]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    description='Benchmark the search API on synthetic '
+                                'indexes.')
+    parser.add_argument('sizes', nargs='*', default=['2000,200,500'],
+                        help='<num_canvases>,<num_curations>,<num_terms>')
+    parser.add_argument('--engine', default='db',
+                        choices=['db', 'memory', 'snapshot'])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    sizes = [[int(n) for n in s.split(',')] for s in args.sizes]
+
+    if args.child:
+        print(json.dumps(run(sizes[0], args.engine, args.repeat)))
+        sys.exit(0)
+
+    print('search engine: {}, {} runs per request'.format(args.engine,
+                                                          args.repeat))
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    run_results = []
+    for size in sizes:
+        out = subprocess.check_output([sys.executable, '-m', 'bench.search',
+                                       '--child', '--engine', args.engine,
+                                       '--repeat', str(args.repeat),
+                                       ','.join(str(n) for n in size)],
+                                      env=env)
+        run_results.append(json.loads(out.decode().strip().split('\n')[-1]))
+        report(run_results[-1])
+    report_endpoints(run_results)
@@ -0,0 +1,73 @@
+""" Benchmark the startup of the app.
+
+    A synthetic index is written to a fresh SQLite DB. Then the app is
+    started repeatedly, each time in a new interpreter (i.e. a cold start of
+    a worker), measuring the time until the imports are done, create_app
+    returned and the first /api response was received.
+
+    usage (from the repository root):
+
+        $ python3 -m bench.startup [<runs> [<num_curations>]]
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+CHILD = '''
+import json
+import time
+t = time.perf_counter()
+from canvasindexer import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+app.test_client().get('/api?select=canvas&limit=1').get_data()
+responded = time.perf_counter()
+print(json.dumps([imported - t, created - t, responded - t]))
+'''
+
+STEPS = ['imports', 'create_app returned', 'first /api response']
+
+
+def run(runs, num_curations, canvases_per_cur=20):
+    tmp_dir = tempfile.mkdtemp(prefix='ci_bench_')
+    db_path = os.path.join(tmp_dir, 'index.db')
+    with open(os.path.join(tmp_dir, 'config.ini'), 'w') as f:
+        f.write('[shared]\ndb_uri = sqlite:///{}\n'.format(db_path))
+        f.write('generation_file = {}\n'.format(os.path.join(tmp_dir,
+                                                             'gen.json')))
+        f.write('[crawler]\ninterval = -1\nlog_file = {}\n'.format(
+            os.path.join(tmp_dir, 'log.txt')))
+    repo_dir = os.getcwd()
+    os.chdir(tmp_dir)
+
+    from bench.doc_codec import populate
+    from canvasindexer import create_app
+    from canvasindexer.models import db
+    from canvasindexer.startup import wait_for_db
+    app = create_app()
+    wait_for_db(app)
+    with app.app_context():
+        populate(db, 'zlib', num_curations, canvases_per_cur)
+
+    env = dict(os.environ, PYTHONPATH=repo_dir)
+    timings = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', CHILD],
+                                      cwd=tmp_dir, env=env)
+        timings.append(json.loads(out.decode().strip().split('\n')[-1]))
+    return [statistics.median(t[i] for t in timings) * 1000
+            for i in range(len(STEPS))]
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    num_curations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print('{} cold starts with {} curations in the index'.format(
+                                                    runs, num_curations))
+    for step, ms in zip(STEPS, run(runs, num_curations)):
+        print('  {:8.1f} ms  {}'.format(ms, step))
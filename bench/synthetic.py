@@ -0,0 +1,234 @@
+""" Generate a synthetic index.
+
+    The index is written directly through canvasindexer.models and has the
+    shape of one created by the crawler: Curations with a hit for their top
+    level metadata and one per Canvas, Canvases shared between Curations,
+    terms spread over several labels (qualifiers), unqualified terms and
+    hidden labels (facet_label_hide), human, machine and unknown actors, the
+    placeholder term associated with every document, a matching
+    CanvasParentMap and the facet list. Term frequencies follow a Zipf
+    distribution, so that there are a few very common and many rare terms.
+
+    usage (from the directory of the config.ini of the DB to fill):
+
+        $ python3 -m bench.synthetic [<num_canvases> [<num_curations> \
+[<num_terms>]]]
+"""
+
+import json
+import os
+import random
+import sys
+from collections import OrderedDict
+from itertools import accumulate
+
+LABELS = ['テーマ', '性別', '向き', '制作年', '所蔵', '原典', '']
+CANVASES_PER_MANIFEST = 20
+COMMIT_EVERY = 100  # Curations
+
+
+def make_metadata(rnd, terms, cum_weights, n, machine_share):
+    """ Return n metadata entries with distinct terms. Entries without an
+        agent are indexed with actor "unknown".
+    """
+
+    metadata = []
+    picked = rnd.choices(terms, cum_weights=cum_weights, k=n)
+    for label, value in OrderedDict.fromkeys(picked):
+        entry = OrderedDict([('label', label), ('value', value)])
+        r = rnd.random()
+        if r < machine_share:
+            entry['agent'] = 'machine'
+        elif r < (1 + machine_share) / 2:
+            entry['agent'] = 'human'
+        metadata.append(entry)
+    return metadata
+
+
+def term_key(entry):
+    """ Return the (<qualifier>, <term>) of a metadata entry or the
+        placeholder term.
+    """
+
+    if isinstance(entry, dict):
+        return (entry['label'], entry['value'])
+    return ('', entry)
+
+
+def actor(entry):
+    if isinstance(entry, dict):
+        return entry.get('agent', 'unknown')
+    return 'unknown'
+
+
+def populate_index(db, cfg, num_canvases, num_curations, num_terms,
+                   machine_share=0.2, shared_share=0.1, seed=0):
+    """ Write a synthetic index into the (empty) DB of the current app
+        context, using the codec, hidden labels and placeholder term of cfg.
+        Return a dict with terms and a Canvas to use in requests.
+    """
+
+    from canvasindexer.crawler.crawler import store_facet_list
+    from canvasindexer.models import (CanvasParentMap, Term, Canvas,
+                                      Curation, CurationHit, TermCanvasAssoc,
+                                      TermCurationAssoc)
+
+    rnd = random.Random(seed)
+    codec_name = cfg.doc_codec()
+    hidden_labels = cfg.facet_label_hide()
+    labels = LABELS + hidden_labels
+
+    # terms, the most common first
+    terms = [(labels[i % len(labels)], '値{}'.format(i))
+             for i in range(num_terms)]
+    cum_weights = list(accumulate(1 / (rank + 1)
+                                  for rank in range(num_terms)))
+    term_ids = OrderedDict()
+    for label, value in terms + [('', cfg.e_term())]:
+        term_ids[(label, value)] = len(term_ids) + 1
+    db.session.bulk_save_objects([Term(id=term_id, term=value,
+                                       qualifier=label,
+                                       hidden=label in hidden_labels)
+                                  for (label, value), term_id
+                                  in term_ids.items()])
+
+    # Canvases of a Curation are a consecutive run (most of the time from
+    # the same Manifest), some are in a second Curation as well
+    cur_canvases = [list(range(c * num_canvases // num_curations,
+                               (c + 1) * num_canvases // num_curations))
+                    for c in range(num_curations)]
+    for i in rnd.sample(range(num_canvases),
+                        int(num_canvases * shared_share)):
+        c = rnd.randrange(num_curations)
+        if i not in cur_canvases[c]:
+            cur_canvases[c].append(i)
+
+    cp_map = {'upward': {}, 'downward': {}}
+    # canvas number → (DB ID, URI, metadata, thumbnail)
+    canvas_db_ids = {}
+    num_hits = 0
+    for c, canvases in enumerate(cur_canvases):
+        records = []
+        cur_uri = 'http://example.org/curation/{}.json'.format(c)
+        cur_db = Curation(id=c + 1, curation_uri=cur_uri)
+        num_hits += 1
+        top_hit_id = num_hits
+        records.append(CurationHit(id=top_hit_id, curation_id=cur_db.id,
+                                   hit_type='curation'))
+        top_metadata = make_metadata(rnd, terms, cum_weights,
+                                     rnd.randint(0, 2), machine_share)
+        for entry in top_metadata + [cfg.e_term()]:
+            key = term_key(entry)
+            records.append(TermCurationAssoc(term_id=term_ids[key],
+                                             curation_hit_id=top_hit_id,
+                                             metadata_type='curation',
+                                             actor=actor(entry)))
+        cur_doc = OrderedDict()
+        cur_doc['curationUrl'] = cur_uri
+        cur_doc['curationLabel'] = 'キュレーション {}'.format(c)
+        cur_doc['curationThumbnail'] = None
+        cur_doc['totalImages'] = len(canvases)
+        cur_doc['crawledAt'] = '2019-01-01T00:00:00.000000'
+        cp_map['downward'][cur_uri] = []
+        term_hits = {}  # term value → hit (first Canvas it appears on)
+        cur_assocs = set()
+        for idx, i in enumerate(canvases):
+            m = i // CANVASES_PER_MANIFEST
+            can_id = 'http://example.org/iiif/{}/canvas/p{}'.format(
+                        m, i % CANVASES_PER_MANIFEST + 1)
+            if i not in canvas_db_ids:
+                fragment = 'xywh={},{},{},{}'.format(
+                    *[rnd.randint(0, 2000) for _ in range(4)])
+                metadata = make_metadata(rnd, terms, cum_weights,
+                                         rnd.randint(1, 5), machine_share)
+                can_doc = OrderedDict()
+                can_doc['manifestUrl'] = ('http://example.org/iiif/{}/manifes'
+                                          't.json').format(m)
+                can_doc['manifestLabel'] = '絵本 {}'.format(m)
+                can_doc['canvas'] = ('http://example.org/iiif/{}/p{}/info.jso'
+                                     'n').format(m, i + 1)
+                can_doc['canvasId'] = can_id
+                can_doc['canvasCursorIndex'] = None
+                can_doc['canvasLabel'] = '{}'.format(
+                                            i % CANVASES_PER_MANIFEST + 1)
+                can_doc['canvasThumbnail'] = ('http://example.org/iiif/{}/p{}'
+                                              '/{}/!200,200/0/default.jpg'
+                                              ).format(m, i + 1, fragment[5:])
+                can_doc['canvasIndex'] = i % CANVASES_PER_MANIFEST + 1
+                can_doc['fragment'] = fragment
+                can_doc['metadata'] = list(metadata)
+                can_uri = '{}#{}'.format(can_id, fragment)
+                can_db = Canvas(id=len(canvas_db_ids) + 1,
+                                canvas_uri=can_uri)
+                can_db.set_full_doc(can_doc, codec_name, hidden_labels)
+                records.append(can_db)
+                for entry in metadata + [cfg.e_term()]:
+                    key = term_key(entry)
+                    records.append(TermCanvasAssoc(term_id=term_ids[key],
+                                                   canvas_id=can_db.id,
+                                                   metadata_type='canvas',
+                                                   actor=actor(entry)))
+                canvas_db_ids[i] = (can_db.id, can_uri, metadata,
+                                    can_doc['canvasThumbnail'])
+            can_db_id, can_uri, metadata, thumbnail = canvas_db_ids[i]
+            if cur_doc['curationThumbnail'] is None:
+                cur_doc['curationThumbnail'] = thumbnail
+            num_hits += 1
+            records.append(CurationHit(id=num_hits, curation_id=cur_db.id,
+                                       hit_type='canvas', canvas_id=can_id,
+                                       fragment=can_uri.split('#')[1],
+                                       canvas_index=idx + 1,
+                                       thumbnail=thumbnail))
+            for entry in metadata + [cfg.e_term()]:
+                key = term_key(entry)
+                hit_id = term_hits.setdefault(key[1], num_hits)
+                if (term_ids[key], hit_id) in cur_assocs:
+                    continue
+                cur_assocs.add((term_ids[key], hit_id))
+                records.append(TermCurationAssoc(term_id=term_ids[key],
+                                                 curation_hit_id=hit_id,
+                                                 metadata_type='curation',
+                                                 actor=actor(entry)))
+            cp_map['upward'].setdefault(can_uri, []).append(cur_uri)
+            cp_map['downward'][cur_uri].append(can_uri)
+        cur_db.set_doc(cur_doc, codec_name)
+        records.insert(0, cur_db)
+        db.session.bulk_save_objects(records)
+        if c % COMMIT_EVERY == COMMIT_EVERY - 1:
+            db.session.commit()
+    db.session.add(CanvasParentMap(json_string=json.dumps(cp_map)))
+    db.session.commit()
+    store_facet_list()
+
+    shared = [uri for uri, parents in cp_map['upward'].items()
+              if len(parents) > 1]
+    sample_uri = shared[0] if shared else next(iter(cp_map['upward']))
+    visible = [t for t in terms if t[0] not in hidden_labels]
+    return {'common_term': visible[0],
+            'rare_term': visible[-1],
+            'sample_canvas': sample_uri.split('#')[0],
+            'sample_xywh': sample_uri.split('#xywh=')[1],
+            'num_hits': num_hits}
+
+
+if __name__ == '__main__':
+    from canvasindexer import create_app
+    from canvasindexer.api.snapshot import publish_index
+    from canvasindexer.models import db, Canvas
+    from canvasindexer.startup import wait_for_db
+
+    num_canvases = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    num_curations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    num_terms = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    app = create_app()
+    wait_for_db(app)
+    with app.app_context():
+        if db.session.query(Canvas.id).first() is not None:
+            print('The DB of {} is not empty.'.format(
+                                            os.path.abspath('config.ini')))
+            sys.exit(1)
+        populate_index(db, app.cfg, num_canvases, num_curations, num_terms)
+        publish_index(app.cfg)
+    print('{} canvases in {} curations with {} terms written to {}'.format(
+            num_canvases, num_curations, num_terms,
+            app.config['SQLALCHEMY_DATABASE_URI']))
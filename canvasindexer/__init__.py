@@ -4,44 +4,41 @@
     offers a search API.
 """
 
-import atexit
 from flask import Flask
 from flask_cors import CORS
-from canvasindexer.config import Cfg
-from canvasindexer.crawler.crawler import crawl
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.interval import IntervalTrigger
+from canvasindexer.config import get_cfg
 
 
 __version__ = '1.0.0'
 
 
 def create_app(**kwargs):
+    """ Create the app. Preparing the DB and crawling happen in the background
+        (see canvasindexer.startup), so this returns without accessing the
+        DB.
+    """
+
     app = Flask(__name__)
-    with app.app_context():
-        CORS(app)
-        app.cfg = Cfg()
-
-        app.config['SQLALCHEMY_DATABASE_URI'] = app.cfg.db_uri()
-        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-        from canvasindexer.models import db
-        db.init_app(app)
-        db.create_all()
-
-        from canvasindexer.api.views import pd
-        app.register_blueprint(pd)
-
-        if app.cfg.crawler_interval() > 0:
-            crawl()
-            scheduler = BackgroundScheduler()
-            scheduler.start()
-            scheduler.add_job(
-                func=crawl,
-                trigger=IntervalTrigger(seconds=app.cfg.crawler_interval()),
-                id='crawl_job',
-                name='crawl AS with interval set in config',
-                replace_existing=True)
-            atexit.register(lambda: scheduler.shutdown())
-
-        return app
+    CORS(app)
+    app.cfg = get_cfg()
+
+    from canvasindexer.builds import active_db_uri
+    app.config['SQLALCHEMY_DATABASE_URI'] = active_db_uri(app.cfg)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    from canvasindexer.models import db
+    from canvasindexer.connections import route_request, setup_engine
+    from canvasindexer.startup import start_background_tasks, wait_for_db
+    db.init_app(app)
+    setup_engine(app, app.cfg)
+    if app.cfg.timing():
+        from canvasindexer.timing import enable_timing
+        enable_timing()
+    app.before_request(wait_for_db)
+    app.before_request(route_request)
+
+    from canvasindexer.api.views import pd
+    app.register_blueprint(pd)
+
+    start_background_tasks(app)
+    return app
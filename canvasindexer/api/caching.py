@@ -0,0 +1,73 @@
+""" HTTP caching support for API endpoints.
+
+    Responses are given validators (ETag, Last-Modified) derived from the
+    current index generation (see canvasindexer.generation), so that
+    conditional requests can be answered with a 304 before any DB access.
+"""
+
+import datetime
+from functools import wraps
+from flask import current_app, make_response, request, Response
+from canvasindexer.generation import read_generation
+
+
+def _http_datetime(dt):
+    """ Normalize a datetime to a naive UTC datetime with second resolution
+        (which is all HTTP dates can express).
+    """
+
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt.replace(microsecond=0)
+
+
+def _is_fresh(etag, last_modified):
+    """ Check if the client's cached representation is still valid.
+        If-None-Match takes precedence over If-Modified-Since (RFC 7232 6.).
+    """
+
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return _http_datetime(request.if_modified_since) >= last_modified
+    return False
+
+
+def _set_cache_headers(resp, etag, last_modified):
+    resp.cache_control.public = True
+    resp.cache_control.max_age = current_app.cfg.cache_max_age()
+    if etag:
+        resp.set_etag(etag, weak=True)
+    if last_modified:
+        resp.last_modified = last_modified
+    return resp
+
+
+def conditional(view):
+    """ Decorator for views whose output only depends on the request and the
+        state of the index. Adds validators and Cache-Control headers and
+        answers matching conditional requests with 304 Not Modified without
+        calling the view.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        gen = read_generation(current_app.cfg.generation_file())
+        if gen is None:
+            # nothing crawled yet (or generation file not accessible)
+            etag = None
+            last_modified = None
+        else:
+            etag = 'ci-{}-{}'.format(gen['generation'],
+                                     current_app.cfg.fingerprint())
+            last_modified = _http_datetime(
+                datetime.datetime.fromisoformat(gen['datetime']))
+            if _is_fresh(etag, last_modified):
+                return _set_cache_headers(Response(status=304), etag,
+                                          last_modified)
+        resp = make_response(view(*args, **kwargs))
+        if resp.status_code != 200:
+            return resp
+        return _set_cache_headers(resp, etag, last_modified)
+
+    return wrapper
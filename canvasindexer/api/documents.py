@@ -0,0 +1,137 @@
+""" Loading search result documents from the DB.
+"""
+
+import json
+from collections import OrderedDict
+from canvasindexer.models import Curation, CurationHit, CanvasParentMap
+from canvasindexer.timing import phase
+from sqlalchemy.orm import joinedload
+
+
+def load_canvas_parent_map():
+    """ Load the Canvas parent map from the DB.
+    """
+
+    with phase('parents'):
+        cp_map_db = CanvasParentMap.query.first()
+        if cp_map_db:
+            return json.loads(cp_map_db.json_string)
+    return {'upward':{}, 'downward':{}}
+
+
+def get_canvas_parents(canvas, xywh, cp_map=None):
+    parents = []
+    if not cp_map:
+        cp_map = load_canvas_parent_map()
+    with phase('parents'):
+        if xywh and len(xywh) > 0:
+            needle = '{}#xywh={}'.format(canvas, xywh)
+            haystack = cp_map['upward']
+        else:
+            needle = '{}#'.format(canvas)
+            haystack = {
+                        key.split('xywh')[0]: val
+                        for (key, val)
+                        in cp_map['upward'].items()
+                       }
+        if needle in haystack:
+            parents = haystack[needle]
+    return parents
+
+
+def get_doc_ids(id_query):
+    """ Given a query for document IDs, return the IDs in the order in which
+        they are returned, without duplicates.
+    """
+
+    seen = set()
+    doc_ids = []
+    with phase('sql'):
+        for (doc_id,) in id_query:
+            if doc_id not in seen:
+                seen.add(doc_id)
+                doc_ids.append(doc_id)
+    return doc_ids
+
+
+def iter_docs(Doc, doc_ids, chunk_size=200, options=()):
+    """ Generate the documents with the given IDs in the given order. Documents
+        are loaded from the DB in chunks so that only few of them are held in
+        memory at a time.
+    """
+
+    for i in range(0, len(doc_ids), chunk_size):
+        chunk = doc_ids[i:i+chunk_size]
+        with phase('sql'):
+            docs_by_id = {doc.id: doc
+                          for doc in Doc.query.options(*options).filter(
+                                                        Doc.id.in_(chunk))}
+        for doc_id in chunk:
+            yield docs_by_id[doc_id]
+
+
+def iter_curation_hit_docs(hit_ids):
+    """ Generate the search result documents for the given Curation hits.
+        Each Curation's document is only decoded once.
+    """
+
+    curation_docs = {}
+    for hit in iter_docs(CurationHit, hit_ids,
+                         options=[joinedload(CurationHit.curation)]):
+        if hit.curation_id not in curation_docs:
+            curation_docs[hit.curation_id] = hit.curation.get_doc(
+                                            object_pairs_hook=OrderedDict)
+        yield hit.get_doc(object_pairs_hook=OrderedDict,
+                          curation_doc=curation_docs[hit.curation_id])
+
+
+def iter_merged_curation_docs(merged_ids):
+    """ Generate Curation search results from tuples of the form
+
+            (<hit ID>, <ID of the hit to take the canvasHit from or None>)
+    """
+
+    hit_ids = get_doc_ids(((hit_id,) for pair in merged_ids
+                           for hit_id in pair if hit_id is not None))
+    hit_docs = dict(zip(hit_ids, iter_curation_hit_docs(hit_ids)))
+    for hit_id, canvas_hit_id in merged_ids:
+        doc = hit_docs[hit_id]
+        if canvas_hit_id is not None:
+            doc['canvasHit'] = hit_docs[canvas_hit_id]['canvasHit']
+        yield doc
+
+
+def canvas_result(doc, cp_map):
+    """ Build the search result for a Canvas record, including info on the
+        Curations containing it.
+    """
+
+    result = doc.get_doc(object_pairs_hook=OrderedDict)
+    # add info on containing curations
+    result['curations'] = []
+    can_uri_c, fragment = doc.canvas_uri.split('#', 1)
+    can_uri_x = fragment[len('xywh='):]
+    parent_ids = get_canvas_parents(can_uri_c, can_uri_x, cp_map=cp_map)
+    if not parent_ids:
+        return result
+    # canvas hits of the parent curations (a curation can contain a canvas
+    # more than once, the first occurrence is reported)
+    canvas_indices = {}
+    with phase('parents'):
+        hits = CurationHit.query.join(CurationHit.curation).filter(
+                    Curation.curation_uri.in_(parent_ids),
+                    CurationHit.hit_type == 'canvas',
+                    CurationHit.canvas_id == can_uri_c,
+                    CurationHit.fragment == fragment
+                    ).with_entities(Curation.curation_uri,
+                                    CurationHit.canvas_index
+                    ).order_by(CurationHit.canvas_index)
+        for cur_uri, canvas_index in hits:
+            canvas_indices.setdefault(cur_uri, canvas_index)
+    for cur_uri in parent_ids:
+        if cur_uri in canvas_indices:
+            parent = {}
+            parent['curationUrl'] = cur_uri
+            parent['curationCanvasIndex'] = canvas_indices[cur_uri]
+            result['curations'].append(parent)
+    return result
@@ -0,0 +1,334 @@
+""" In-memory search engine for the API.
+
+    Instead of joining document, association and term tables for every
+    request, the associations are loaded once per index generation into
+    posting lists: for every term and every combination of metadata type and
+    actor a sorted array of document IDs. Searches are answered by merging
+    and intersecting these lists, so the DB is only needed to load the
+    documents of the page actually returned.
+
+    Enabled by setting `search_engine = memory` in the api section of the
+    config.
+"""
+
+import heapq
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from itertools import chain
+from canvasindexer.connections import request_generation
+from canvasindexer.models import (db, Term, Curation, CurationHit,
+                                  TermCanvasAssoc, TermCurationAssoc)
+
+_engine = {'instance': None}
+_engine_lock = threading.Lock()
+
+CONTAINER_LABEL = 'A mere container for machine tagged cavanses'
+
+
+def like_to_regex(pattern):
+    """ Translate a SQL LIKE pattern into a compiled case insensitive regular
+        expression.
+    """
+
+    parts = []
+    for char in pattern:
+        if char == '%':
+            parts.append('.*')
+        elif char == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    return re.compile('^{}$'.format(''.join(parts)), re.IGNORECASE | re.DOTALL)
+
+
+def actor_bucket(actor):
+    """ Group actors the way the API filters them (unknown counts as human).
+    """
+
+    if actor in ['human', 'unknown']:
+        return 'human'
+    elif actor == 'machine':
+        return 'machine'
+    return 'other'
+
+
+def union(lists):
+    """ Merge sorted ID lists into one sorted list without duplicates.
+    """
+
+    if len(lists) == 1:
+        return lists[0]
+    merged = array('i')
+    last = None
+    for doc_id in heapq.merge(*lists):
+        if doc_id != last:
+            merged.append(doc_id)
+            last = doc_id
+    return merged
+
+
+def intersection(lists):
+    """ Intersect sorted ID lists. The shortest list is walked while the others
+        are searched in using bisection.
+    """
+
+    lists = sorted(lists, key=len)
+    result = lists[0]
+    for other in lists[1:]:
+        kept = array('i')
+        lo = 0
+        for doc_id in result:
+            lo = bisect_left(other, doc_id, lo)
+            if lo == len(other):
+                break
+            if other[lo] == doc_id:
+                kept.append(doc_id)
+        result = kept
+        if not result:
+            break
+    return result
+
+
+class SearchEngine():
+    """ Posting lists of one index generation.
+    """
+
+    def __init__(self, generation, e_term):
+        self.generation = generation
+        self.e_term = e_term
+        # (qualifier, term) → term ID for all searchable terms
+        self.terms = {}
+        # {'canvas': {<term ID>: {(<metadata type>, <actor>): array}},
+        #  'curation': ...}
+        self.postings = {'canvas': {}, 'curation': {}}
+        # curation hit ID → (curation ID, is hit for top level metadata)
+        self.hits = {}
+        self.container_curations = set()
+        # select → forward index (see forward_index), built when first needed
+        self.forward = {}
+        self._forward_lock = threading.Lock()
+        self._term_keys = None
+
+    def load(self):
+        for term_id, term, qualifier, hidden in db.session.query(
+                Term.id, Term.term, Term.qualifier, Term.hidden):
+            if hidden or term == self.e_term:
+                continue
+            self.terms[(qualifier, term)] = term_id
+        self._load_postings('canvas', TermCanvasAssoc.canvas_id,
+                            TermCanvasAssoc)
+        self._load_postings('curation', TermCurationAssoc.curation_hit_id,
+                            TermCurationAssoc)
+        for hit_id, cur_id, hit_type in db.session.query(
+                CurationHit.id, CurationHit.curation_id, CurationHit.hit_type):
+            self.hits[hit_id] = (cur_id, hit_type == 'curation')
+        for cur in Curation.query:
+            if cur.get_doc()['curationLabel'] == CONTAINER_LABEL:
+                self.container_curations.add(cur.id)
+        return self
+
+    def _load_postings(self, select, doc_id_col, Assoc):
+        postings = self.postings[select]
+        assocs = db.session.query(Assoc.term_id, doc_id_col,
+                                  Assoc.metadata_type, Assoc.actor
+                                  ).order_by(doc_id_col)
+        for term_id, doc_id, metadata_type, actor in assocs:
+            lists = postings.setdefault(term_id, {})
+            key = (metadata_type, actor_bucket(actor))
+            if key not in lists:
+                lists[key] = array('i')
+            lists[key].append(doc_id)
+
+    def match_terms(self, qualifier, value, fuzzy):
+        """ Return the IDs of the terms matching a search condition. A value
+            of None matches all terms.
+        """
+
+        if value is None:
+            return list(self.terms.values())
+        if not fuzzy:
+            term_id = self.terms.get((qualifier, value))
+            return [term_id] if term_id is not None else []
+        regex = like_to_regex('%{}%'.format(value))
+        return [term_id for (qual, term), term_id in self.terms.items()
+                if (qualifier is None or qual == qualifier) and
+                regex.match(term)]
+
+    def search(self, select, conditions, where_op, from_types, actors,
+               term_cache=None):
+        """ Return the sorted IDs of the documents (Canvases or Curation hits)
+            matching the conditions, each given as (qualifier, value, fuzzy).
+            from_types and actors are lists of the metadata types and actor
+            groups to consider (None for all). Matching terms are cached in
+            term_cache if given.
+        """
+
+        postings = self.postings[select]
+        results = []
+        for condition in conditions:
+            if term_cache is None:
+                term_ids = self.match_terms(*condition)
+            else:
+                if condition not in term_cache:
+                    term_cache[condition] = self.match_terms(*condition)
+                term_ids = term_cache[condition]
+            lists = []
+            for term_id in term_ids:
+                for (metadata_type, actor), ids in postings.get(
+                        term_id, {}).items():
+                    if from_types is not None and \
+                            metadata_type not in from_types:
+                        continue
+                    if actors is not None and actor not in actors:
+                        continue
+                    lists.append(ids)
+            results.append(union(lists) if lists else array('i'))
+        if where_op == 'or':
+            return union(results)
+        return intersection(results)
+
+    def forward_index(self, select):
+        """ Return the terms of each document as two arrays (offsets,
+            entries). The entries of document ID i are
+            entries[offsets[i]:offsets[i+1]], each of them a term given as
+            2 * <term ID> + <1 if machine generated, else 0>. Only terms
+            counted as facets are included, for Canvases only Canvas metadata.
+            For Curations, the document IDs are Curation IDs and the terms of
+            all their hits are included once.
+        """
+
+        if select not in self.forward:
+            with self._forward_lock:
+                if select not in self.forward:
+                    self.forward[select] = self._build_forward_index(select)
+        return self.forward[select]
+
+    def _build_forward_index(self, select):
+        term_ids = set(self.terms.values())
+        by_doc = {}
+        for term_id, lists in self.postings[select].items():
+            if term_id not in term_ids:
+                continue
+            for (metadata_type, actor), ids in lists.items():
+                if select == 'canvas' and metadata_type != 'canvas':
+                    continue
+                entry = 2 * term_id + (actor == 'machine')
+                if select == 'curation':
+                    ids = [self.get_hit(hit_id)[0] for hit_id in ids]
+                for doc_id in ids:
+                    by_doc.setdefault(doc_id, []).append(entry)
+        offsets = array('q', [0])
+        entries = array('i')
+        for doc_id in range(max(by_doc) + 1 if by_doc else 0):
+            doc_entries = by_doc.get(doc_id, [])
+            if select == 'curation':
+                # Curations are counted once, no matter how many of their
+                # hits are associated with a term
+                doc_entries = sorted(set(doc_entries))
+            entries.extend(doc_entries)
+            offsets.append(len(entries))
+        return offsets, entries
+
+    def term_keys(self):
+        """ Return a dict term ID → (qualifier, term).
+        """
+
+        if self._term_keys is None:
+            self._term_keys = {term_id: key
+                               for key, term_id in self.terms.items()}
+        return self._term_keys
+
+    def facet_counts(self, select, doc_ids):
+        """ Count the values of each label among the given documents (sorted
+            Canvas or Curation IDs) in the form expected by
+            canvasindexer.crawler.crawler.sort_facets. Like for /facets, only
+            Canvas metadata is counted for Canvases.
+        """
+
+        offsets, entries = self.forward_index(select)
+        doc_ids = doc_ids[:bisect_left(doc_ids, len(offsets) - 1)]
+        # ↓ the entries of all documents, sliced and counted in C
+        starts = map(offsets.__getitem__, doc_ids)
+        ends = map(offsets.__getitem__, map((1).__add__, doc_ids))
+        counts = Counter(chain.from_iterable(
+                    map(entries.__getitem__, map(slice, starts, ends))))
+        term_keys = self.term_keys()
+        facet_counts = OrderedDict()
+        for term_id in sorted({entry >> 1 for entry in counts}):
+            qualifier, term = term_keys[term_id]
+            facet_counts.setdefault(qualifier, OrderedDict())[term] = [
+                                counts[2 * term_id], counts[2 * term_id + 1]]
+        return facet_counts
+
+    def get_hit(self, hit_id):
+        """ Return (<curation ID>, <is hit for top level metadata>).
+        """
+
+        return self.hits[hit_id]
+
+    def merge_curation_hits(self, hit_ids):
+        """ Combine Curation hits the way the API presents them: one result
+            per Curation, which unites a top level metadata hit with a canvas
+            hit where possible. Return a list of tuples
+
+                (<hit ID>, <ID of the hit to take the canvasHit from or None>)
+
+            in the order in which the Curations first appear in hit_ids.
+        """
+
+        by_cur = {}
+        order = []
+        for hit_id in hit_ids:
+            cur_id, is_cur_hit = self.get_hit(hit_id)
+            if cur_id in self.container_curations:
+                continue
+            if cur_id not in by_cur:
+                by_cur[cur_id] = []
+                order.append(cur_id)
+            by_cur[cur_id].append((hit_id, is_cur_hit))
+        merged = []
+        for cur_id in order:
+            hits = by_cur[cur_id]
+            if len(hits) == 1:
+                merged.append((hits[0][0], None))
+            elif len(hits) == 2:
+                if hits[0][1]:
+                    merged.append((hits[0][0], hits[1][0]))
+                else:
+                    merged.append((hits[1][0], hits[0][0]))
+            else:
+                has_cur = None
+                has_can = None
+                for hit_id, is_cur_hit in hits:
+                    if is_cur_hit:
+                        has_cur = hit_id
+                    else:
+                        has_can = hit_id
+                    if has_cur and has_can:
+                        break
+                if has_cur and has_can:
+                    merged.append((has_cur, has_can))
+                else:
+                    merged.append((hits[-1][0], None))
+        return merged
+
+
+def get_engine(cfg):
+    """ Return the engine for the current index generation, (re)building it
+        if the index changed since it was last built.
+    """
+
+    gen = request_generation(cfg)
+    generation = gen['generation'] if gen else None
+    engine = _engine['instance']
+    if engine is not None and engine.generation == generation:
+        return engine
+    with _engine_lock:
+        engine = _engine['instance']
+        if engine is None or engine.generation != generation:
+            engine = SearchEngine(generation, cfg.e_term()).load()
+            _engine['instance'] = engine
+    return engine
@@ -0,0 +1,63 @@
+""" Facet counts for the documents matched by a search (facets=true).
+"""
+
+from collections import OrderedDict
+from canvasindexer.models import (db, Term, Curation, CurationHit,
+                                  TermCanvasAssoc, TermCurationAssoc)
+from sqlalchemy import case, func, not_
+
+
+def count_facets(select, doc_ids, e_term, chunk_size=500):
+    """ Count the values of each label among the given documents (Canvas or
+        Curation IDs) in the form expected by
+        canvasindexer.crawler.crawler.sort_facets. Documents are passed to the
+        DB in chunks, the counts of which are added up.
+    """
+
+    if select == 'canvas':
+        Assoc = TermCanvasAssoc
+        doc_id_col = TermCanvasAssoc.canvas_id
+        count_col = func.count(TermCanvasAssoc.canvas_id)
+    else:
+        Assoc = TermCurationAssoc
+        doc_id_col = CurationHit.curation_id
+        # Curations are counted once, no matter how many of their hits are
+        # associated with a term
+        count_col = func.count(CurationHit.curation_id.distinct())
+    # unknown and other actors count as human (see sort_facets)
+    actor_col = case([(Assoc.actor == 'machine', 'machine')], else_='human')
+    counts = {}
+    for i in range(0, len(doc_ids), chunk_size):
+        chunk = doc_ids[i:i+chunk_size]
+        query = db.session.query(Term.id, Term.qualifier, Term.term,
+                                 actor_col, count_col
+                                 ).join(Assoc, Assoc.term_id == Term.id)
+        if select == 'canvas':
+            query = query.filter(TermCanvasAssoc.metadata_type == 'canvas')
+        else:
+            query = query.join(CurationHit)
+        query = query.filter(doc_id_col.in_(chunk),
+                             not_(Term.term == e_term),
+                             not_(Term.hidden)
+                             ).group_by(Term.id, actor_col)
+        for term_id, qualifier, term, actor, count in query:
+            if (term_id, qualifier, term) not in counts:
+                counts[(term_id, qualifier, term)] = [0, 0]
+            counts[(term_id, qualifier, term)][actor == 'machine'] += count
+    facet_counts = OrderedDict()
+    for (term_id, qualifier, term), value_counts in sorted(counts.items()):
+        facet_counts.setdefault(qualifier, OrderedDict())[term] = value_counts
+    return facet_counts
+
+
+def get_curation_ids(curation_urls, chunk_size=500):
+    """ Return the sorted DB IDs of the Curations with the given URLs.
+    """
+
+    cur_ids = []
+    curation_urls = list(curation_urls)
+    for i in range(0, len(curation_urls), chunk_size):
+        cur_ids.extend(cur_id for (cur_id,) in Curation.query.filter(
+                    Curation.curation_uri.in_(curation_urls[i:i+chunk_size])
+                    ).with_entities(Curation.id))
+    return sorted(cur_ids)
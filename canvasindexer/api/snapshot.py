@@ -0,0 +1,293 @@
+""" Read-only index snapshots shared by all API workers.
+
+    After the index changed, the crawler writes a single binary file that
+    contains everything needed to answer /api requests: the term dictionary,
+    the posting lists of the in-memory engine and all search result
+    documents, pre-serialized as compact JSON. API workers map the file into
+    memory (mmap), so all of them share one copy through the OS page cache
+    instead of each holding their own Python objects.
+
+    A new snapshot is written to a temporary file which then replaces the
+    old one. Workers pick it up by generation number; requests still running
+    keep using the old mapping.
+
+    Layout (native byte order, sections 8 byte aligned):
+
+        header     MAGIC, generation (int64), dictionary offset and length
+        sections   int32 arrays (posting lists, document and hit IDs, hit
+                   curation IDs and flags, forward index entries), int64
+                   arrays (document and forward index offsets) and the
+                   serialized documents
+        dictionary JSON describing where in the file the sections are
+
+    Enabled by setting `search_engine = snapshot` in the api section of the
+    config.
+"""
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+from functools import partial
+from bisect import bisect_left
+from canvasindexer.api.documents import (canvas_result, iter_curation_hit_docs,
+                                         iter_docs, load_canvas_parent_map)
+from canvasindexer.api.engine import SearchEngine
+from canvasindexer.api.streaming import COMPACT_SEPARATORS
+from canvasindexer.generation import bump_generation, read_generation
+from canvasindexer.models import Canvas
+
+MAGIC = b'CISNAP02'
+HEADER = struct.Struct('=8sqqq')
+
+_snapshot = {'instance': None, 'key': None}
+_snapshot_lock = threading.Lock()
+
+
+class SnapshotWriter():
+    """ Helper for writing aligned sections to a snapshot file.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.f.write(b'\0' * HEADER.size)
+
+    def align(self):
+        pos = self.f.tell()
+        if pos % 8:
+            self.f.write(b'\0' * (8 - pos % 8))
+        return self.f.tell()
+
+    def write_array(self, arr):
+        offset = self.align()
+        arr.tofile(self.f)
+        return offset
+
+    def write_bytes(self, data):
+        offset = self.f.tell()
+        self.f.write(data)
+        return offset
+
+
+def write_docs(writer, doc_ids, docs):
+    """ Write the serialized documents and the arrays needed to find them.
+        Return the dictionary entry describing them.
+    """
+
+    offsets = array('q')
+    start = writer.align()
+    for doc in docs:
+        offsets.append(writer.f.tell() - start)
+        writer.f.write(json.dumps(doc, separators=COMPACT_SEPARATORS
+                                  ).encode('utf-8'))
+    offsets.append(writer.f.tell() - start)
+    return {'start': start,
+            'ids': writer.write_array(array('i', doc_ids)),
+            'offsets': writer.write_array(offsets),
+            'count': len(doc_ids)}
+
+
+def write_snapshot(path, generation, e_term):
+    """ Write a snapshot of the current index to path (atomically replacing
+        an existing one).
+    """
+
+    engine = SearchEngine(generation, e_term).load()
+    fd, tmp_path = tempfile.mkstemp(
+                        dir=os.path.dirname(os.path.abspath(path)),
+                        prefix='{}.'.format(os.path.basename(path)),
+                        suffix='.tmp')
+    # ↓ mkstemp creates the file readable by its owner only, API workers
+    #   might run as another user
+    os.chmod(tmp_path, 0o644)
+    try:
+        with open(fd, 'wb') as f:
+            _write_snapshot(f, engine, generation)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def _write_snapshot(f, engine, generation):
+    """ Write the sections and the header of a snapshot to f.
+    """
+
+    writer = SnapshotWriter(f)
+    dictionary = {'generation': generation,
+                  'terms': [[qual, term, term_id] for (qual, term), term_id
+                            in engine.terms.items()],
+                  'postings': {},
+                  'container_curations': sorted(
+                      engine.container_curations)}
+    for select, postings in engine.postings.items():
+        dictionary['postings'][select] = [
+            [term_id, metadata_type, actor, writer.write_array(ids),
+             len(ids)]
+            for term_id, lists in postings.items()
+            for (metadata_type, actor), ids in lists.items()]
+    hit_ids = sorted(engine.hits)
+    dictionary['hits'] = {
+        'ids': writer.write_array(array('i', hit_ids)),
+        'curations': writer.write_array(array(
+            'i', [engine.hits[h][0] for h in hit_ids])),
+        'flags': writer.write_array(array(
+            'i', [int(engine.hits[h][1]) for h in hit_ids])),
+        'count': len(hit_ids)}
+    dictionary['forward'] = {}
+    for select in ['canvas', 'curation']:
+        offsets, entries = engine.forward_index(select)
+        dictionary['forward'][select] = {
+            'offsets': writer.write_array(offsets),
+            'entries': writer.write_array(entries),
+            'count': len(offsets),
+            'entry_count': len(entries)}
+    canvas_ids = [c_id for (c_id,) in Canvas.query.with_entities(
+                                            Canvas.id).order_by(Canvas.id)]
+    cp_map = load_canvas_parent_map()
+    dictionary['docs'] = {
+        'canvas': write_docs(writer, canvas_ids,
+                             (canvas_result(doc, cp_map) for doc
+                              in iter_docs(Canvas, canvas_ids))),
+        'curation': write_docs(writer, hit_ids,
+                               iter_curation_hit_docs(hit_ids))}
+    dict_bytes = json.dumps(dictionary).encode('utf-8')
+    dict_offset = writer.write_bytes(dict_bytes)
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, generation, dict_offset, len(dict_bytes)))
+
+
+def publish_index(cfg, timestamp=None, db_uri=None):
+    """ Let API workers know that the index changed: write a new snapshot (if
+        snapshots are used) and bump the index generation. Return the new
+        generation dict. If db_uri is given, API workers switch to that DB.
+    """
+
+    prepare = None
+    if cfg.search_engine() == 'snapshot':
+        prepare = partial(write_snapshot, cfg.snapshot_file(),
+                          e_term=cfg.e_term())
+    if db_uri is not None:
+        return bump_generation(cfg.generation_file(), timestamp, db_uri,
+                               cfg.db_uri(), prepare)
+    return bump_generation(cfg.generation_file(), timestamp, prepare=prepare)
+
+
+def snapshot_generation(path):
+    """ Return the generation of the snapshot at path, or None if there is
+        none.
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            magic, generation, _, _ = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC:
+        return None
+    return generation
+
+
+class Snapshot(SearchEngine):
+    """ A search engine reading from a memory mapped snapshot file.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self.mm)
+        magic, generation, dict_offset, dict_length = HEADER.unpack_from(
+                                                                self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not an index snapshot'.format(path))
+        dictionary = json.loads(
+            bytes(self.buf[dict_offset:dict_offset+dict_length]).decode())
+        self.generation = generation
+        self.terms = {(qual, term): term_id
+                      for qual, term, term_id in dictionary['terms']}
+        self.postings = {}
+        for select, lists in dictionary['postings'].items():
+            self.postings[select] = {}
+            for term_id, metadata_type, actor, offset, count in lists:
+                self.postings[select].setdefault(term_id, {})[
+                    (metadata_type, actor)] = self._ints(offset, count)
+        hits = dictionary['hits']
+        self.hit_ids = self._ints(hits['ids'], hits['count'])
+        self.hit_curations = self._ints(hits['curations'], hits['count'])
+        self.hit_flags = self._ints(hits['flags'], hits['count'])
+        self.container_curations = set(dictionary['container_curations'])
+        self.forward = {
+            select: (self.buf[index['offsets']:
+                              index['offsets']+8*index['count']].cast('q'),
+                     self._ints(index['entries'], index['entry_count']))
+            for select, index in dictionary['forward'].items()}
+        self._term_keys = None
+        self.docs = {}
+        for select, docs in dictionary['docs'].items():
+            self.docs[select] = (
+                docs['start'],
+                self._ints(docs['ids'], docs['count']),
+                self.buf[docs['offsets']:docs['offsets']+8*(docs['count']+1)
+                         ].cast('q'))
+
+    def _ints(self, offset, count):
+        return self.buf[offset:offset+4*count].cast('i')
+
+    def get_hit(self, hit_id):
+        i = bisect_left(self.hit_ids, hit_id)
+        return (self.hit_curations[i], bool(self.hit_flags[i]))
+
+    def get_doc_json(self, select, doc_id):
+        """ Return the search result document with the given ID as compact
+            JSON.
+        """
+
+        start, ids, offsets = self.docs[select]
+        i = bisect_left(ids, doc_id)
+        return bytes(self.buf[start+offsets[i]:start+offsets[i+1]]
+                     ).decode('utf-8')
+
+    def iter_merged_curation_docs(self, merged_ids):
+        """ Same as canvasindexer.api.documents.iter_merged_curation_docs.
+        """
+
+        for hit_id, canvas_hit_id in merged_ids:
+            doc = json.loads(self.get_doc_json('curation', hit_id),
+                             object_pairs_hook=OrderedDict)
+            if canvas_hit_id is not None:
+                doc['canvasHit'] = json.loads(
+                    self.get_doc_json('curation', canvas_hit_id),
+                    object_pairs_hook=OrderedDict)['canvasHit']
+            yield doc
+
+
+def get_snapshot(cfg):
+    """ Return the current snapshot, mapping a newly published one if the
+        index generation changed. Return None if no snapshot (of the current
+        format) was published yet.
+    """
+
+    gen = read_generation(cfg.generation_file())
+    generation = gen['generation'] if gen else None
+    snapshot = _snapshot['instance']
+    if snapshot is not None and snapshot.generation == generation:
+        return snapshot
+    with _snapshot_lock:
+        try:
+            st = os.stat(cfg.snapshot_file())
+        except OSError:
+            return None
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if _snapshot['key'] != key:
+            try:
+                _snapshot['instance'] = Snapshot(cfg.snapshot_file())
+            except ValueError:
+                # e.g. written by an older version. the crawler replaces it
+                # (see snapshot_generation), until then the DB is used
+                return None
+            _snapshot['key'] = key
+    return _snapshot['instance']
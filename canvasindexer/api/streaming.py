@@ -0,0 +1,55 @@
+""" Incremental JSON serialization of API responses.
+
+    Large search results are written out piece by piece from an iterator
+    instead of first building (and pretty printing) the complete response
+    in memory.
+"""
+
+import json
+from canvasindexer.timing import phase
+
+COMPACT_SEPARATORS = (',', ':')
+
+
+def dumps(obj, pretty=False):
+    """ Serialize obj either indented (for humans) or as compact as possible
+        (for machine clients).
+    """
+
+    with phase('serialize'):
+        if pretty:
+            return json.dumps(obj, indent=4)
+        return json.dumps(obj, separators=COMPACT_SEPARATORS)
+
+
+def json_stream(envelope, key, items, pretty=False, serialized=False):
+    """ Generate the JSON serialization of envelope (a dict) with an
+        additional last entry `key`, the value of which is a list filled from
+        the iterable items. The output is identical to that of dumps() on the
+        fully assembled dict, but only one item is held in memory at a time.
+
+        If serialized is set, items are expected to already be compact JSON
+        strings (only possible if not pretty).
+    """
+
+    indent = '    ' if pretty else ''
+    newline = '\n' if pretty else ''
+    head = dumps(envelope, pretty)
+    head = head[:head.rfind('}')].rstrip()
+    if len(envelope) > 0:
+        head += ','
+    yield '{}{}{}{}'.format(head, newline, indent, dumps(key, pretty))
+    yield ': [' if pretty else ':['
+    first = True
+    for item in items:
+        item_json = item if serialized else dumps(item, pretty)
+        if pretty:
+            item_json = item_json.replace('\n', '\n' + indent * 2)
+        yield '{}{}{}{}'.format('' if first else ',', newline, indent * 2,
+                                item_json)
+        first = False
+    if first:
+        yield ']'
+    else:
+        yield '{}{}]'.format(newline, indent)
+    yield '{}}}'.format(newline)
@@ -0,0 +1,116 @@
+""" Prefix search over the indexed terms (autocompletion).
+
+    The searchable terms are kept in memory as sorted arrays (one for all
+    terms, one per qualifier), so that the terms starting with a prefix are
+    found by bisection. The arrays are rebuilt lazily once the index
+    generation changed, i.e. after a crawl.
+"""
+
+import threading
+from bisect import bisect_left
+from canvasindexer.connections import request_generation
+from canvasindexer.models import (db, Term, CurationHit, TermCanvasAssoc,
+                                  TermCurationAssoc)
+from sqlalchemy import case, func, not_
+
+_term_index = {'instance': None}
+_term_index_lock = threading.Lock()
+
+ACTORS = ['human', 'machine']
+
+
+def term_key(term):
+    """ Sort key of a term (prefix matching is case insensitive).
+    """
+
+    return term.casefold()
+
+
+class TermIndex():
+    """ Sorted term arrays of one index generation.
+    """
+
+    def __init__(self, generation, e_term):
+        self.generation = generation
+        self.e_term = e_term
+        # None (all terms) or qualifier → (sorted keys, entries), where an
+        # entry is (term, qualifier, document frequencies) and the document
+        # frequencies are
+        #   [<canvases human>, <canvases machine>,
+        #    <curations human>, <curations machine>]
+        self.scopes = {}
+
+    def load(self):
+        terms = {}
+        for term_id, term, qualifier in db.session.query(
+                Term.id, Term.term, Term.qualifier).filter(
+                not_(Term.term == self.e_term), not_(Term.hidden)):
+            terms[term_id] = (term, qualifier, [0, 0, 0, 0])
+        # unknown and other actors count as human
+        actor_col = case([(TermCanvasAssoc.actor == 'machine', 1)], else_=0)
+        for term_id, actor, count in db.session.query(
+                TermCanvasAssoc.term_id, actor_col,
+                func.count(TermCanvasAssoc.canvas_id)
+                ).group_by(TermCanvasAssoc.term_id, actor_col):
+            if term_id in terms:
+                terms[term_id][2][actor] += count
+        actor_col = case([(TermCurationAssoc.actor == 'machine', 1)], else_=0)
+        for term_id, actor, count in db.session.query(
+                TermCurationAssoc.term_id, actor_col,
+                func.count(CurationHit.curation_id.distinct())
+                ).join(CurationHit).group_by(TermCurationAssoc.term_id,
+                                             actor_col):
+            if term_id in terms:
+                terms[term_id][2][2 + actor] += count
+        entries = sorted(terms.values(),
+                         key=lambda e: (term_key(e[0]), e[0], e[1]))
+        self.scopes[None] = ([term_key(e[0]) for e in entries], entries)
+        by_qualifier = {}
+        for entry in entries:
+            by_qualifier.setdefault(entry[1], []).append(entry)
+        for qualifier, q_entries in by_qualifier.items():
+            self.scopes[qualifier] = ([term_key(e[0]) for e in q_entries],
+                                      q_entries)
+        return self
+
+    def suggest(self, prefix, qualifier=None, actors=ACTORS, limit=10):
+        """ Return up to limit (all if limit < 0) terms starting with prefix
+            in alphabetical order, each as a tuple
+
+                (<term>, <qualifier>, <#canvases>, <#curations>)
+
+            where only metadata by the given actors is considered.
+        """
+
+        keys, entries = self.scopes.get(qualifier, ([], []))
+        prefix = term_key(prefix)
+        human = 'human' in actors
+        machine = 'machine' in actors
+        suggestions = []
+        for i in range(bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix) or len(suggestions) == limit:
+                break
+            term, qual, freqs = entries[i]
+            canvases = human * freqs[0] + machine * freqs[1]
+            curations = human * freqs[2] + machine * freqs[3]
+            if canvases or curations:
+                suggestions.append((term, qual, canvases, curations))
+        return suggestions
+
+
+def get_term_index(cfg):
+    """ Return the term index for the current index generation, (re)building
+        it if the index changed since it was last built.
+    """
+
+    gen = request_generation(cfg)
+    generation = gen['generation'] if gen else None
+    term_index = _term_index['instance']
+    if term_index is not None and term_index.generation == generation:
+        return term_index
+    with _term_index_lock:
+        term_index = _term_index['instance']
+        if term_index is None or term_index.generation != generation:
+            term_index = TermIndex(generation, cfg.e_term()).load()
+            _term_index['instance'] = term_index
+    return term_index
@@ -1,18 +1,43 @@
+import base64
+import binascii
+from bisect import bisect_right
+import hashlib
 import json
 import uuid
-import requests
 from collections import OrderedDict
 from flask import (abort, Blueprint, current_app, redirect, request,
-                   Response, url_for, render_template)
+                   Response, stream_with_context, url_for, render_template)
 from util.iiif import Curation as CurationObj
-from canvasindexer.crawler.crawler import crawl
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.urls import url_encode
+from canvasindexer.api.caching import conditional
+from canvasindexer.api.documents import (canvas_result, get_canvas_parents,
+                                         get_doc_ids, iter_curation_hit_docs,
+                                         iter_docs, iter_merged_curation_docs,
+                                         load_canvas_parent_map)
+from canvasindexer.api.engine import CONTAINER_LABEL, get_engine
+from canvasindexer.api.facets import count_facets, get_curation_ids
+from canvasindexer.api.snapshot import Snapshot, get_snapshot
+from canvasindexer.api.streaming import dumps, json_stream
+from canvasindexer.api.suggest import get_term_index
+from canvasindexer.connections import read_only
+from canvasindexer.crawler.crawler import crawl, sort_facets
 from canvasindexer.crawler.enhancer import post_job, enhance
-from canvasindexer.models import (Term, Canvas, Curation, FacetList,
-                                  TermCanvasAssoc, TermCurationAssoc,
-                                  CanvasParentMap)
+from canvasindexer.models import (Term, Canvas, CurationHit, FacetList,
+                                  TermCanvasAssoc, TermCurationAssoc)
+from canvasindexer.profiler import (finish_request_profile,
+                                    start_request_profile)
+from canvasindexer.timing import (finish_timing, phase, render_metrics,
+                                  start_timing)
 from sqlalchemy import not_
 
 pd = Blueprint('pd', __name__)
+pd.before_request(start_request_profile)
+pd.before_request(start_timing)
+# after request hooks run in reverse order, the profile is logged last
+pd.after_request(finish_request_profile)
+pd.after_request(finish_timing)
 
 
 def combine(cr1, cr2):
@@ -30,27 +55,217 @@ def combine(cr1, cr2):
     return has_cur
 
 
-def get_canvas_parents(canvas, xywh, cp_map_db = None):
-    parents = []
-    if not cp_map_db:
-        cp_map_db = CanvasParentMap.query.first()
-    if cp_map_db:
-        cp_map = json.loads(cp_map_db.json_string)
-    else:
-        cp_map = {'upward':{}, 'downward':{}}
-    if xywh and len(xywh) > 0:
-        needle = '{}#xywh={}'.format(canvas, xywh)
-        haystack = cp_map['upward']
+def merge_curation_results(all_results):
+    """ Combine the Curation and Canvas hits of each Curation (for searches
+        answered by the DB).
+    """
+
+    unique_cur_urls = []
+    merged_results = []
+    for r in all_results:
+        if r['curationLabel'] == CONTAINER_LABEL:
+            # FIXME: dirty solution to keep "container" curations (that
+            #        only contain canvases + machine generated tags)
+            #        out of search results
+            #        using canvases directly doesn't work here because
+            #        the original canvas url needs to be preserved for
+            #        associating the tags with the canvas
+            #
+            #        solution: use ranges an containers (requires some
+            #        work in the crawling process)
+            continue
+        dupes = [d for d in all_results
+                 if d['curationUrl'] == r['curationUrl']]
+        if len(dupes) == 2:
+            if r['curationUrl'] not in unique_cur_urls:
+                merged_results.append(combine(*dupes))
+        elif len(dupes) > 2:
+            # FIXME: 1. this can be done more efficient
+            if r['curationUrl'] not in unique_cur_urls:
+                has_cur = None
+                has_can = None
+                for cr in dupes:
+                    if cr['curationHit']:
+                        has_cur = cr
+                    else:
+                        has_can = cr
+                    if has_cur and has_can:
+                        break
+                if has_cur and has_can:
+                    merged_results.append(combine(has_cur, has_can))
+                else:
+                    merged_results.append(cr)
+        else:
+            merged_results.append(r)
+        unique_cur_urls.append(r['curationUrl'])
+    return merged_results
+
+
+def encode_cursor(doc_id):
+    """ Create an opaque cursor token pointing behind the given document.
+    """
+
+    return base64.urlsafe_b64encode(json.dumps({'after': doc_id}).encode()
+                                    ).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """ Get the document ID from a cursor token. Return None if the token is
+        not valid.
+    """
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        after = json.loads(base64.urlsafe_b64decode(padded.encode()).decode()
+                           )['after']
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        return None
+    if type(after) != int:
+        return None
+    return after
+
+
+def get_id_page(id_query, id_col, after_id, limit):
+    """ Keyset pagination. Return the IDs of the first `limit` documents
+        (all if limit < 0) with an ID greater than after_id, and the ID to
+        continue from for the next page (None if there is no next page or
+        the page is empty).
+    """
+
+    id_query = id_query.distinct().order_by(id_col)
+    if after_id is not None:
+        id_query = id_query.filter(id_col > after_id)
+    if limit >= 0:
+        id_query = id_query.limit(limit + 1)
+    page_ids = [doc_id for (doc_id,) in id_query]
+    if limit >= 0 and len(page_ids) > limit:
+        page_ids = page_ids[:limit]
+        if page_ids:
+            return page_ids, page_ids[-1]
+    return page_ids, None
+
+
+class CanvasResults():
+    """ The Canvas search results with the given IDs. They are loaded (as JSON
+        strings if they're read from a snapshot) one at a time whenever the
+        results are iterated over, so they can be gone through more than once
+        without being held in memory.
+    """
+
+    def __init__(self, engine, doc_ids):
+        self.engine = engine
+        self.doc_ids = doc_ids
+
+    def __iter__(self):
+        if isinstance(self.engine, Snapshot):
+            return (self.engine.get_doc_json('canvas', doc_id)
+                    for doc_id in self.doc_ids)
+        cp_map = load_canvas_parent_map()
+        return (canvas_result(doc, cp_map)
+                for doc in iter_docs(Canvas, self.doc_ids))
+
+    def subset(self, doc_ids):
+        return CanvasResults(self.engine, doc_ids)
+
+
+def get_list_page(doc_ids, after_id, limit):
+    """ Same as get_id_page, for a sorted list of document IDs.
+    """
+
+    i = 0
+    if after_id is not None:
+        i = bisect_right(doc_ids, after_id)
+    if limit < 0:
+        return doc_ids[i:], None
+    page_ids = doc_ids[i:i+limit]
+    if page_ids and i + limit < len(doc_ids):
+        return page_ids, page_ids[-1]
+    return page_ids, None
+
+
+def single_or_list(values):
+    """ Represent request argument values in the response the way they were
+        given: False if not set, a string if set once, a list otherwise.
+    """
+
+    if not values:
+        return False
+    if len(values) == 1:
+        return values[0]
+    return values
+
+
+def get_term_query(qualifier, value, fuzzy):
+    """ Build a query for the searchable terms matching a search condition
+        (qualifier, value, fuzzy). A value of None matches all terms.
+    """
+
+    # (hidden metadata labels don't yield search results)
+    terms = Term.query.filter(not_(Term.term == current_app.cfg.e_term()),
+                              not_(Term.hidden))
+    if value is not None:
+        if fuzzy:
+            terms = terms.filter(Term.term.ilike('%{}%'.format(value)))
+        else:
+            terms = terms.filter(Term.term == value)
+        if qualifier is not None:
+            terms = terms.filter(Term.qualifier == qualifier)
+    return terms
+
+
+def get_id_query(Doc, Assoc, vrom, where_agent, qualifier, value, fuzzy,
+                 term_cache=None):
+    """ Build a query for the IDs of the documents matching a search condition
+        (qualifier, value, fuzzy). A value of None matches all terms.
+
+        If a dict is given as term_cache, the IDs of the matching terms are
+        looked up (or taken from the cache) instead of joining the term
+        table.
+    """
+
+    docs = Doc.query
+    assocs = Assoc.query
+
+    if vrom not in ['curation,canvas', 'canvas,curation']:
+        assocs = assocs.filter(Assoc.metadata_type == vrom)
+    if where_agent in ['human,machine', 'machine,human']:
+        # NOTE: this should actually filter for 'human' or 'machine' or
+        # 'unknown', but in its current, controlled application setup there are
+        # no values except those three, so we just skip the filtering to avoid
+        # unnecessary processing
+        pass
+    elif where_agent == 'human':
+        # the Canvas Indexer crawling process accepts any type of 'agent'
+        # value for metadata and sets it to 'unknown' if not specified.
+        # the API endpoint, however, currently limits queries to the values
+        # 'human' and 'machine' *but* adds the assumption that unknown
+        # agents are humans.
+        assocs = assocs.filter((Assoc.actor == 'human') |
+                               (Assoc.actor == 'unknown'))
     else:
-        needle = '{}#'.format(canvas)
-        haystack = {
-                    key.split('xywh')[0]: val
-                    for (key, val)
-                    in cp_map['upward'].items()
-                   }
-    if needle in haystack:
-        parents = haystack[needle]
-    return parents
+        assocs = assocs.filter(Assoc.actor == where_agent)
+
+    terms = get_term_query(qualifier, value, fuzzy)
+    if term_cache is None or value is None:
+        return docs.join(assocs).join(terms).with_entities(Doc.id)
+    key = (qualifier, value, fuzzy)
+    if key not in term_cache:
+        term_cache[key] = [term_id for (term_id,)
+                           in terms.with_entities(Term.id)]
+    assocs = assocs.filter(Assoc.term_id.in_(term_cache[key]))
+    return docs.join(assocs).with_entities(Doc.id)
+
+
+def combine_doc_ids(id_lists, where_op):
+    """ Combine the document IDs matching several search conditions, either
+        requiring all conditions to match ('and') or any ('or').
+    """
+
+    if where_op == 'or':
+        return get_doc_ids(((doc_id,) for ids in id_lists for doc_id in ids))
+    id_sets = [set(ids) for ids in id_lists[1:]]
+    return [doc_id for doc_id in id_lists[0]
+            if all(doc_id in id_set for id_set in id_sets)]
 
 
 @pd.route('/', methods=['GET', 'POST'])
@@ -74,7 +289,7 @@ def index():
     else:
         canvases = all_canvases
 
-    canvas_dicts = [json.loads(can.json_string) for can in canvases]
+    canvas_dicts = [can.get_doc() for can in canvases]
     canvas_digests = [(can['manifestUrl'],
                       '{}#{}'.format(can['canvasId'], can['fragment']),
                       can['canvasThumbnail'])
@@ -94,43 +309,44 @@ def index():
 
 
 @pd.route('/facets', methods=['GET'])
+@conditional
+@read_only
 def facets():
     """ Facets. Returns an overview of the indexed metadata.
     """
 
+    # the facet list is stored ready to be served (hidden metadata labels
+    # are already left out)
     db_entry = FacetList.query.first()
     if db_entry:
-        facet_list = json.loads(db_entry.json_string,
-                                object_pairs_hook=OrderedDict)
+        resp = Response(db_entry.json_string)
     else:
-        facet_list = {'facets': []}
-
-    # remove hidden metadata labels
-    to_hide = current_app.cfg.facet_label_hide()
-    facet_list['facets'] = [
-        f for f in facet_list ['facets']if f['label'] not in to_hide
-    ]
-
-    resp = Response(json.dumps(facet_list, indent=4))
+        resp = Response(json.dumps({'facets': []}, indent=4))
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
 
-@pd.route('/{}'.format(current_app.cfg.api_path()), methods=['GET'])
-def api():
-    """ Search API.
+def search(args, term_cache=None):
+    """ Run a search given the arguments of an /api request (a MultiDict).
+        Return a tuple (<response envelope>, <results>, <serialized>), where
+        results is an iterable of result documents, given as compact JSON
+        strings if serialized is set.
+
+        Invalid arguments are reported using abort(). If a dict is given as
+        term_cache, search terms are resolved only once across all searches
+        sharing it.
     """
 
     # parse request arguments
     # select
-    select = request.args.get('select', 'curation')
+    select = args.get('select', 'curation')
     if select not in ['curation', 'canvas']:
         return abort(400, 'Parameter "select" must be either "curation" or "ca'
                           'nvas" or not set.')
     # from
     valid_froms = True
     from_default = 'curation,canvas'
-    vrom = request.args.get('from', 'curation,canvas')
+    vrom = args.get('from', 'curation,canvas')
     if vrom == '':
         vrom = from_default
     for v in vrom.split(','):
@@ -141,18 +357,23 @@ def api():
                           'ngth >= 1), containing only the terms "curation" an'
                           'd "canvas".')
     # where*
-    where = request.args.get('where', False)
-    where_metadata_label = request.args.get('where_metadata_label', False)
-    where_metadata_value = request.args.get('where_metadata_value', False)
-    if (where and where_metadata_label and where_metadata_value) or \
-            (where_metadata_label and not where_metadata_value) or \
-            (where_metadata_value and not where_metadata_label):
+    wheres = [w for w in args.getlist('where') if w]
+    where_metadata_labels = [l for l in
+                             args.getlist('where_metadata_label') if l]
+    where_metadata_values = [v for v in
+                             args.getlist('where_metadata_value') if v]
+    if (wheres and where_metadata_labels and where_metadata_values) or \
+            len(where_metadata_labels) != len(where_metadata_values):
         return abort(400, 'You can either set parameter "where" or set both pa'
                           'rameters "where_metadata_label" and "where_metadata'
                           '_value')
+    where_op = args.get('where_op', 'and')
+    if where_op not in ['and', 'or']:
+        return abort(400, 'Parameter "where_op" must be either "and" or "or" o'
+                          'r not set.')
     valid_where_agent = True
     where_agent_detault = 'human,machine'
-    where_agent = request.args.get('where_agent', where_agent_detault)
+    where_agent = args.get('where_agent', where_agent_detault)
     if where_agent == '':
         where_agent = where_agent_detault
     for wa in where_agent.split(','):
@@ -162,230 +383,425 @@ def api():
         return abort(400, 'Parameter "where_agent" must be a comma seperated l'
                           'ist (length >= 1), containing only the terms "human'
                           '" and "machine".')
-    if where:
-        fuzzy = True
+    # search conditions in the form (qualifier, value, fuzzy)
+    if wheres:
+        conditions = [(None, where, True) for where in wheres]
+    elif where_metadata_labels:
+        conditions = [(label, value, False) for label, value
+                      in zip(where_metadata_labels, where_metadata_values)]
     else:
-        fuzzy = False
-    start = int(request.args.get('start', 0))
-    limit = int(request.args.get('limit', -1))
+        conditions = [(None, None, False)]
+    try:
+        start = int(args.get('start', 0))
+        limit = int(args.get('limit', -1))
+    except ValueError:
+        return abort(400, 'Parameters "start" and "limit" must be integers.')
+    cursor = args.get('cursor', None)
+    after_id = None
+    if cursor is not None:
+        if select != 'canvas':
+            return abort(400, 'Parameter "cursor" is only supported in combina'
+                              'tion with "select=canvas".')
+        if 'start' in args:
+            return abort(400, 'Parameters "start" and "cursor" can not be comb'
+                              'ined.')
+        if cursor != '*':
+            after_id = decode_cursor(cursor)
+            if after_id is None:
+                return abort(400, 'Invalid cursor.')
+    count_total = args.get('total', 'exact')
+    if count_total not in ['exact', 'none']:
+        return abort(400, 'Parameter "total" must be either "exact" or "none" '
+                          'or not set.')
+    show_facets = args.get('facets', 'false')
+    if show_facets not in ['true', 'false']:
+        return abort(400, 'Parameter "facets" must be either "true" or "false"'
+                          ' or not set.')
+    show_facets = show_facets == 'true'
 
     # start building response
     ret = OrderedDict()
     ret['select'] = select
     ret['from'] = vrom
-    if where:
-        ret['where'] = where
+    if wheres:
+        ret['where'] = single_or_list(wheres)
     else:
-        ret['where_metadata_label'] = where_metadata_label
-        ret['where_metadata_value'] = where_metadata_value
+        ret['where_metadata_label'] = single_or_list(where_metadata_labels)
+        ret['where_metadata_value'] = single_or_list(where_metadata_values)
+    if len(conditions) > 1:
+        ret['where_op'] = where_op
     ret['where_agent'] = where_agent
-    # ret['fuzzy'] = fuzzy
 
     # select tables
-    results = []
     if select == 'canvas':
         Doc = Canvas
         Assoc = TermCanvasAssoc
     elif select == 'curation':
-        Doc = Curation
+        Doc = CurationHit
         Assoc = TermCurationAssoc
 
     # filter records
-    docs = Doc.query
-    assocs = Assoc.query
-    terms = Term.query.filter(not_(Term.term == current_app.cfg.e_term()))
-
-    # prevent hidden metadata labels from yielding search results
-    for hidden_term in current_app.cfg.facet_label_hide():
-        terms = terms.filter(not_(Term.qualifier == hidden_term))
-
-    if vrom not in ['curation,canvas', 'canvas,curation']:
-        assocs = assocs.filter(Assoc.metadata_type == vrom)
-    if where_agent in ['human,machine', 'machine,human']:
-        # NOTE: this should actually filter for 'human' or 'machine' or
-        # 'unknown', but in its current, controlled application setup there are
-        # no values except those three, so we just skip the filtering to avoid
-        # unnecessary processing
-        pass
-    elif where_agent == 'human':
-        # the Canvas Indexer crawling process accepts any type of 'agent'
-        # value for metadata and sets it to 'unknown' if not specified.
-        # the API endpoint, however, currently limits queries to the values
-        # 'human' and 'machine' *but* adds the assumption that unknown
-        # agents are humans.
-        assocs = assocs.filter((Assoc.actor == 'human') |
-                               (Assoc.actor == 'unknown'))
+    # either id_query (a query for the matching document IDs) or doc_ids (a
+    # list of them) is set
+    id_query = None
+    doc_ids = None
+    engine = None
+    if current_app.cfg.search_engine() == 'snapshot':
+        # (None if no snapshot was published yet → use DB)
+        engine = get_snapshot(current_app.cfg)
+    elif current_app.cfg.search_engine() == 'memory':
+        engine = get_engine(current_app.cfg)
+    # results are either dicts or (if serialized) JSON strings
+    serialized = False
+    if engine is not None:
+        from_types = None
+        if vrom not in ['curation,canvas', 'canvas,curation']:
+            from_types = [vrom]
+        actors = None
+        if where_agent not in ['human,machine', 'machine,human']:
+            actors = [where_agent]
+        with phase('search'):
+            doc_ids = engine.search(select, conditions, where_op, from_types,
+                                    actors, term_cache)
     else:
-        assocs = assocs.filter(Assoc.actor == where_agent)
-    if where:
-        if fuzzy:
-            terms = terms.filter(Term.term.ilike('%{}%'.format(where)))
+        id_queries = [get_id_query(Doc, Assoc, vrom, where_agent, *condition,
+                                   term_cache=term_cache)
+                      for condition in conditions]
+        if len(id_queries) == 1:
+            id_query = id_queries[0]
         else:
-            terms = terms.filter(Term.term == where)
-    elif where_metadata_label:
-        if fuzzy:
-            terms = terms.filter(Term.term.ilike('%{}%'.format(
-                                                          where_metadata_value
-                                                              )),
-                                 Term.qualifier == where_metadata_label)
-        else:
-            terms = terms.filter(Term.term == where_metadata_value,
-                                 Term.qualifier == where_metadata_label)
-
-    docs = docs.join(assocs).join(terms).all()
-
-    if docs:
-        if select == 'curation':
-            # because of result combining we "need" to go through all results
-            #
-            # (first selecting for curations with limit applied (if given) and
-            # then looking for corresponding canvas results is probably faster)
-            all_results = [json.loads(doc.json_string,
-                                      object_pairs_hook=OrderedDict)
-                           for doc in docs]
-            # combine curation and canvas hits
-            unique_cur_urls = []
-            merged_results = []
-            for r in all_results:
-                if r['curationLabel'] == ('A mere container for machine tagged'
-                                          ' cavanses'):
-                    # FIXME: dirty solution to keep "container" curations (that
-                    #        only contain canvases + machine generated tags)
-                    #        out of search results
-                    #        using canvases directly doesn't work here because
-                    #        the original canvas url needs to be preserved for
-                    #        associating the tags with the canvas
-                    #
-                    #        solution: use ranges an containers (requires some
-                    #        work in the crawling process)
-                    continue
-                dupes = [d for d in all_results
-                         if d['curationUrl'] == r['curationUrl']]
-                if len(dupes) == 2:
-                    if r['curationUrl'] not in unique_cur_urls:
-                        merged_results.append(combine(*dupes))
-                elif len(dupes) > 2:
-                    # FIXME: 1. this can be done more efficient
-                    if r['curationUrl'] not in unique_cur_urls:
-                        has_cur = None
-                        has_can = None
-                        for cr in dupes:
-                            if cr['curationHit']:
-                                has_cur = cr
-                            else:
-                                has_can = cr
-                            if has_cur and has_can:
-                                break
-                        if has_cur and has_can:
-                            merged_results.append(combine(has_cur, has_can))
-                        else:
-                            merged_results.append(cr)
-                else:
-                    merged_results.append(r)
-                unique_cur_urls.append(r['curationUrl'])
-            all_results = merged_results
-            # apply start & limit
-            results = all_results[start:]
-            if limit >= 0 and len(results) > limit:
-                results = results[0:limit]
+            doc_ids = combine_doc_ids([get_doc_ids(q) for q in id_queries],
+                                      where_op)
+
+    if select == 'curation' and engine is not None:
+        # hits are combined based on IDs only, so just the documents of the
+        # returned page have to be loaded
+        with phase('merge'):
+            merged_ids = engine.merge_curation_hits(doc_ids)
+        total = len(merged_ids)
+        page_ids = merged_ids[start:]
+        if limit >= 0:
+            page_ids = page_ids[:limit]
+        if isinstance(engine, Snapshot):
+            results = engine.iter_merged_curation_docs(page_ids)
         else:
-            # for canvases, there is no result joining, so we can use start
-            # and limit to reduce the amount of result JSON string parsing
-            all_results = docs  # later only used for len(all_results)
-            results = []
-            for i, doc in enumerate(docs):
-                if limit >= 0 and i<start:
-                    continue
-                if limit >= 0 and i>=start+limit:
-                    break
-                result = json.loads(doc.json_string,
-                                    object_pairs_hook=OrderedDict)
-                # add info on containing curations
-                result['curations'] = []
-                can_uri_parts = doc.canvas_uri.split('#xywh=')
-                if len(can_uri_parts) > 1:
-                    can_uri_c = can_uri_parts[0]
-                    can_uri_x = can_uri_parts[1]
-                else:
-                    # no #xywh contained
-                    can_uri_c = can_uri_parts
-                    can_uri_x = ''
-                cp_map_db = CanvasParentMap.query.first()
-                parent_ids = get_canvas_parents(can_uri_c, can_uri_x, cp_map_db = cp_map_db)
-                curations_seen = []
-                for cur_id in parent_ids:
-                    pcurs_db = Curation.query.filter(Curation.curation_uri.ilike('{}%'.format(cur_id))).all()
-                    for pcur_db in pcurs_db:
-                        pcur_j = json.loads(pcur_db.json_string)
-                        if pcur_j['curationUrl'] in curations_seen:
-                            continue
-                        if type(pcur_j['canvasHit']) == dict and \
-                               pcur_j['canvasHit']['canvasId'] == can_uri_c and \
-                               pcur_j['canvasHit']['fragment'] == 'xywh={}'.format(can_uri_x):
-                            parent = {}
-                            parent['curationUrl'] = pcur_j['curationUrl']
-                            parent['curationCanvasIndex'] = pcur_j['canvasHit']['curationCanvasIndex']
-                            result['curations'].append(parent)
-                            curations_seen.append(pcur_j['curationUrl'])
-                results.append(result)
+            results = iter_merged_curation_docs(page_ids)
+    elif select == 'curation':
+        # because of result combining we "need" to go through all results
+        #
+        # (first selecting for curations with limit applied (if given) and
+        # then looking for corresponding canvas results is probably faster)
+        if doc_ids is None:
+            doc_ids = get_doc_ids(id_query)
+        # ↓ hits are merged in ID order, as by the search engines
+        all_results = list(iter_curation_hit_docs(sorted(doc_ids)))
+        # combine curation and canvas hits
+        with phase('merge'):
+            all_results = merge_curation_results(all_results)
+        total = len(all_results)
+        # apply start & limit
+        results = all_results[start:]
+        if limit >= 0 and len(results) > limit:
+            results = results[0:limit]
+    elif cursor is None:
+        # for canvases, there is no result joining, so we can use start
+        # and limit to only load and parse the documents actually returned.
+        # those are then generated one at a time while writing the response
+        if doc_ids is None:
+            doc_ids = get_doc_ids(id_query)
+        if engine is None:
+            # in ID order, as by the search engines
+            doc_ids = sorted(doc_ids)
+        total = len(doc_ids)
+        page_ids = doc_ids
+        if limit >= 0:
+            page_ids = doc_ids[start:start+limit]
+        results = CanvasResults(engine, page_ids)
+        serialized = isinstance(engine, Snapshot)
     else:
-        all_results = []
+        # keyset pagination: results are ordered by document ID and the
+        # cursor translates into a `WHERE id > ?` clause, so the cost of a
+        # page does not depend on how deep into the result list it is
+        if id_query is not None:
+            page_ids, next_id = get_id_page(id_query, Doc.id, after_id, limit)
+            if count_total == 'exact':
+                total = id_query.distinct().count()
+        else:
+            doc_ids = sorted(doc_ids)
+            page_ids, next_id = get_list_page(doc_ids, after_id, limit)
+            total = len(doc_ids)
+        if next_id is not None:
+            next_cursor = encode_cursor(next_id)
+        else:
+            next_cursor = None
+        results = CanvasResults(engine, page_ids)
+        serialized = isinstance(engine, Snapshot)
 
     # finish building response
-    ret['total'] = len(all_results)
-    ret['start'] = start
+    if count_total == 'exact':
+        ret['total'] = total
+    else:
+        ret['total'] = None
+    if cursor is None:
+        ret['start'] = start
     if limit >= 0:
         ret['limit'] = limit
     else:
         ret['limit'] = None
+    if cursor is not None:
+        ret['cursor'] = cursor
+        ret['next_cursor'] = next_cursor
+    if show_facets:
+        # value counts over all matched documents, not just the page returned
+        if select == 'curation' and engine is not None:
+            facet_ids = sorted({engine.get_hit(hit_id)[0]
+                                for hit_id, _ in merged_ids})
+        elif select == 'curation':
+            facet_ids = get_curation_ids(r['curationUrl'] for r in all_results)
+        else:
+            if doc_ids is None:
+                doc_ids = get_doc_ids(id_query)
+            facet_ids = doc_ids
+        with phase('facets'):
+            if engine is not None:
+                facet_counts = engine.facet_counts(select, facet_ids)
+            else:
+                facet_counts = count_facets(select, facet_ids,
+                                            current_app.cfg.e_term())
+            ret['facets'] = sort_facets(facet_counts)['facets']
+
+    return ret, results, serialized
+
+
+def result_curation(results, cur_id, range_base_url, pretty=False,
+                    serialized=False):
+    """ Generate the JSON serialization of a Curation containing the given
+        Canvas search results (CanvasResults, given as JSON strings if
+        serialized is set). All results from the same Manifest are put into
+        one Range, in the order the Manifests first appear in. The results
+        are gone through twice, first to see which Manifest each one is in,
+        then one Range at a time, so only the Range currently written is held
+        in memory.
+    """
+
+    cur = CurationObj(cur_id, 'Canvas Indexer search result')
+    envelope = cur.get_dict()
+    del envelope['selections']
+    # Range IDs are derived from the Curation ID so that the same search
+    # always yields the same Curation
+    range_prefix = '{}/{}/range/r'.format(
+        range_base_url,
+        hashlib.sha1(cur_id.encode('utf-8')).hexdigest()[:32])
+
+    def docs(results):
+        if serialized:
+            return parse_results(results)
+        return results
+
+    def ranges():
+        by_manifest = OrderedDict()
+        for doc_id, res in zip(results.doc_ids, docs(results)):
+            by_manifest.setdefault(res['manifestUrl'], []).append(doc_id)
+        for i, (within, doc_ids) in enumerate(by_manifest.items()):
+            members = []
+            for res in docs(results.subset(doc_ids)):
+                if len(res['fragment']) == 0:
+                    can_uri = res['canvasId']
+                else:
+                    can_uri = '{}#{}'.format(res['canvasId'], res['fragment'])
+                can = cur.create_canvas(
+                    can_uri,
+                    label = res['canvasLabel']
+                )
+                can['metadata'] = res['metadata']
+                members.append(can)
+            yield cur.create_range(
+                within,
+                members,
+                within_label = res['manifestLabel'],
+                label = 'Temporary range for displaying search results',
+                ran_id = '{}{}'.format(range_prefix, i+1)
+            )
 
-    ret['results'] = results
+    return json_stream(envelope, 'selections', ranges(), pretty)
 
-    # filter out hidden metadata labels
-    for i, _ in enumerate(results):
-        if 'metadata' in results[i]:
-            results[i]['metadata'] = [
-                m for m in results[i]['metadata']
-                if m.get('label') not in current_app.cfg.facet_label_hide()
-                ]
+
+def parse_results(results):
+    """ Parse results given as JSON strings.
+    """
+
+    for result in results:
+        with phase('decode'):
+            doc = json.loads(result, object_pairs_hook=OrderedDict)
+        yield doc
+
+
+@conditional
+@read_only
+def api():
+    """ Search API.
+    """
+
+    ret, results, serialized = search(request.args)
+    pretty = request.args.get('pretty', 'false') == 'true'
 
     # retroactively transform canvas response to Curation JSON
     # if output=cutaion
     output_param = request.args.get('output', '')
-    if output_param == 'curation' and select == 'canvas':
+    if output_param == 'curation' and ret['select'] == 'canvas':
         # build curation
         url_param_part = request.url.split(request.path)[-1]
-        cur = CurationObj(
-            '{}{}{}'.format(
-                current_app.cfg.serv_url(),
-                url_for('pd.api'),
-                url_param_part
-            ),
-            'Canvas Indexer search result')
-        for i, res in enumerate(results):
-            if len(res['fragment']) == 0:
-                can_uri = res['canvasId']
+        cur_id = '{}{}{}'.format(
+            current_app.cfg.serv_url(),
+            url_for('pd.api'),
+            url_param_part
+        )
+        resp = Response(stream_with_context(result_curation(
+            results, cur_id, request.url.split('?')[0], pretty, serialized)))
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+    if serialized and pretty:
+        results = parse_results(results)
+        serialized = False
+
+    resp = Response(stream_with_context(json_stream(ret, 'results', results,
+                                                    pretty, serialized)))
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+
+def batch_args(params):
+    """ Convert the parameters of one search in a batch request (a dict
+        with string, number or boolean values or lists of them) into a
+        MultiDict with the values as they would be given in a URL (e.g. 1
+        → '1', true → 'true').
+    """
+
+    if type(params) != dict:
+        return abort(400, 'Each search must be given as a JSON object.')
+    args = MultiDict()
+    for key, value in params.items():
+        if type(value) != list:
+            value = [value]
+        for v in value:
+            if type(v) == bool:
+                v = str(v).lower()
+            elif type(v) == int:
+                v = str(v)
+            elif type(v) != str:
+                return abort(400, 'Parameter values must be strings, integers'
+                                  ', booleans or lists of them.')
+            args.add(key, v)
+    return args
+
+
+def batch_responses(searches, pretty):
+    """ Generate the responses to the searches of a batch request, as
+        compact JSON strings unless pretty is set. Invalid searches result in
+        an error object {"status": <HTTP status>, "message": <message>}.
+    """
+
+    term_cache = {}
+    for params in searches:
+        try:
+            args = batch_args(params)
+            ret, results, serialized = search(args, term_cache)
+        except HTTPException as e:
+            error = OrderedDict()
+            error['status'] = e.code
+            error['message'] = e.description
+            yield error if pretty else dumps(error)
+            continue
+        if args.get('output') == 'curation' and ret['select'] == 'canvas':
+            api_url = '{}{}'.format(current_app.cfg.serv_url(),
+                                    url_for('pd.api'))
+            cur_json = ''.join(result_curation(
+                results, '{}?{}'.format(api_url, url_encode(args)), api_url,
+                serialized=serialized))
+            if pretty:
+                yield json.loads(cur_json, object_pairs_hook=OrderedDict)
             else:
-                can_uri = '{}#{}'.format(res['canvasId'], res['fragment'])
-            can = cur.create_canvas(
-                can_uri,
-                label = res['canvasLabel']
-            )
-            can['metadata'] = res['metadata']
-            cur.add_and_fill_range(
-                res['manifestUrl'],
-                [can],
-                within_label = res['manifestLabel'],
-                label = 'Temporary range for displaying search results',
-                ran_id = '{}/{}/range/r{}'.format(
-                    request.url.split('?')[0],
-                    str(uuid.uuid4()),
-                    i+1
-                )
-            )
-        ret = cur.get_dict()
+                yield cur_json
+        elif pretty:
+            if serialized:
+                results = parse_results(results)
+            ret['results'] = list(results)
+            yield ret
+        else:
+            yield ''.join(json_stream(ret, 'results', results, False,
+                                      serialized))
 
-    resp = Response(json.dumps(ret, indent=4))
+
+@read_only
+def api_batch():
+    """ Batch search API. Takes a JSON list of searches, each given as an
+        object containing /api parameters, and responds with the list of
+        their results.
+    """
+
+    searches = request.get_json(force=True, silent=True)
+    if type(searches) != list:
+        return abort(400, 'Request body must be a JSON list of searches.')
+    pretty = request.args.get('pretty', 'false') == 'true'
+
+    resp = Response(stream_with_context(json_stream(
+        OrderedDict(), 'responses', batch_responses(searches, pretty), pretty,
+        not pretty)))
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+
+@pd.record
+def add_api_routes(state):
+    """ Add the routes below the configurable API path when the blueprint is
+        registered (so that the config is not needed at import time).
+    """
+
+    api_path = state.app.cfg.api_path()
+    state.add_url_rule('/{}'.format(api_path), view_func=api,
+                       methods=['GET'])
+    state.add_url_rule('/{}/batch'.format(api_path), view_func=api_batch,
+                       methods=['POST'])
+
+
+@pd.route('/suggest', methods=['GET'])
+@conditional
+@read_only
+def suggest():
+    """ Autocompletion. Lists indexed terms starting with a given prefix.
+    """
+
+    ret = OrderedDict()
+    ret['q'] = request.args.get('q', '')
+    ret['qualifier'] = request.args.get('qualifier', None)
+    where_agent = request.args.get('where_agent', 'human,machine')
+    if where_agent == '':
+        where_agent = 'human,machine'
+    actors = where_agent.split(',')
+    if not all(actor in ['human', 'machine'] for actor in actors):
+        return abort(400, 'Parameter "where_agent" must be a comma seperated l'
+                          'ist (length >= 1), containing only the terms "human'
+                          '" and "machine".')
+    ret['where_agent'] = where_agent
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        return abort(400, 'Parameter "limit" must be an integer.')
+    ret['limit'] = limit if limit >= 0 else None
+    pretty = request.args.get('pretty', 'false') == 'true'
+
+    term_index = get_term_index(current_app.cfg)
+    ret['terms'] = []
+    for term, qualifier, canvases, curations in term_index.suggest(
+            ret['q'], ret['qualifier'], actors, limit):
+        entry = OrderedDict()
+        entry['term'] = term
+        entry['qualifier'] = qualifier
+        entry['canvases'] = canvases
+        entry['curations'] = curations
+        ret['terms'].append(entry)
+
+    resp = Response(dumps(ret, pretty))
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
@@ -441,7 +857,22 @@ def callback():
     return resp
 
 
+@pd.route('/metrics', methods=['GET'])
+def metrics():
+    """ Request timing metrics of this worker in the Prometheus text format
+        (only available if timing is enabled).
+    """
+
+    if not current_app.cfg.timing():
+        return abort(404)
+    resp = Response(render_metrics())
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return resp
+
+
 @pd.route('/parents', methods=['GET'])
+@conditional
+@read_only
 def parents():
     """ List a Canvas' parent documents.
 
@@ -481,6 +912,7 @@ def build():
             cans.append(cur.create_canvas(can))
         cur.add_and_fill_range(within, cans)
 
+    import requests
     headers = {'Accept': 'application/json',
                'Content-Type': 'application/ld+json'}
     resp = requests.post(current_app.cfg.curation_upload_url(),
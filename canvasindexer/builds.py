@@ -0,0 +1,161 @@
+""" Blue-green index builds.
+
+    With `blue_green = true` in the crawler section of the config, the
+    crawler does not write to the DB the API is reading from. Instead the
+    index is kept in two SQLite files, the configured one (blue) and a second
+    one next to it with the suffix .green. A crawl copies the active DB into
+    the inactive one (or starts from an empty DB if run with --fresh), crawls
+    into the copy, builds the facet list and only then makes the API switch
+    over by recording the new DB in the generation file, which is replaced
+    atomically. API workers pick up the switch at the start of their next
+    request, requests still running finish on the old DB.
+
+    The previous DB is kept until the next build overwrites it.
+
+    Bots send their results to the API (see canvasindexer.crawler.enhancer),
+    which writes them to the active DB. Results arriving while a build is
+    running are also recorded in a file next to the configured DB, and are
+    replayed into the build right before it is switched to (see
+    callback_lock).
+"""
+
+import fcntl
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from canvasindexer.generation import read_generation
+
+GREEN_SUFFIX = '.green'
+
+
+def sqlite_path(db_uri):
+    return db_uri[len('sqlite:///'):]
+
+
+def active_db_uri(cfg, gen=None):
+    """ Return the URI of the DB the API currently serves from.
+    """
+
+    if gen is None:
+        gen = read_generation(cfg.generation_file())
+    if gen and gen.get('db_uri') and gen.get('base_db_uri') == cfg.db_uri():
+        return gen['db_uri']
+    return cfg.db_uri()
+
+
+def build_db_uri(cfg):
+    """ Return the URI of the DB not in use by the API.
+    """
+
+    if active_db_uri(cfg) == cfg.db_uri():
+        return cfg.db_uri() + GREEN_SUFFIX
+    return cfg.db_uri()
+
+
+def remove_db_files(path):
+    for suffix in ['', '-journal', '-wal', '-shm']:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def callbacks_path(cfg):
+    return sqlite_path(cfg.db_uri()) + '.callbacks'
+
+
+@contextmanager
+def callback_lock(cfg):
+    """ Context manager for writing bot results to the active DB (and
+        recording them, see record_callback), as well as for replaying them
+        into a build and switching to it, so that no results are written to
+        a DB after it was switched away from. Does nothing unless blue-green
+        builds are enabled.
+    """
+
+    if not cfg.blue_green():
+        yield
+        return
+    with open('{}.lock'.format(callbacks_path(cfg)), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def record_callback(cfg, job_result):
+    """ If a build is running, record the results a bot sent, so that they
+        can be replayed into the build. Call with callback_lock held.
+    """
+
+    path = callbacks_path(cfg)
+    if cfg.blue_green() and os.path.exists(path):
+        with open(path, 'a') as f:
+            f.write(json.dumps(job_result) + '\n')
+
+
+def recorded_callbacks(cfg):
+    """ Return the bot results recorded since the current build started.
+        Call with callback_lock held.
+    """
+
+    try:
+        with open(callbacks_path(cfg)) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def end_build(cfg):
+    """ Stop recording bot results. Call with callback_lock held.
+    """
+
+    if os.path.exists(callbacks_path(cfg)):
+        os.remove(callbacks_path(cfg))
+
+
+def start_build(cfg, fresh=False, pages=1024):
+    """ Prepare the inactive DB for a build and return its URI. Unless fresh
+        is set, the active DB is copied using SQLite's online backup, which
+        copies pages in steps so that the active DB stays usable for readers
+        and writers in the meantime.
+
+        Bot results are recorded from before the copy is made, so some of
+        them may already be in it (see apply_job_results).
+    """
+
+    with callback_lock(cfg):
+        with open(callbacks_path(cfg), 'w'):
+            pass
+    build_uri = build_db_uri(cfg)
+    build_path = sqlite_path(build_uri)
+    remove_db_files(build_path)
+    active_path = sqlite_path(active_db_uri(cfg))
+    if not fresh and os.path.exists(active_path):
+        source = sqlite3.connect(active_path)
+        target = sqlite3.connect(build_path)
+        source.backup(target, pages=pages)
+        target.close()
+        source.close()
+    return build_uri
+
+
+def switch_to_build(cfg, build_uri, timestamp=None):
+    """ Replay the bot results recorded during the build into it and make
+        the API switch to it (see publish_index). Needs an app context with
+        the DB session bound to the build. Return the new generation dict.
+    """
+
+    from canvasindexer.api.snapshot import publish_index
+    from canvasindexer.crawler.enhancer import replay_callbacks
+    with callback_lock(cfg):
+        replay_callbacks()
+        gen = publish_index(cfg, timestamp, db_uri=build_uri)
+        end_build(cfg)
+    return gen
+
+
+def discard_build(cfg, build_uri):
+    """ Remove a build that won't be switched to.
+    """
+
+    with callback_lock(cfg):
+        end_build(cfg)
+    remove_db_files(sqlite_path(build_uri))
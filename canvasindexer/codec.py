@@ -0,0 +1,64 @@
+""" Codecs for storing search result documents (Canvas and Curation records)
+    in the DB.
+
+    Every record remembers the codec it was written with, so the configured
+    codec can be changed at any time. Existing records can be converted with
+    run_migration.py.
+"""
+
+import json
+import zlib
+
+
+class JSONCodec():
+    """ Plain JSON text. This is how documents were stored originally, so
+        records without a codec set are read with this one.
+    """
+
+    name = 'json'
+    binary = False
+
+    def encode(self, doc):
+        return json.dumps(doc)
+
+    def decode(self, data, object_pairs_hook=None):
+        return json.loads(data, object_pairs_hook=object_pairs_hook)
+
+
+class ZlibJSONCodec():
+    """ Compact UTF-8 JSON (no whitespace, no \\u escapes), zlib compressed.
+    """
+
+    name = 'zlib'
+    binary = True
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def encode(self, doc):
+        compact = json.dumps(doc, separators=(',', ':'), ensure_ascii=False)
+        return zlib.compress(compact.encode('utf-8'), self.level)
+
+    def decode(self, data, object_pairs_hook=None):
+        return json.loads(zlib.decompress(data).decode('utf-8'),
+                          object_pairs_hook=object_pairs_hook)
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """ Make a codec available under its name. A codec needs a `name`, a
+        `binary` flag (True if `encode` returns bytes instead of str) and the
+        methods `encode(doc)` and `decode(data, object_pairs_hook=None)`.
+    """
+
+    CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    return CODECS[name]
+
+
+register_codec(JSONCodec())
+register_codec(ZlibJSONCodec())
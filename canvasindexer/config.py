@@ -2,8 +2,13 @@
 """
 
 import configparser
+import hashlib
+import json
 import os
 import sys
+from canvasindexer.codec import CODECS
+
+_cfgs = {}
 
 
 class Cfg():
@@ -24,6 +29,27 @@ class Cfg():
     def db_uri(self):
         return self.cfg['db_uri']
 
+    def generation_file(self):
+        return self.cfg['generation_file']
+
+    def snapshot_file(self):
+        return self.cfg['snapshot_file']
+
+    def doc_codec(self):
+        return self.cfg['doc_codec']
+
+    def sqlite_journal_mode(self):
+        return self.cfg['sqlite_journal_mode']
+
+    def sqlite_busy_timeout(self):
+        return self.cfg['sqlite_busy_timeout']
+
+    def sqlite_cache_size(self):
+        return self.cfg['sqlite_cache_size']
+
+    def sqlite_mmap_size(self):
+        return self.cfg['sqlite_mmap_size']
+
     def as_sources(self):
         return self.cfg['as_sources']
 
@@ -33,6 +59,21 @@ class Cfg():
     def crawler_log_file(self):
         return self.cfg['crawler_log_file']
 
+    def crawler_profile_sql(self):
+        return self.cfg['crawler_profile_sql']
+
+    def defer_thumbnails(self):
+        return self.cfg['defer_thumbnails']
+
+    def pipeline_workers(self):
+        return self.cfg['pipeline_workers']
+
+    def pipeline_executor(self):
+        return self.cfg['pipeline_executor']
+
+    def blue_green(self):
+        return self.cfg['blue_green']
+
     def allow_orphan_canvases(self):
         return self.cfg['allow_orphan_canvases']
 
@@ -63,6 +104,35 @@ class Cfg():
     def bot_urls(self):
         return self.cfg['bot_urls']
 
+    def cache_max_age(self):
+        return self.cfg['cache_max_age']
+
+    def search_engine(self):
+        return self.cfg['search_engine']
+
+    def timing(self):
+        return self.cfg['timing']
+
+    def api_profile_sql(self):
+        return self.cfg['api_profile_sql']
+
+    def slow_query_ms(self):
+        return self.cfg['slow_query_ms']
+
+    def sqlite_read_only_api(self):
+        return self.cfg['sqlite_read_only_api']
+
+    def fingerprint(self):
+        """ Return a short digest of the parsed config. Used to tell apart
+            API responses generated with different settings.
+        """
+
+        if not hasattr(self, '_fingerprint'):
+            dump = json.dumps(self.cfg, sort_keys=True)
+            self._fingerprint = hashlib.sha1(dump.encode('utf-8')
+                                             ).hexdigest()[:8]
+        return self._fingerprint
+
     def e_term(self):
         """ Return a placeholder term that will be associated with all
             documents to ensure documents w/o any metadata (yet) will also be
@@ -77,13 +147,31 @@ class Cfg():
         # later read from config file
         cfg = {}
         cfg['db_uri'] = 'sqlite:////tmp/ci_tmp.db'
+        cfg['generation_file'] = '/tmp/ci_generation.json'
+        cfg['doc_codec'] = 'zlib'
+        cfg['snapshot_file'] = '/tmp/ci_snapshot.bin'
+        cfg['sqlite_journal_mode'] = ''
+        cfg['sqlite_busy_timeout'] = 5000
+        cfg['sqlite_cache_size'] = 0
+        cfg['sqlite_mmap_size'] = 0
+        cfg['slow_query_ms'] = 100
         cfg['as_sources'] = []
         cfg['crawler_interval'] = 3600
         cfg['crawler_log_file'] = '/tmp/ci_crawl_log.txt'
         cfg['allow_orphan_canvases'] = False
+        cfg['blue_green'] = False
+        cfg['defer_thumbnails'] = False
+        cfg['pipeline_workers'] = 0
+        cfg['pipeline_executor'] = 'thread'
+        cfg['crawler_profile_sql'] = False
         cfg['server_url'] = 'http://localhost:5005'
         cfg['api_path'] = 'api'
         cfg['bot_urls'] = []
+        cfg['cache_max_age'] = 0
+        cfg['search_engine'] = 'db'
+        cfg['sqlite_read_only_api'] = False
+        cfg['timing'] = False
+        cfg['api_profile_sql'] = False
         cfg['facet_label_sort_top'] = []
         cfg['facet_label_sort_bottom'] = []
         cfg['facet_label_hide'] = []
@@ -105,6 +193,33 @@ class Cfg():
         if 'shared' in cp.sections():
             if cp['shared'].get('db_uri'):
                 cfg['db_uri'] = cp['shared'].get('db_uri')
+            if cp['shared'].get('generation_file'):
+                cfg['generation_file'] = cp['shared'].get('generation_file')
+            if cp['shared'].get('snapshot_file'):
+                cfg['snapshot_file'] = cp['shared'].get('snapshot_file')
+            if cp['shared'].get('doc_codec'):
+                doc_codec = cp['shared'].get('doc_codec')
+                if doc_codec in CODECS:
+                    cfg['doc_codec'] = doc_codec
+                else:
+                    fails.append(('doc_codec in shared section must be one of '
+                                  '{}').format(', '.join(sorted(CODECS))))
+            if cp['shared'].get('sqlite_journal_mode'):
+                journal_mode = cp['shared'].get('sqlite_journal_mode').lower()
+                if journal_mode in ['delete', 'truncate', 'persist', 'wal']:
+                    cfg['sqlite_journal_mode'] = journal_mode
+                else:
+                    fails.append(('sqlite_journal_mode in shared section must '
+                                  'be one of delete, truncate, persist, wal'))
+            for key in ['sqlite_busy_timeout', 'sqlite_cache_size',
+                        'sqlite_mmap_size', 'slow_query_ms']:
+                if cp['shared'].get(key):
+                    try:
+                        str_val = cp['shared'].get(key)
+                        cfg[key] = int(str_val)
+                    except ValueError:
+                        fails.append(('{} in shared section must be an integer'
+                                      ).format(key))
         if 'crawler' in cp.sections():
             if cp['crawler'].get('as_sources'):
                 as_sources = cp['crawler'].get('as_sources')
@@ -123,6 +238,34 @@ class Cfg():
             if cp['crawler'].get('allow_orphan_canvases'):
                 cfg['allow_orphan_canvases'] = cp['crawler'].getboolean(
                                                     'allow_orphan_canvases')
+            if cp['crawler'].get('blue_green'):
+                cfg['blue_green'] = cp['crawler'].getboolean('blue_green')
+                db_uri = cfg['db_uri']
+                if cfg['blue_green'] and \
+                        (not db_uri.startswith('sqlite:///') or
+                         len(db_uri) == len('sqlite:///')):
+                    fails.append(('blue_green in crawler section requires a '
+                                  'SQLite DB file as db_uri'))
+            if cp['crawler'].get('defer_thumbnails'):
+                cfg['defer_thumbnails'] = cp['crawler'].getboolean(
+                                                        'defer_thumbnails')
+            if cp['crawler'].get('pipeline_workers'):
+                try:
+                    str_val = cp['crawler'].get('pipeline_workers')
+                    cfg['pipeline_workers'] = int(str_val)
+                except ValueError:
+                    fails.append(('pipeline_workers in crawler section must be'
+                                  ' an integer'))
+            if cp['crawler'].get('pipeline_executor'):
+                executor = cp['crawler'].get('pipeline_executor')
+                if executor in ['thread', 'process']:
+                    cfg['pipeline_executor'] = executor
+                else:
+                    fails.append(('pipeline_executor in crawler section must '
+                                  'be one of thread, process'))
+            if cp['crawler'].get('profile_sql'):
+                cfg['crawler_profile_sql'] = cp['crawler'].getboolean(
+                                                                'profile_sql')
         # Sorting of API responses
         if 'api' in cp.sections():
             if cp['api'].get('server_url'):
@@ -132,6 +275,27 @@ class Cfg():
             if cp['api'].get('bot_urls'):
                 val = cp['api'].get('bot_urls')
                 cfg['bot_urls'] = [u.strip() for u in val.split(',') if len(u) > 0]
+            if cp['api'].get('cache_max_age'):
+                try:
+                    str_val = cp['api'].get('cache_max_age')
+                    cfg['cache_max_age'] = int(str_val)
+                except ValueError:
+                    fails.append(('cache_max_age in api section must be an int'
+                                  'eger'))
+            if cp['api'].get('search_engine'):
+                search_engine = cp['api'].get('search_engine')
+                if search_engine in ['db', 'memory', 'snapshot']:
+                    cfg['search_engine'] = search_engine
+                else:
+                    fails.append(('search_engine in api section must be one of'
+                                  ' db, memory, snapshot'))
+            if cp['api'].get('sqlite_read_only'):
+                cfg['sqlite_read_only_api'] = cp['api'].getboolean(
+                                                            'sqlite_read_only')
+            if cp['api'].get('timing'):
+                cfg['timing'] = cp['api'].getboolean('timing')
+            if cp['api'].get('profile_sql'):
+                cfg['api_profile_sql'] = cp['api'].getboolean('profile_sql')
             sort_options = ['facet_label_sort_top',
                             'facet_label_sort_bottom',
                             'facet_label_sort_bottom',
@@ -165,3 +329,14 @@ class Cfg():
             fail = False
 
         return fail, cfg
+
+
+def get_cfg(path='config.ini'):
+    """ Return the config read from path. Each config file is only parsed
+        once per process.
+    """
+
+    key = os.path.abspath(path)
+    if key not in _cfgs:
+        _cfgs[key] = Cfg(path)
+    return _cfgs[key]
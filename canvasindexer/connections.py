@@ -0,0 +1,133 @@
+""" Setup of DB connections.
+
+    For SQLite, connections are configured with the PRAGMAs set in the config
+    (journal mode, busy timeout, cache and mmap size). In WAL mode readers
+    and the writer don't block each other, so searches can run while a
+    crawl commits.
+
+    Optionally, requests to read only views (see read_only) get their
+    connections from a separate engine whose connections refuse to write
+    (PRAGMA query_only).
+
+    After a blue-green build (see canvasindexer.builds) requests are routed
+    to the DB recorded in the generation file (see route_request).
+"""
+
+import threading
+from functools import wraps
+from flask import current_app, g, has_app_context
+from sqlalchemy import create_engine, event
+from canvasindexer.builds import active_db_uri
+from canvasindexer.generation import read_generation
+from canvasindexer.models import db
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def is_sqlite(db_uri):
+    return db_uri.startswith('sqlite:')
+
+
+def sqlite_pragmas(cfg, read_only=False):
+    """ Return the PRAGMA statements to run on new SQLite connections.
+    """
+
+    pragmas = []
+    if cfg.sqlite_journal_mode():
+        pragmas.append('PRAGMA journal_mode = {}'.format(
+                                                    cfg.sqlite_journal_mode()))
+    pragmas.append('PRAGMA busy_timeout = {}'.format(cfg.sqlite_busy_timeout()))
+    if cfg.sqlite_cache_size() > 0:
+        # negative values are interpreted as KiB instead of pages
+        pragmas.append('PRAGMA cache_size = -{}'.format(
+                                                    cfg.sqlite_cache_size()))
+    if cfg.sqlite_mmap_size() > 0:
+        pragmas.append('PRAGMA mmap_size = {}'.format(
+                                        cfg.sqlite_mmap_size() * 1024 * 1024))
+    if read_only:
+        pragmas.append('PRAGMA query_only = ON')
+    return pragmas
+
+
+def set_pragmas(engine, pragmas):
+    """ Run the given PRAGMA statements on every new connection of engine.
+    """
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    event.listen(engine, 'connect', on_connect)
+
+
+def setup_engine(app, cfg):
+    """ Configure the DB connections of app (needs to be called after
+        db.init_app(app) and before the first DB access).
+    """
+
+    if is_sqlite(cfg.db_uri()):
+        set_pragmas(db.get_engine(app), sqlite_pragmas(cfg))
+
+
+def get_engine(cfg, db_uri, read_only=False):
+    """ Return an engine for db_uri other than the one of the app. Engines for
+        DBs which are no longer in use are disposed of.
+    """
+
+    key = (db_uri, read_only)
+    engine = _engines.get(key)
+    if engine is not None:
+        return engine
+    with _engines_lock:
+        if key not in _engines:
+            engine = create_engine(db_uri)
+            if is_sqlite(db_uri):
+                set_pragmas(engine, sqlite_pragmas(cfg, read_only))
+            for old_key in [k for k in _engines if k[0] != db_uri]:
+                _engines.pop(old_key).dispose()
+            _engines[key] = engine
+    return _engines[key]
+
+
+def route_request():
+    """ Before request hook pinning the index generation and the DB to serve
+        it from for the rest of the request. Called again by requests which
+        have to write to the DB active at that point (see enhance).
+    """
+
+    cfg = current_app.cfg
+    g.generation = read_generation(cfg.generation_file())
+    g.db_uri = active_db_uri(cfg, g.generation)
+    if g.db_uri != current_app.config['SQLALCHEMY_DATABASE_URI']:
+        g.db_engine = get_engine(cfg, g.db_uri)
+    else:
+        g.db_engine = None
+
+
+def request_generation(cfg):
+    """ Return the index generation pinned for the current request (see
+        route_request) or else the current one.
+    """
+
+    if has_app_context() and 'generation' in g:
+        return g.generation
+    return read_generation(cfg.generation_file())
+
+
+def read_only(view):
+    """ Decorator for views that don't write to the DB. If configured, the DB
+        session uses a read only engine for the rest of the request.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cfg = current_app.cfg
+        if cfg.sqlite_read_only_api() and is_sqlite(cfg.db_uri()):
+            db_uri = g.get('db_uri') or active_db_uri(cfg)
+            g.db_engine = get_engine(cfg, db_uri, read_only=True)
+        return view(*args, **kwargs)
+
+    return wrapper
@@ -1,21 +1,26 @@
+""" Crawling of Activity Streams and indexing of the Curations they reference.
+
+    This module is imported by the API as well, so HTTP and date parsing
+    libraries only needed while crawling are imported where they are used.
+"""
+
+import copy
 import datetime
-import dateutil.parser
+import hashlib
 import json
 import re
-import requests
 import stat
 import os
 from collections import OrderedDict
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-from canvasindexer.models import (db, Term, Canvas, Curation, FacetList,
-                                  TermCanvasAssoc, TermCurationAssoc, CrawlLog,
-                                  CanvasParentMap)
+from canvasindexer.models import (db, Term, Canvas, Curation, CurationHit,
+                                  FacetList, TermCanvasAssoc,
+                                  TermCurationAssoc, CrawlLog, CanvasParentMap)
+from canvasindexer.crawler.doc_cache import CanvasDocCache
 from canvasindexer.crawler.enhancer import post_job
+from canvasindexer.api.snapshot import publish_index, snapshot_generation
+from canvasindexer.generation import read_generation
 from sqlalchemy import desc, not_
-from canvasindexer.config import Cfg
-
-cfg = Cfg()
+from canvasindexer.config import get_cfg
 
 
 def requests_retry_session(retries=5, backoff_factor=0.2,
@@ -31,6 +36,10 @@ def requests_retry_session(retries=5, backoff_factor=0.2,
         https://www.peterbe.com/plog/best-practice-with-retries-with-requests
     """
 
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
+
     session = session or requests.Session()
     retry = Retry(
         total=retries,
@@ -47,10 +56,12 @@ def requests_retry_session(retries=5, backoff_factor=0.2,
 
 def build_facet_list():
     """ From the current DB state, pre build the response for requests to the
-        /facets path.
+        /facets path. Terms with hidden labels are left out.
     """
 
-    terms = db.session.query(Term).filter(not_(Term.term == cfg.e_term()))
+    cfg = get_cfg()
+    terms = db.session.query(Term).filter(not_(Term.term == cfg.e_term()),
+                                          not_(Term.hidden))
     terms = terms.join(TermCanvasAssoc)
     terms = terms.filter(TermCanvasAssoc.metadata_type == 'canvas').all()
     facet_map = {}
@@ -60,42 +71,52 @@ def build_facet_list():
         if term.term not in facet_map[term.qualifier]:
             facet_map[term.qualifier].append(term.term)
 
-    # create
-    pre_facets = {}
+    # count
+    facet_counts = OrderedDict()
     for label, vals in facet_map.items():
         assocs = db.session.query(TermCanvasAssoc).join(Term)
         assocs = assocs.filter(TermCanvasAssoc.metadata_type == 'canvas',
                                TermCanvasAssoc.term_id == Term.id,
                                Term.qualifier == label).all()
+        value_counts = OrderedDict()
+        for val in vals:
+            value_counts[val] = [0, 0]
+        for a in assocs:
+            if a.term.term not in value_counts:
+                continue
+            if a.actor == 'machine':
+                value_counts[a.term.term][1] += 1
+            else:
+                value_counts[a.term.term][0] += 1
+        facet_counts[label] = value_counts
+
+    return sort_facets(facet_counts)
+
+
+def sort_facets(facet_counts):
+    """ Given value counts per label in the form
+
+            {'<a_label>': {'<a_value>': [<human count>, <machine count>],
+                           ...},
+             ...
+            }
+
+        build a facet list sorted as configured.
+
+        Currently the API part of Canvas Indexer works with the assumption
+        that unknown metadata is human generated. Since build_facet_list pre
+        generates a reply of the API, unknown is to be counted as human here
+        as well.
+    """
+
+    cfg = get_cfg()
+    pre_facets = {}
+    for label, value_counts in facet_counts.items():
         facet = OrderedDict()
         facet['label'] = label
         # create
         facet['value'] = []
-        for val in vals:
-            unkown_count = 0
-            human_count = 0
-            machine_count = 0
-            for a in assocs:
-                if a.term.term == val:
-                    if a.actor == 'human':
-                        human_count += 1
-                    elif a.actor == 'machine':
-                        machine_count += 1
-                    else:
-                        # unkown_count += 1
-                        human_count += 1
-                        # Currently the API part of Canvas Indexer works with
-                        # the assumption that unknown metadata is human
-                        # generated. Since build_facet_list pre generates a
-                        # reply of the API, unknown is treated as human here
-                        # as well
-        # agents are humans.
-            # unknwon actor
-            if unkown_count > 0:
-                entry = OrderedDict()
-                entry['label'] = val
-                entry['value'] = unkown_count
-                facet['value'].append(entry)
+        for val, (human_count, machine_count) in value_counts.items():
             # human actor
             if human_count > 0:
                 entry = OrderedDict()
@@ -146,6 +167,20 @@ def build_facet_list():
     return ret
 
 
+def store_facet_list():
+    """ Build the facet list and persist it in the form it is served in.
+    """
+
+    facet_list = build_facet_list()
+    log('persisting facet list')
+    db_entry = db.session.query(FacetList).first()
+    if not db_entry:
+        db_entry = FacetList()
+    db_entry.json_string = json.dumps(facet_list, indent=4)
+    db.session.add(db_entry)
+    db.session.commit()
+
+
 def custom_sort(dictionary, sort_top_labels, sort_bottom_labels):
     """ Given a dictionary in the form of
 
@@ -276,10 +311,75 @@ def thumbnail_url(img_uri, canvas_uri, width, height, compliance_lvl,
     return thumb_url
 
 
-def build_canvas_doc(man, cur_can):
+def get_info_json(info_url, require_ok=False):
+    """ Retrieve the info.json of an image. Return None if not possible.
+        Unless require_ok is set, a JSON body is used whatever the HTTP status
+        of the response.
+    """
+
+    try:
+        resp = requests_retry_session().get(info_url)
+        if require_ok:
+            resp.raise_for_status()
+        return resp.json()
+    except Exception as e:
+        log(('Could not get info.json at {}.'
+             ' Error {}.').format(
+            info_url,
+            e.__class__.__name__
+            )
+        )
+        return None
+
+
+def image_url(info_dict):
+    """ Given the info.json of an image, create the URL of the full image.
+    """
+
+    quality = None
+    quality_options = info_dict.get('qualities', [])
+    if 'default' in quality_options:
+        quality = 'default'
+    elif 'native' in quality_options:
+        quality = 'native'
+    elif len(quality_options) > 0 and \
+         type(quality_options[0]) == str:
+        quality = quality_options[0]
+    else:
+        quality = 'default'
+    formad = None
+    formad_options = info_dict.get('formats', [])
+    if 'jpg' in formad_options:
+        formad = 'jpg'
+    elif len(formad_options) > 0 and \
+         type(formad_options[0]) == str:
+        formad = formad_options[0]
+    else:
+        formad = 'jpg'
+    return '{}/full/full/0/{}.{}'.format(info_dict.get('@id'),
+                                         quality,
+                                         formad)
+
+
+def provisional_thumbnail(info_url, canvas_uri, man_can):
+    """ Create the URL of a thumbnail without retrieving the image's
+        info.json, assuming its @id is the info.json's URL without
+        "/info.json" and default settings (see image_url).
+    """
+
+    url_base = info_url[:-len('/info.json')]
+    img_url = '{}/full/full/0/default.jpg'.format(url_base)
+    return thumbnail_url(img_url, canvas_uri, 200, 200, -1, man_can)
+
+
+def build_canvas_doc(man, cur_can, defer_thumbnail=False):
     """ Given a manifest and canvas cutout dictionary, build a document
         (OrderedDict) with all information necessary to display the cutout as
         a search result.
+
+        If defer_thumbnail is set, the image's info.json is not retrieved and
+        the document gets a provisional thumbnail (see
+        canvasindexer.crawler.enrichment).
     """
 
     doc = OrderedDict()
@@ -311,41 +411,6 @@ def build_canvas_doc(man, cur_can):
                 #       then [0:-4] cuts off /{size}/...{format}
                 info_url = '{}/info.json'.format(url_base)
                 doc['canvas'] = info_url
-                try:
-                    resp = requests_retry_session().get(info_url)
-                    info_dict = resp.json()
-                except Exception as e:
-                    log(('Could not get info.json at {}.'
-                         ' Error {}.').format(
-                        info_url,
-                        e.__class__.__name__
-                        )
-                    )
-                    info_dict =  {}
-                profile = info_dict.get('profile')
-                quality = None
-                quality_options = info_dict.get('qualities', [])
-                if 'default' in quality_options:
-                    quality = 'default'
-                elif 'native' in quality_options:
-                    quality = 'native'
-                elif len(quality_options) > 0 and \
-                     type(quality_options[0]) == str:
-                    quality = quality_options[0]
-                else:
-                    quality = 'default'
-                formad = None
-                formad_options = info_dict.get('formats', [])
-                if 'jpg' in formad_options:
-                    formad = 'jpg'
-                elif len(formad_options) > 0 and \
-                     type(formad_options[0]) == str:
-                    formad = formad_options[0]
-                else:
-                    formad = 'jpg'
-                img_url = '{}/full/full/0/{}.{}'.format(info_dict.get('@id'),
-                                                        quality,
-                                                        formad)
 
                 # > canvasId
                 doc['canvasId'] = man_can['@id']
@@ -354,10 +419,17 @@ def build_canvas_doc(man, cur_can):
                 # > canvasLabel
                 doc['canvasLabel'] = man_can.get('label')
                 # > canvasThumbnail
-                comp_lvl = get_img_compliance_level(profile)
-                doc['canvasThumbnail'] = thumbnail_url(img_url, cur_can['@id'],
-                                                       200, 200, comp_lvl,
-                                                       man_can)
+                if defer_thumbnail:
+                    doc['canvasThumbnail'] = provisional_thumbnail(
+                                            info_url, cur_can['@id'], man_can)
+                else:
+                    info_dict = get_info_json(info_url) or {}
+                    comp_lvl = get_img_compliance_level(
+                                                    info_dict.get('profile'))
+                    doc['canvasThumbnail'] = thumbnail_url(
+                                            image_url(info_dict),
+                                            cur_can['@id'], 200, 200,
+                                            comp_lvl, man_can)
                 # > canvasIndex
                 doc['canvasIndex'] = canvas_index
                 # > fragment
@@ -377,23 +449,53 @@ def build_canvas_doc(man, cur_can):
     return doc
 
 
-def build_curation_doc(cur, activity, canvas_doc=None, cur_can_idx=None):
-    """ Build a document (OrderedDict) with all information necessary to
-        display a search result for a Curation.
+def get_curation(activity, fetched=None):
+    """ Return the Curation an Activity is about. If the activity was
+        prepared by the pipeline (see canvasindexer.crawler.pipeline), the
+        Curation retrieved there is used.
+    """
 
-        If canvas_doc is given, this is assumed to be a sarch result associated
-        with Canvas metadata. Otherwise (search result associated with Curation
-        top level metadata) the method enhance_top_meta_curation_doc is to be
-        used to retroactively add missing information.
+    if fetched is not None and fetched.curation is not None:
+        return fetched.curation
+    return get_referenced(activity, 'object')
+
+
+def get_content_hash(cur, fetched=None):
+    """ Return the content hash of a Curation (see content_hash), computed
+        ahead if possible (see get_curation).
+    """
+
+    if fetched is not None and fetched.content_hash is not None:
+        return fetched.content_hash
+    return content_hash(cur)
+
+
+def get_range_manifest(ran, fetched=None):
+    """ Return the Manifest a range of a Curation is within, retrieved ahead
+        if possible (see get_curation).
+    """
+
+    if fetched is not None:
+        man = fetched.manifests.get(get_attrib_uri(ran, 'within'))
+        if man is not None:
+            return man
+    return get_referenced(ran, 'within')
+
+
+def build_curation_doc(cur, activity):
+    """ Build a document (OrderedDict) with the information necessary to
+        display a search result for a Curation that does not depend on the
+        matched term. The term dependent parts (thumbnail, canvas hit) are
+        stored as CurationHit records (see build_curation_hit).
+
+        The thumbnail is added retroactively using the method
+        enhance_top_meta_curation_doc once the first Canvas is indexed.
     """
 
     doc = OrderedDict()
     doc['curationUrl'] = cur['@id']
     doc['curationLabel'] = cur['label']
-    if canvas_doc:
-        doc['curationThumbnail'] = canvas_doc['canvasThumbnail']
-    else:
-        doc['curationThumbnail'] = None
+    doc['curationThumbnail'] = None
     num_canvases = 0
     for ran in cur.get('selections', []):
         num_canvases += len(ran.get('members', []))
@@ -403,21 +505,39 @@ def build_curation_doc(cur, activity, canvas_doc=None, cur_can_idx=None):
         doc['crawledAt'] = activity['endTime']
     else:
         doc['crawledAt'] = datetime.datetime.utcnow().isoformat()
-    # - - -
-    if canvas_doc:
-        canvas_hit = OrderedDict()
-        canvas_hit['canvasId'] = canvas_doc['canvasId']
-        canvas_hit['fragment'] = canvas_doc['fragment']
-        canvas_hit['curationCanvasIndex'] = cur_can_idx + 1
-        doc['curationHit'] = None
-        doc['canvasHit'] = canvas_hit
-    else:
-        doc['curationHit'] = True
-        doc['canvasHit'] = None
 
     return doc
 
 
+def content_hash(cur):
+    """ Return a hash of a Curation's JSON that does not depend on key order
+        or formatting.
+    """
+
+    normalized = json.dumps(cur, sort_keys=True, separators=(',', ':'),
+                            ensure_ascii=False)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def build_curation_hit(cur_db_id, canvas_doc=None, cur_can_idx=None):
+    """ Build a CurationHit record.
+
+        If canvas_doc is given, this is assumed to be a search result
+        associated with Canvas metadata. Otherwise it is a search result
+        associated with Curation top level metadata, which is displayed using
+        the Curation's thumbnail.
+    """
+
+    if canvas_doc:
+        return CurationHit(curation_id=cur_db_id,
+                           hit_type='canvas',
+                           canvas_id=canvas_doc['canvasId'],
+                           fragment=canvas_doc['fragment'],
+                           canvas_index=cur_can_idx + 1,
+                           thumbnail=canvas_doc['canvasThumbnail'])
+    return CurationHit(curation_id=cur_db_id, hit_type='curation')
+
+
 def enhance_top_meta_curation_doc(cur_doc, canvas_doc):
     """ Retroactively add missing information to a Curation search result
         associated with Curation top level metadata.
@@ -482,6 +602,7 @@ def merge_iiif_doc_metadata(old_doc, new_doc):
         `value` keys as recommended in iiif.io/api/presentation/2.1/#metadata.
     """
 
+    cfg = get_cfg()
     old_meta = old_doc.get('metadata', [])
     if type(old_meta) != list:
         old_meta = []
@@ -490,7 +611,7 @@ def merge_iiif_doc_metadata(old_doc, new_doc):
         new_meta = []
     # clean
     result_meta = []
-    seen = []
+    seen = set()
     for meta in old_meta + new_meta:
         if type(meta) != dict:
             continue
@@ -498,9 +619,15 @@ def merge_iiif_doc_metadata(old_doc, new_doc):
         value = meta.get('value')
         if not label or not value:
             continue
-        if (label, value) not in seen:
+        key = (label, value)
+        try:
+            hash(key)
+        except TypeError:
+            # e.g. values given in several languages (list of dicts)
+            key = json.dumps(key, sort_keys=True)
+        if key not in seen:
             result_meta.append(meta)
-            seen.append((label, value))
+            seen.add(key)
     # sort
     sort_top_labels = cfg.facet_label_sort_top()
     sort_bottom_labels = cfg.facet_label_sort_bottom()
@@ -526,6 +653,7 @@ def log(msg):
     """ Write a log message.
     """
 
+    cfg = get_cfg()
     timestamp = str(datetime.datetime.now()).split('.')[0]
     fn = cfg.crawler_log_file()
     # make /dev/stdout usable as log file
@@ -544,82 +672,76 @@ def log(msg):
 
 def index_canvases_in_cur_selection(lo,
                                     cp_map,
-                                    activity,
-                                    cur,
                                     man,
                                     canvases,
-                                    found_top_metadata,
-                                    top_cur_db,
-                                    top_doc_has_thumbnail,
-                                    top_cur_doc,
-                                    top_term,
-                                    top_term_db_id,
-                                    top_actor):
+                                    cur_db,
+                                    cur_doc,
+                                    docs=None):
     """ Iterate over a list of Canvases in one of the ranges of a Curation, and
-        write the resulting index entries into the DB.
+        write the resulting index entries into the DB. Canvas documents that
+        were already built can be given as docs ({<index>: <document>}).
     """
 
+    cfg = get_cfg()
     new_canvases = 0
+    cur_uri = cur_doc['curationUrl']
     for cur_can_idx, cur_can_dict in enumerate(canvases):
         log('canvas #{}'.format(cur_can_idx))
         # TODO: mby get read and include man[_can] metadata
-        can_doc = build_canvas_doc(man, cur_can_dict)
+        if docs and cur_can_idx in docs:
+            can_doc = docs.pop(cur_can_idx)
+        else:
+            can_doc = build_canvas_doc(man, cur_can_dict,
+                                       cfg.defer_thumbnails())
         # ↓ canvas URIs w/o fragment end with a "#"
         can_uri = '{}#{}'.format(can_doc['canvasId'], can_doc['fragment'])
-        can_cur_doc = build_curation_doc(cur, activity, can_doc,
-                                     cur_can_idx)
         # Canvas parent map
         # # upward
         if can_uri not in cp_map['upward']:
             cp_map['upward'][can_uri] = []
-        if can_cur_doc['curationUrl'] not in cp_map['upward'][can_uri]:
-            cp_map['upward'][can_uri].append(can_cur_doc['curationUrl'])
+        if cur_uri not in cp_map['upward'][can_uri]:
+            cp_map['upward'][can_uri].append(cur_uri)
         # # downward
-        if can_cur_doc['curationUrl'] not in cp_map['downward']:
-            cp_map['downward'][can_cur_doc['curationUrl']] = []
-        if can_uri not in cp_map['downward'][can_cur_doc['curationUrl']]:
-            cp_map['downward'][can_cur_doc['curationUrl']].append(can_uri)
+        if cur_uri not in cp_map['downward']:
+            cp_map['downward'][cur_uri] = []
+        if can_uri not in cp_map['downward'][cur_uri]:
+            cp_map['downward'][cur_uri].append(can_uri)
         # canvas
         if can_uri not in lo['canvas_uri_dict']:
             log('creating new canvas {}'.format(can_uri))
             new_canvases += 1
-            can_db = Canvas(canvas_uri=can_uri,
-                         json_string=json.dumps(can_doc))
-            db.session.add(can_db)
-            db.session.flush()
-            lo['canvas_uri_dict'][can_uri] = can_db.id
-            can_db_id = can_db.id
+            can_db_id = lo['canvas_docs'].create(can_uri, can_doc,
+                                                 cfg.defer_thumbnails())
+            lo['canvas_uri_dict'][can_uri] = can_db_id
         else:
             log('using exiting canvas {}'.format(can_uri))
             can_db_id = lo['canvas_uri_dict'][can_uri]
-            can_db = db.session.query(Canvas).filter(
-                            Canvas.canvas_uri == can_uri).first()
-            old_can_dict = json.loads(can_db.json_string)
+            old_can_dict = lo['canvas_docs'].get(can_db_id)
+            if cfg.defer_thumbnails():
+                # might not be provisional anymore
+                can_doc['canvasThumbnail'] = old_can_dict.get(
+                                                            'canvasThumbnail')
+            old_meta = old_can_dict.get('metadata')
             merged_doc = merge_iiif_doc_metadata(old_can_dict, cur_can_dict)
-            can_db.json_string = json.dumps(merged_doc)
-            db.session.add(can_db)
-            db.session.flush()
+            if merged_doc['metadata'] != old_meta:
+                lo['canvas_docs'].put(can_db_id, merged_doc)
         # still curation metadata
-        if found_top_metadata and top_cur_db and \
-                not top_doc_has_thumbnail:
+        if cur_doc['curationThumbnail'] is None:
             # enhance (cur metadata-) cur
             log(('enhancing curation {} search result (thumbnail, etc.)'
-                ).format(top_cur_db.curation_uri))
-            enhance_top_meta_curation_doc(top_cur_doc, can_doc)
-            top_cur_db.json_string = json.dumps(top_cur_doc)
-            top_doc_has_thumbnail = True
-            # can assoc
-            tcaa_key = (lo['term_tup_dict'][top_term],
-                        lo['canvas_uri_dict'][can_uri])
-            if tcaa_key not in lo['term_can_assoc_list']:
-                log('associating top term {} with  canvas {}'.format(top_term,
-                                                                     can_uri))
-                lo['term_can_assoc_list'].append(tcaa_key)
-                assoc = TermCanvasAssoc(term_id=top_term_db_id,
-                                        canvas_id=can_db_id,
-                                        metadata_type='curation',
-                                        actor=top_actor)
-                db.session.add(assoc)
+                ).format(cur_uri))
+            enhance_top_meta_curation_doc(cur_doc, can_doc)
+            cur_db.set_doc(cur_doc, cfg.doc_codec())
+        # canvas hit
+        hit_key = (cur_uri, 'canvas', can_uri, cur_can_idx)
+        if hit_key not in lo['hit_key_dict']:
+            log('creating new canvas hit {} for curation {}'.format(can_uri,
+                                                                   cur_uri))
+            hit_db = build_curation_hit(cur_db.id, can_doc, cur_can_idx)
+            db.session.add(hit_db)
+            db.session.flush()
+            lo['hit_key_dict'][hit_key] = hit_db.id
+        can_hit_id = lo['hit_key_dict'][hit_key]
 
         # canvas metadata
         log('going through canvas level metadata')
@@ -632,7 +754,8 @@ def index_canvases_in_cur_selection(lo,
             if can_term not in lo['term_tup_dict']:
                 log('creating new term {}'.format(can_term))
                 term = Term(term=can_term[1],
-                            qualifier=can_term[0])
+                            qualifier=can_term[0],
+                            hidden=can_term[0] in cfg.facet_label_hide())
                 db.session.add(term)
                 db.session.flush()
                 lo['term_tup_dict'][can_term] = term.id
@@ -653,31 +776,22 @@ def index_canvases_in_cur_selection(lo,
                                         actor=can_actor)
                 db.session.add(assoc)
                 lo['term_can_assoc_list'].append(tcaa_key)
-            # cur
-            can_cur_uri = '{}{}{}'.format(can_cur_doc['curationUrl'],
-                                          can_term[1],
-                                          'canvas')
-            if can_cur_uri not in lo['curation_uri_dict']:
-                log('creating new canvas hit curation {}'.format(can_cur_uri))
-                can_cur_db = Curation(curation_uri=can_cur_uri,
-                                      json_string=json.dumps(can_cur_doc))
-                db.session.add(can_cur_db)
-                db.session.flush()
-                lo['curation_uri_dict'][can_cur_uri] = can_cur_db.id
-                can_cur_id = can_cur_db.id
+            # cur hit
+            # (a term is represented by the first canvas it appears on)
+            term_hit_key = (cur_uri, can_term[1], 'canvas')
+            if term_hit_key not in lo['term_hit_dict']:
+                log(('using canvas hit {} for {}').format(can_uri, can_term))
+                lo['term_hit_dict'][term_hit_key] = can_hit_id
             else:
-                log(('using existing canvas hit curation {}'
-                    ).format(can_cur_uri))
-                can_cur_id = lo['curation_uri_dict'][can_cur_uri]
+                log(('using existing canvas hit for {}').format(can_term))
+            term_hit_id = lo['term_hit_dict'][term_hit_key]
             # cur assoc
-            tcua_key = (lo['term_tup_dict'][can_term],
-                        lo['curation_uri_dict'][can_cur_uri])
-            can_actor = get_metadata_actor(can_md)
+            tcua_key = (lo['term_tup_dict'][can_term], term_hit_id)
             if tcua_key not in lo['term_cur_assoc_list']:
-                log(('creating new association between {} and {}'
-                    ).format(can_term, can_cur_uri))
+                log(('creating new association between {} and canvas hit in {}'
+                    ).format(can_term, cur_uri))
                 assoc = TermCurationAssoc(term_id=can_term_id,
-                                          curation_id=can_cur_id,
+                                          curation_hit_id=term_hit_id,
                                           metadata_type='curation',
                                           actor=can_actor)
                 db.session.add(assoc)
@@ -685,15 +799,42 @@ def index_canvases_in_cur_selection(lo,
     return new_canvases
 
 
-def process_curation_create(lo, cp_map, activity):
+def process_curation_create(lo, cp_map, activity, fetched=None):
     """ Process a create activity that has a cr:Curation as its object.
+        What was retrieved and built ahead for the activity can be given as
+        fetched (see canvasindexer.crawler.pipeline).
     """
 
+    cfg = get_cfg()
     new_canvases = 0
     log('retrieving curation {}'.format(activity['object']['@id']))
-    cur_dict = get_referenced(activity, 'object')
-    top_cur_doc = build_curation_doc(cur_dict, activity)
-    found_top_metadata = False
+    cur_dict = get_curation(activity, fetched)
+    cur_doc = build_curation_doc(cur_dict, activity)
+    cur_uri = cur_doc['curationUrl']
+    # cur
+    if cur_uri not in lo['curation_uri_dict']:
+        # new
+        log('creating curation {}'.format(cur_uri))
+        cur_db = Curation(curation_uri=cur_uri)
+        cur_db.set_doc(cur_doc, cfg.doc_codec())
+        db.session.add(cur_db)
+        db.session.flush()
+        lo['curation_uri_dict'][cur_uri] = cur_db.id
+    else:
+        # existing
+        log('using existing curation {}'.format(cur_uri))
+        cur_db = db.session.query(Curation).get(
+                                        lo['curation_uri_dict'][cur_uri])
+        cur_doc = cur_db.get_doc(object_pairs_hook=OrderedDict)
+    # cur hit for top level metadata
+    hit_key = (cur_uri, 'curation')
+    if hit_key not in lo['hit_key_dict']:
+        log('creating curation hit for {}'.format(cur_uri))
+        hit_db = build_curation_hit(cur_db.id)
+        db.session.add(hit_db)
+        db.session.flush()
+        lo['hit_key_dict'][hit_key] = hit_db.id
+    top_hit_id = lo['hit_key_dict'][hit_key]
     log('going through top level metadata')
     # curation metadata
     for cur_md in cur_dict.get('metadata', []) + [cfg.e_term()]:
@@ -704,7 +845,8 @@ def process_curation_create(lo, cp_map, activity):
         # term
         if top_term not in lo['term_tup_dict']:
             log('creating term {}'.format(top_term))
-            term = Term(term=top_term[1], qualifier=top_term[0])
+            term = Term(term=top_term[1], qualifier=top_term[0],
+                        hidden=top_term[0] in cfg.facet_label_hide())
             db.session.add(term)
             db.session.flush()
             lo['term_tup_dict'][top_term] = term.id
@@ -712,84 +854,348 @@ def process_curation_create(lo, cp_map, activity):
         else:
             log('using existing term {}'.format(top_term))
             top_term_db_id = lo['term_tup_dict'][top_term]
-        # cur
-        top_cur_uri = top_cur_doc['curationUrl']+top_term[1]+'curation'
-        if top_cur_uri not in lo['curation_uri_dict']:
-            # new
-            log('creating curation {}'.format(top_cur_uri))
-            top_cur_db = Curation(curation_uri=top_cur_uri,
-                                  json_string=json.dumps(top_cur_doc))
-            db.session.add(top_cur_db)
-            db.session.flush()
-            lo['curation_uri_dict'][top_cur_uri] = top_cur_db.id
-            top_cur_db_id = top_cur_db.id
-        else:
-            # existing
-            log('using existing curation {}'.format(top_cur_uri))
-            top_cur_db_id = lo['curation_uri_dict'][top_cur_uri]
-            top_cur_db = None
         # cur assoc
-        tcua_key = (lo['term_tup_dict'][top_term],
-                    lo['curation_uri_dict'][top_cur_uri])
+        lo['term_hit_dict'][(cur_uri, top_term[1], 'curation')] = top_hit_id
+        tcua_key = (lo['term_tup_dict'][top_term], top_hit_id)
         top_actor = get_metadata_actor(cur_md)
         if tcua_key not in lo['term_cur_assoc_list']:
-            log(('creating new association between {} and {}'
-                ).format(top_term, top_cur_uri))
+            log(('creating new association between {} and curation hit in {}'
+                ).format(top_term, cur_uri))
             assoc = TermCurationAssoc(term_id=top_term_db_id,
-                                      curation_id=top_cur_db_id,
+                                      curation_hit_id=top_hit_id,
                                       metadata_type='curation',
                                       actor=top_actor)
             db.session.add(assoc)
             db.session.flush()
             lo['term_cur_assoc_list'].append(tcua_key)
-        found_top_metadata = True
 
-    top_doc_has_thumbnail = False
     log('entering ranges')
-    for ran in cur_dict.get('selections', []):
+    complete = True
+    for ran_idx, ran in enumerate(cur_dict.get('selections', [])):
         # Manifest is the same for all Canvases ahead, so get it now
-        man = get_referenced(ran, 'within')
+        man = get_range_manifest(ran, fetched)
         if man == '{}':
             # if the manifest can not be accessed, skip this range
+            complete = False
             continue
         todo = len(ran.get('members', []) + ran.get('canvases', []))
         log('processing {} canvases'.format(todo))
 
         canvases = ran.get('members', []) + ran.get('canvases', [])
+        docs = fetched.canvas_docs.get(ran_idx) if fetched else None
         new_canvases += index_canvases_in_cur_selection(lo,
-                                                cp_map,
-                                                activity,
-                                                cur_dict,
-                                                man,
-                                                canvases,
-                                                found_top_metadata,
-                                                top_cur_db,
-                                                top_doc_has_thumbnail,
-                                                top_cur_doc,
-                                                top_term,
-                                                top_term_db_id,
-                                                top_actor)
+                                                        cp_map,
+                                                        man,
+                                                        canvases,
+                                                        cur_db,
+                                                        cur_doc,
+                                                        docs)
         log('done')
+    # only remember the content if it was indexed in full, so that skipped
+    # ranges are tried again on the next Update
+    cur_db.content_hash = get_content_hash(cur_dict, fetched) if complete \
+        else None
+    db.session.add(cur_db)
     return new_canvases
 
 
-def process_curation_delete(cp_map, activity):
+def canvas_uri(cur_can):
+    """ Return the URI under which a Canvas (cutout) in a Curation is indexed
+        (see build_canvas_doc) without retrieving its Manifest.
+    """
+
+    url_parts = cur_can['@id'].split('#')
+    if len(url_parts) == 2:
+        return '{}#{}'.format(url_parts[0], url_parts[1])
+    return '{}#'.format(url_parts[0])
+
+
+def curation_hit_key(hit, cur_uri):
+    """ Return the key of a CurationHit record in lo['hit_key_dict'].
+    """
+
+    if hit.hit_type == 'canvas':
+        can_uri = '{}#{}'.format(hit.canvas_id, hit.fragment)
+        return (cur_uri, 'canvas', can_uri, hit.canvas_index - 1)
+    return (cur_uri, 'curation')
+
+
+def get_term_id(lo, term):
+    """ Return the DB ID of a (<qualifier>, <term>) tuple, creating the term
+        if it is new.
+    """
+
+    if term not in lo['term_tup_dict']:
+        log('creating new term {}'.format(term))
+        term_db = Term(term=term[1], qualifier=term[0],
+                       hidden=term[0] in get_cfg().facet_label_hide())
+        db.session.add(term_db)
+        db.session.flush()
+        lo['term_tup_dict'][term] = term_db.id
+    return lo['term_tup_dict'][term]
+
+
+def process_curation_update(lo, cp_map, activity, fetched=None):
+    """ Process an update activity that has a cr:Curation as its object.
+
+        Instead of deleting the Curation and creating it again, the Curation
+        is compared with what is indexed and only the differences are written
+        (with the same result, except that records keep their IDs and the
+        Curation keeps its place among the parents of its Canvases). Manifests
+        and info.json documents are only retrieved for ranges with Canvases
+        that are not indexed yet.
+
+        If the Curation's content is the same as when it was last indexed (see
+        content_hash), nothing is changed and None is returned. Otherwise the
+        number of new Canvases is returned.
+
+        For fetched see process_curation_create.
+    """
+
+    cfg = get_cfg()
+    cur_uri = get_attrib_uri(activity, 'object')
+    if cur_uri not in lo['curation_uri_dict']:
+        log('curation {} is not indexed yet'.format(cur_uri))
+        return process_curation_create(lo, cp_map, activity, fetched)
+    log('retrieving curation {}'.format(cur_uri))
+    cur_dict = get_curation(activity, fetched)
+    cur_db = db.session.query(Curation).get(lo['curation_uri_dict'][cur_uri])
+    cur_hash = get_content_hash(cur_dict, fetched)
+    if cur_db.content_hash == cur_hash:
+        log('curation {} is unchanged. skipping'.format(cur_uri))
+        return None
+    cur_doc = build_curation_doc(cur_dict, activity)
+
+    # determine what is to be indexed, in the order process_curation_create
+    # would index it
+    top_key = (cur_uri, 'curation')
+    # (<term tuple>, <hit key>) → actor
+    wanted_cur_assocs = OrderedDict()
+    for cur_md in cur_dict.get('metadata', []) + [cfg.e_term()]:
+        top_term = build_qualifier_tuple(cur_md)
+        if top_term[1]:
+            wanted_cur_assocs.setdefault((top_term, top_key),
+                                         get_metadata_actor(cur_md))
+    wanted_hits = OrderedDict()  # hit key → (Canvas document, index)
+    canvases = OrderedDict()     # Canvas URI → [Canvas dict, ...]
+    can_docs = {}                # Canvas URI → indexed or new document
+    can_terms = {}               # Canvas URI → {<term tuple>: actor}
+    term_hits = {}               # term → hit key of first Canvas with it
+    complete = True
+    for ran_idx, ran in enumerate(cur_dict.get('selections', [])):
+        cur_cans = ran.get('members', []) + ran.get('canvases', [])
+        can_uris = [canvas_uri(cur_can) for cur_can in cur_cans]
+        docs = fetched.canvas_docs.get(ran_idx, {}) if fetched else {}
+        new_uris = [can_uri for can_uri in can_uris
+                    if can_uri not in lo['canvas_uri_dict'] and
+                    can_uri not in can_docs]
+        if new_uris:
+            log('retrieving manifest for {} new canvases'.format(
+                                                            len(new_uris)))
+            man = get_range_manifest(ran, fetched)
+            if man == '{}':
+                # if the manifest can not be accessed, skip this range
+                complete = False
+                continue
+        for cur_can_idx, (cur_can, can_uri) in enumerate(zip(cur_cans,
+                                                             can_uris)):
+            if can_uri not in can_docs:
+                if can_uri in lo['canvas_uri_dict']:
+                    # ↓ copy to be able to tell if it changed
+                    can_docs[can_uri] = copy.copy(lo['canvas_docs'].get(
+                                            lo['canvas_uri_dict'][can_uri]))
+                elif cur_can_idx in docs:
+                    can_docs[can_uri] = docs.pop(cur_can_idx)
+                else:
+                    can_docs[can_uri] = build_canvas_doc(
+                                        man, cur_can, cfg.defer_thumbnails())
+            can_doc = can_docs[can_uri]
+            canvases.setdefault(can_uri, []).append(cur_can)
+            if cur_doc['curationThumbnail'] is None:
+                enhance_top_meta_curation_doc(cur_doc, can_doc)
+            hit_key = (cur_uri, 'canvas', can_uri, cur_can_idx)
+            wanted_hits.setdefault(hit_key, (can_doc, cur_can_idx))
+            for can_md in cur_can.get('metadata', []) + [cfg.e_term()]:
+                can_term = build_qualifier_tuple(can_md)
+                if not can_term[1]:
+                    # don't allow empty values
+                    continue
+                can_actor = get_metadata_actor(can_md)
+                can_terms.setdefault(can_uri, OrderedDict()).setdefault(
+                                                        can_term, can_actor)
+                term_hit_key = term_hits.setdefault(can_term[1], hit_key)
+                wanted_cur_assocs.setdefault((can_term, term_hit_key),
+                                             can_actor)
+
+    # Curation
+    log('updating curation {}'.format(cur_uri))
+    cur_db.set_doc(cur_doc, cfg.doc_codec())
+    cur_db.content_hash = cur_hash if complete else None
+    db.session.add(cur_db)
+
+    # curation hits
+    hits = {}
+    for hit in db.session.query(CurationHit).filter(
+                CurationHit.curation_id == cur_db.id):
+        hits[curation_hit_key(hit, cur_uri)] = hit
+    if top_key not in hits:
+        hits[top_key] = build_curation_hit(cur_db.id)
+        db.session.add(hits[top_key])
+    for hit_key, (can_doc, cur_can_idx) in wanted_hits.items():
+        if hit_key not in hits:
+            log('creating new canvas hit {} for curation {}'.format(
+                                                        hit_key[2], cur_uri))
+            hits[hit_key] = build_curation_hit(cur_db.id, can_doc,
+                                               cur_can_idx)
+            db.session.add(hits[hit_key])
+    db.session.flush()
+    for hit_key, hit in hits.items():
+        lo['hit_key_dict'][hit_key] = hit.id
+
+    # curation term associations
+    wanted = OrderedDict()
+    for (term, hit_key), actor in wanted_cur_assocs.items():
+        wanted[(get_term_id(lo, term), hits[hit_key].id)] = actor
+    old_assocs = db.session.query(TermCurationAssoc, Term.term,
+                                  CurationHit.hit_type).join(
+                                    TermCurationAssoc.term).join(
+                                    TermCurationAssoc.curation_hit).filter(
+                                    CurationHit.curation_id == cur_db.id)
+    removed = set()
+    for assoc, term, hit_type in old_assocs:
+        tcua_key = (assoc.term_id, assoc.curation_hit_id)
+        lo['term_hit_dict'].pop((cur_uri, term, hit_type), None)
+        if tcua_key not in wanted:
+            db.session.delete(assoc)
+            removed.add(tcua_key)
+        elif assoc.actor != wanted[tcua_key]:
+            assoc.actor = wanted.pop(tcua_key)
+        else:
+            del wanted[tcua_key]
+    if removed:
+        log('removing {} term associations of curation {}'.format(
+                                                        len(removed), cur_uri))
+        lo['term_cur_assoc_list'] = [key for key in lo['term_cur_assoc_list']
+                                     if key not in removed]
+    for (term_id, hit_id), actor in wanted.items():
+        db.session.add(TermCurationAssoc(term_id=term_id,
+                                         curation_hit_id=hit_id,
+                                         metadata_type='curation',
+                                         actor=actor))
+        lo['term_cur_assoc_list'].append((term_id, hit_id))
+    for (term, hit_key) in wanted_cur_assocs:
+        lo['term_hit_dict'][(cur_uri, term[1], hit_key[1])] = \
+                                                        hits[hit_key].id
+    for hit_key, hit in hits.items():
+        if hit_key != top_key and hit_key not in wanted_hits:
+            log('removing canvas hit {} of curation {}'.format(hit_key[2],
+                                                               cur_uri))
+            db.session.delete(hit)
+            del lo['hit_key_dict'][hit_key]
+
+    # Canvases
+    new_canvases = 0
+    for can_uri, cur_cans in canvases.items():
+        doc = can_docs[can_uri]
+        replace_terms = False
+        if can_uri not in lo['canvas_uri_dict']:
+            log('creating new canvas {}'.format(can_uri))
+            for cur_can in cur_cans[1:]:
+                doc = merge_iiif_doc_metadata(doc, cur_can)
+            can_db_id = lo['canvas_docs'].create(can_uri, doc,
+                                                 cfg.defer_thumbnails())
+            lo['canvas_uri_dict'][can_uri] = can_db_id
+            new_canvases += 1
+            old_assocs = []
+        else:
+            can_db_id = lo['canvas_uri_dict'][can_uri]
+            old_doc = lo['canvas_docs'].get(can_db_id)
+            parents = cp_map['upward'].get(can_uri, [])
+            if not cfg.allow_orphan_canvases() and \
+                    set(parents) == {cur_uri}:
+                # only in this Curation, so indexed as if it were new
+                replace_terms = True
+                if len(cur_cans[0].get('metadata', [])) > 0:
+                    doc['metadata'] = cur_cans[0]['metadata']
+                else:
+                    doc.pop('metadata', None)
+                for cur_can in cur_cans[1:]:
+                    doc = merge_iiif_doc_metadata(doc, cur_can)
+            else:
+                for cur_can in cur_cans:
+                    doc = merge_iiif_doc_metadata(doc, cur_can)
+            if doc != old_doc:
+                log('updating canvas {}'.format(can_uri))
+                lo['canvas_docs'].put(can_db_id, doc)
+            old_assocs = db.session.query(TermCanvasAssoc).filter(
+                            TermCanvasAssoc.canvas_id == can_db_id).all()
+        # canvas term associations
+        wanted = OrderedDict()
+        for term, actor in can_terms.get(can_uri, {}).items():
+            wanted[get_term_id(lo, term)] = actor
+        removed = set()
+        for assoc in old_assocs:
+            if not replace_terms:
+                wanted.pop(assoc.term_id, None)
+            elif assoc.term_id not in wanted:
+                db.session.delete(assoc)
+                removed.add((assoc.term_id, can_db_id))
+            elif assoc.actor != wanted[assoc.term_id]:
+                assoc.actor = wanted.pop(assoc.term_id)
+            else:
+                del wanted[assoc.term_id]
+        if removed:
+            lo['term_can_assoc_list'] = [key for key in
+                                         lo['term_can_assoc_list']
+                                         if key not in removed]
+        for term_id, actor in wanted.items():
+            db.session.add(TermCanvasAssoc(term_id=term_id,
+                                           canvas_id=can_db_id,
+                                           metadata_type='canvas',
+                                           actor=actor))
+            lo['term_can_assoc_list'].append((term_id, can_db_id))
+
+    # Canvas parent map (and Canvases no longer in any Curation)
+    if not cfg.allow_orphan_canvases() and cur_uri in cp_map['downward']:
+        detach_canvases(cp_map, cur_uri, list(cp_map['downward'][cur_uri]),
+                        keep=canvases, lo=lo)
+    if cur_uri not in cp_map['downward']:
+        cp_map['downward'][cur_uri] = []
+    for can_uri in canvases:
+        if can_uri not in cp_map['upward']:
+            cp_map['upward'][can_uri] = []
+        if cur_uri not in cp_map['upward'][can_uri]:
+            cp_map['upward'][can_uri].append(cur_uri)
+        if can_uri not in cp_map['downward'][cur_uri]:
+            cp_map['downward'][cur_uri].append(can_uri)
+    return new_canvases
+
+
+def process_curation_delete(cp_map, activity, lo=None):
     """ Process a delete activity that has a cr:Curation as its object.
+        If given, the lookup dictionary is updated.
     """
 
+    cfg = get_cfg()
     log(('deletion triggered through activity {}').format(activity['id']))
     # delete Curation
     cur_uri = get_attrib_uri(activity, 'object')
-    to_del = db.session.query(Curation).filter(
-                Curation.curation_uri.ilike('%{}%'.format(cur_uri))
-                ).all()
-    if len(to_del) == 0:
+    cur_db = db.session.query(Curation).filter(
+                Curation.curation_uri == cur_uri
+                ).first()
+    if not cur_db:
         log('nothing to delete')
-    for cur_db in to_del:
-        log(('deleting curation record {} and all term associations belonging'
-             'to it').format(cur_db.curation_uri))
+    else:
+        log(('deleting curation record {} and all hits and term associations '
+             'belonging to it').format(cur_db.curation_uri))
+        hit_ids = db.session.query(CurationHit.id).filter(
+                CurationHit.curation_id == cur_db.id
+                )
         db.session.query(TermCurationAssoc).filter(
-                TermCurationAssoc.curation_id == cur_db.id
+                TermCurationAssoc.curation_hit_id.in_(hit_ids.subquery())
+                ).delete(synchronize_session=False)
+        db.session.query(CurationHit).filter(
+                CurationHit.curation_id == cur_db.id
                 ).delete()
         db.session.query(Curation).filter(
                 Curation.id == cur_db.id
@@ -799,30 +1205,48 @@ def process_curation_delete(cp_map, activity):
     # delete orphaned Canvases if configured
     if not cfg.allow_orphan_canvases() and \
             cur_uri in cp_map['downward']:
-        to_del_uris = list(cp_map['downward'][cur_uri])  # copy
-        for can_uri in to_del_uris:
-            try:
-                cp_map['upward'][can_uri].remove(cur_uri)
-                cp_map['downward'][cur_uri].remove(can_uri)
-            except ValueError as e:
-                log(('tried to delete parent entry {} for canvas {} but co'
-                     'uld not find it in the canvas parent map'
-                     ).format(cur_uri, can_uri))
-            if len(cp_map['upward'][can_uri]) == 0:
-                log(('deleting canvas record {} and all term associations belo'
-                     'nging to it because it was orphaned').format(can_uri))
-                can_db = db.session.query(Canvas).filter(
-                            Canvas.canvas_uri == can_uri
-                            ).first()
-                db.session.query(TermCanvasAssoc).filter(
-                        TermCanvasAssoc.canvas_id == can_db.id
-                        ).delete()
-                db.session.query(Canvas).filter(
-                        Canvas.id == can_db.id
-                        ).delete()
-            else:
-                log(('record {} still has {} parent(s) left. not deleting'
-                    ).format(can_uri, len(cp_map['upward'][can_uri])))
+        detach_canvases(cp_map, cur_uri, list(cp_map['downward'][cur_uri]),
+                        lo=lo)
+
+
+def detach_canvases(cp_map, cur_uri, can_uris, keep=(), lo=None):
+    """ Remove a Curation from the parents of the given Canvases in the
+        Canvas parent map and delete the Canvases left without a parent
+        (except for those in keep). If given, the lookup dictionary is
+        updated accordingly.
+    """
+
+    for can_uri in can_uris:
+        try:
+            cp_map['upward'][can_uri].remove(cur_uri)
+            cp_map['downward'][cur_uri].remove(can_uri)
+        except ValueError as e:
+            log(('tried to delete parent entry {} for canvas {} but co'
+                 'uld not find it in the canvas parent map'
+                 ).format(cur_uri, can_uri))
+        if can_uri in keep:
+            continue
+        if len(cp_map['upward'][can_uri]) == 0:
+            log(('deleting canvas record {} and all term associations belo'
+                 'nging to it because it was orphaned').format(can_uri))
+            can_db = db.session.query(Canvas).filter(
+                        Canvas.canvas_uri == can_uri
+                        ).first()
+            db.session.query(TermCanvasAssoc).filter(
+                    TermCanvasAssoc.canvas_id == can_db.id
+                    ).delete()
+            db.session.query(Canvas).filter(
+                    Canvas.id == can_db.id
+                    ).delete()
+            if lo is not None:
+                del lo['canvas_uri_dict'][can_uri]
+                lo['canvas_docs'].discard(can_db.id)
+                lo['term_can_assoc_list'] = [
+                    key for key in lo['term_can_assoc_list']
+                    if key[1] != can_db.id]
+        else:
+            log(('record {} still has {} parent(s) left. not deleting'
+                ).format(can_uri, len(cp_map['upward'][can_uri])))
 
 
 def get_lookup_dict():
@@ -840,15 +1264,19 @@ def get_lookup_dict():
         for term in terms:
             term_tup_dict[(term.qualifier, term.term)] = term.id
     canvas_uri_dict = {}
-    cans = db.session.query(Canvas).all()
-    if cans:
-        for can in cans:
-            canvas_uri_dict[can.canvas_uri] = can.id
+    for can_id, can_uri in db.session.query(Canvas.id, Canvas.canvas_uri):
+        canvas_uri_dict[can_uri] = can_id
     curation_uri_dict = {}
-    curs = db.session.query(Curation).all()
-    if curs:
-        for cur in curs:
-            curation_uri_dict[cur.curation_uri] = cur.id
+    for cur_id, cur_uri in db.session.query(Curation.id,
+                                            Curation.curation_uri):
+        curation_uri_dict[cur_uri] = cur_id
+    # curation hits by (<curation>, 'curation') or
+    #                  (<curation>, 'canvas', <canvas>, <index in range>)
+    hit_key_dict = {}
+    hits = db.session.query(CurationHit, Curation.curation_uri).join(
+                                                        CurationHit.curation)
+    for hit, cur_uri in hits:
+        hit_key_dict[curation_hit_key(hit, cur_uri)] = hit.id
     log('building lookup lists of existing associations')
     # build lookup lists of existing associations
     term_can_assoc_list = []
@@ -857,23 +1285,84 @@ def get_lookup_dict():
         for tcaa in tcaas:
             term_can_assoc_list.append((tcaa.term_id, tcaa.canvas_id))
     term_cur_assoc_list = []
-    tcuas = db.session.query(TermCurationAssoc).all()
-    if tcuas:
-        for tcua in tcuas:
-            term_cur_assoc_list.append((tcua.term_id, tcua.curation_id))
+    # curation hits by (<curation>, <term>, <hit type>)
+    term_hit_dict = {}
+    tcuas = db.session.query(TermCurationAssoc.term_id,
+                             TermCurationAssoc.curation_hit_id,
+                             Term.term,
+                             CurationHit.hit_type,
+                             Curation.curation_uri).join(
+                                TermCurationAssoc.term).join(
+                                TermCurationAssoc.curation_hit).join(
+                                CurationHit.curation)
+    for term_id, hit_id, term, hit_type, cur_uri in tcuas:
+        term_cur_assoc_list.append((term_id, hit_id))
+        term_hit_dict[(cur_uri, term, hit_type)] = hit_id
     lo = {}
     lo['term_tup_dict'] = term_tup_dict
     lo['canvas_uri_dict'] = canvas_uri_dict
     lo['curation_uri_dict'] = curation_uri_dict
+    lo['hit_key_dict'] = hit_key_dict
+    lo['term_hit_dict'] = term_hit_dict
     lo['term_can_assoc_list'] = term_can_assoc_list
     lo['term_cur_assoc_list'] = term_cur_assoc_list
+    # documents of the Canvases touched during the crawl
+    cfg = get_cfg()
+    lo['canvas_docs'] = CanvasDocCache(cfg.doc_codec(),
+                                       cfg.facet_label_hide())
     return lo
 
 
-def crawl_single(lo, cp_map, as_source):
-    """ Crawl, given a URL to an Activity Stream
+def read_pages(as_ocp):
+    """ Starting from the given (last) page of an Activity Stream, yield its
+        pages, going backwards.
+    """
+
+    while True:
+        log('going through AS page {}'.format(as_ocp['id']))
+        yield as_ocp
+        if not as_ocp.get('prev', False):
+            break
+        as_ocp = get_referenced(as_ocp, 'prev')
+
+
+def plan_activities(pages, last_crawl_time=None):
+    """ Yield the Activities of the given Activity Stream pages that have to be
+        processed: those about a Curation that ended after the last crawl
+        (if any), and of those only the most recent one per Curation.
+    """
+
+    import dateutil.parser
+
+    # NOTE: seen_activity_objs is used to prevent processing obsolete
+    #       activities. Since we go through the Activity Stream backwards, we
+    #       only process the most recent Activity per IIIF doc.
+    #       (Not doing so might lead to for example trying to process a Create
+    #       for a document for which a Delete was processed just before.)
+    seen_activity_objs = []
+    for as_ocp in pages:
+        for activity in as_ocp['orderedItems']:
+            log('going through {} item {}'.format(activity['type'],
+                                                  activity['id']))
+            activity_end_time = dateutil.parser.parse(activity['endTime'])
+            # if we haven't seen it yet and it's about a Curation
+            if (not last_crawl_time or activity_end_time > last_crawl_time) \
+                    and activity['object']['@type'] == 'cr:Curation' and \
+                    activity['object'] not in seen_activity_objs:
+                seen_activity_objs.append(activity['object'])
+                yield activity
+            else:
+                log('skipping')
+
+
+def crawl_single(lo, cp_map, as_source, post_jobs=True):
+    """ Crawl, given a URL to an Activity Stream. Return True if the index
+        was changed. Bots are called unless post_jobs is False.
     """
 
+    import dateutil.parser
+    import requests
+
     log('retrieving Activity Stream')
     try:
         resp = requests.get(as_source)
@@ -896,77 +1385,68 @@ def crawl_single(lo, cp_map, as_source):
     as_ocp = get_referenced(as_oc, 'last')
     last_crawl = db.session.query(CrawlLog).order_by(desc(CrawlLog.log_id)
                                                     ).first()
+    last_crawl_time = None
+    if last_crawl:
+        last_crawl_time = dateutil.parser.parse(last_crawl.datetime)
     new_canvases = 0
+    unchanged_curations = 0
     new_activity = False
-    # NOTE: seen_activity_objs is used to prevent processing obsolete
-    #       activities. Since we go through the Activity Stream backwards, we
-    #       only process the most recent Activity per IIIF doc.
-    #       (Not doing so might lead to for example trying to process a Create
-    #       for a document for which a Delete was processed just before.)
-    seen_activity_objs = []
-    # for all AS pages
-    while True:
-        # for all AC items
-        log('going through AS page {}'.format(as_ocp['id']))
-        for activity in as_ocp['orderedItems']:
-            log('going through {} item {}'.format(activity['type'],
-                                                  activity['id']))
-            activity_end_time = dateutil.parser.parse(activity['endTime'])
-            if last_crawl:
-                last_crawl_time = dateutil.parser.parse(last_crawl.datetime)
-            else:
-                zero_timestamp = datetime.datetime.fromtimestamp(0)
-                last_crawl_time = zero_timestamp.isoformat()
-            # if we haven't seen it yet and it's about a Curation
-            if (not last_crawl or activity_end_time > last_crawl_time) and \
-                    activity['object']['@type'] == 'cr:Curation' and \
-                    activity['object'] not in seen_activity_objs:
-                new_activity = True
-                if activity['type'] == 'Create':
-                    new_canvases += process_curation_create(lo, cp_map,
-                                                            activity)
-                elif activity['type'] == 'Update':
-                    process_curation_delete(cp_map, activity)
-                    lo = get_lookup_dict()
-                    process_curation_create(lo, cp_map, activity)
-                    # TODO: possible to determine new canvases?
-                elif activity['type'] == 'Delete':
-                    process_curation_delete(cp_map, activity)
-                db.session.commit()
-                seen_activity_objs.append(activity['object'])
-            else:
-                log('skipping')
-
-        if not as_ocp.get('prev', False):
-            break
-        as_ocp = get_referenced(as_ocp, 'prev')
+    cfg = get_cfg()
+    if cfg.pipeline_workers() > 0:
+        from canvasindexer.crawler.pipeline import run_pipeline
+        planned = run_pipeline(as_ocp, last_crawl_time, lo,
+                               cfg.pipeline_workers(),
+                               cfg.pipeline_executor())
+    else:
+        planned = ((activity, None) for activity
+                   in plan_activities(read_pages(as_ocp), last_crawl_time))
+    try:
+        for activity, fetched in planned:
+            changed = True
+            if activity['type'] == 'Create':
+                new_canvases += process_curation_create(lo, cp_map, activity,
+                                                        fetched)
+            elif activity['type'] == 'Update':
+                added = process_curation_update(lo, cp_map, activity,
+                                                fetched)
+                if added is None:
+                    # re-saved without changes
+                    unchanged_curations += 1
+                    changed = False
+                else:
+                    new_canvases += added
+            elif activity['type'] == 'Delete':
+                process_curation_delete(cp_map, activity, lo)
+            new_activity = new_activity or changed
+            lo['canvas_docs'].write_back()
+            db.session.commit()
+    finally:
+        planned.close()
 
     # persist crawl log
+    if unchanged_curations:
+        log('skipped {} updates of unchanged curations'.format(
+                                                        unchanged_curations))
     crawl_log = CrawlLog(new_canvases=new_canvases,
+                         unchanged_curations=unchanged_curations,
                          datetime=datetime.datetime.utcnow().isoformat())
     db.session.add(crawl_log)
     db.session.commit()
     if new_activity:
         # call bots (if configured)
-        post_bot_jobs()
+        if post_jobs:
+            post_bot_jobs()
         log('generating facet list')
-        # build and persist facet list
-        facet_list = build_facet_list()
-        log('persisting facet list')
-        db_entry = db.session.query(FacetList).first()
-        if not db_entry:
-            db_entry = FacetList(json_string=json.dumps(facet_list))
-        else:
-            db_entry.json_string = json.dumps(facet_list)
-        db.session.add(db_entry)
-        db.session.commit()
+        store_facet_list()
     else:
         log('no changes. skipping generation of facet list')
 
     log('- - - - - - - - - - END - - - - - - - - - -')
+    return new_activity
 
 
 def post_bot_jobs():
+    cfg = get_cfg()
     # trigger job post to bost (in case new Canvases were craweld)
     for bot_url in cfg.bot_urls():
         post_url = '{}{}'.format(bot_url, '/job')
@@ -990,9 +1470,18 @@ def post_bot_jobs():
             log('something went horribly wrong')
 
 
-def crawl():
+def crawl(fresh=False, profile_sql=False):
     """ Crawl all Activity Streams set in the config.
 
+        In blue-green mode (see canvasindexer.builds) the crawl goes into the
+        DB not used by the API, which is switched to once the crawl is done.
+        If fresh is set, that DB starts out empty instead of as a copy of the
+        active one, i.e. everything is crawled again.
+
+        If profile_sql is set (or profile_sql in the crawler section of the
+        config), a profile of the SQL statements is written to the log (see
+        canvasindexer.profiler).
+
         This function does not run inside the normal Canvas Indexer app context
         (because it is not triggered by a web request) and "therefore" looks a
         bit messy, has imports inside it, etc.
@@ -1001,14 +1490,31 @@ def crawl():
     from flask import Flask
     app = Flask(__name__)
     with app.app_context():
-        cfg = Cfg()
-        app.config['SQLALCHEMY_DATABASE_URI'] = cfg.db_uri()
+        cfg = get_cfg()
+        from canvasindexer.builds import (active_db_uri, discard_build,
+                                          start_build, switch_to_build)
+        build_uri = None
+        if cfg.blue_green():
+            build_uri = start_build(cfg, fresh)
+            db_uri = build_uri
+        else:
+            db_uri = active_db_uri(cfg)
+        app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
         app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
         from canvasindexer.models import db
+        from canvasindexer.connections import setup_engine
+        from canvasindexer.startup import prepare_db
         db.init_app(app)
-        db.create_all()
+        setup_engine(app, cfg)
+        prepare_db(app)
         log('- - - - - - - - - - START - - - - - - - - - -')
+        if build_uri:
+            log('building index in {}'.format(build_uri))
+        profiler = None
+        if profile_sql or cfg.crawler_profile_sql():
+            from canvasindexer.profiler import SQLProfiler
+            profiler = SQLProfiler(cfg.slow_query_ms(), log).start()
         # prepare DB ID lookup structures
         lo = get_lookup_dict()
 
@@ -1021,10 +1527,57 @@ def crawl():
             cp_map_db = CanvasParentMap(json_string=json.dumps(cp_map))
 
         # crawl
+        index_changed = False
         for as_source in cfg.as_sources():
-            crawl_single(lo, cp_map, as_source)
+            # in blue-green mode bots are called once the API serves the new
+            # index, so that their results go into it
+            if crawl_single(lo, cp_map, as_source, post_jobs=not build_uri):
+                index_changed = True
+        doc_cache = lo['canvas_docs']
+        log('canvas documents: {} loaded, {} cache hits, {} written'.format(
+                            doc_cache.loaded, doc_cache.hits, doc_cache.written))
 
         # store Canvas parent map
         cp_map_db.json_string = json.dumps(cp_map)
         db.session.add(cp_map_db)
         db.session.commit()
+
+        # let API workers know that cached responses are outdated
+        # (and publish a snapshot of the index for them if configured).
+        # bot results only bump the generation, so the snapshot is also
+        # written again if it is of an older generation
+        current = read_generation(cfg.generation_file())
+        snapshot_outdated = cfg.search_engine() == 'snapshot' and \
+            (not current or
+             snapshot_generation(cfg.snapshot_file()) != current['generation'])
+        last_crawl = db.session.query(CrawlLog).order_by(
+                                    desc(CrawlLog.log_id)).first()
+        timestamp = last_crawl.datetime if last_crawl else None
+        discarded = False
+        if index_changed or snapshot_outdated or not current:
+            if build_uri:
+                gen = switch_to_build(cfg, build_uri, timestamp)
+            else:
+                gen = publish_index(cfg, timestamp)
+            log('index generation is now {}'.format(gen['generation']))
+            if build_uri:
+                log('API switched to {}'.format(build_uri))
+                if index_changed:
+                    post_bot_jobs()
+        elif build_uri:
+            db.session.remove()
+            discard_build(cfg, build_uri)
+            log('no changes. discarded build')
+            discarded = True
+
+        # thumbnails of Canvases indexed with provisional ones (a discarded
+        # build's Canvases are enriched in the next build)
+        if cfg.defer_thumbnails() and not discarded:
+            from canvasindexer.crawler.enrichment import enrich_canvases
+            if enrich_canvases(cp_map):
+                gen = publish_index(cfg, timestamp)
+                log('index generation is now {}'.format(gen['generation']))
+
+        if profiler:
+            profiler.stop()
+            log('\n'.join(profiler.report()))
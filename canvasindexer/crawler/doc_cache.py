@@ -0,0 +1,110 @@
+""" Write-back cache of Canvas documents used during a crawl.
+
+    A Canvas that appears in several Curations (or several times in one) is
+    indexed with the merged metadata of all its occurrences. Instead of
+    loading, decoding, merging, encoding and writing its document for every
+    occurrence, the documents of the Canvases touched in a crawl are kept in
+    memory and only the ones that changed are written, once, by write_back().
+    The crawler calls write_back() before each commit, so that committed
+    Canvas documents always match the committed term associations.
+"""
+
+import copy
+from collections import OrderedDict
+from canvasindexer.models import db, Canvas
+
+
+class CanvasDocCache():
+    """ Full documents (see Canvas.get_full_doc) by Canvas DB ID. Of the
+        documents not changed since the last write_back(), at most max_size
+        are kept, the least recently used ones are dropped first.
+    """
+
+    def __init__(self, codec_name, hidden_labels, max_size=10000):
+        self.codec_name = codec_name
+        self.hidden_labels = hidden_labels
+        self.max_size = max_size
+        self.docs = OrderedDict()
+        self.dirty = set()
+        self.loaded = 0
+        self.hits = 0
+        self.written = 0
+
+    def get(self, can_id):
+        """ Return the document of a Canvas. Changes to it have to be passed
+            to put().
+        """
+
+        if can_id in self.docs:
+            self.hits += 1
+            self.docs.move_to_end(can_id)
+            return self.docs[can_id]
+        doc = db.session.query(Canvas).get(can_id).get_full_doc()
+        self.loaded += 1
+        self._add(can_id, doc)
+        return doc
+
+    def put(self, can_id, doc):
+        """ Set the (changed) document of a Canvas.
+        """
+
+        self.docs[can_id] = doc
+        self.docs.move_to_end(can_id)
+        self.dirty.add(can_id)
+
+    def create(self, can_uri, doc, pending_enrichment=False):
+        """ Create the record of a new Canvas and return its ID. If
+            pending_enrichment is set, the Canvas is marked as having a
+            provisional thumbnail.
+        """
+
+        can_db = Canvas(canvas_uri=can_uri)
+        if pending_enrichment and doc.get('canvas'):
+            can_db.pending_enrichment = 0
+        # ↓ copy b/c metadata with hidden labels is moved out of the document
+        can_db.set_full_doc(copy.copy(doc), self.codec_name,
+                            self.hidden_labels)
+        db.session.add(can_db)
+        db.session.flush()
+        self._add(can_db.id, doc)
+        return can_db.id
+
+    def discard(self, can_id):
+        """ Forget a Canvas (e.g. because its record was deleted).
+        """
+
+        self.docs.pop(can_id, None)
+        self.dirty.discard(can_id)
+
+    def write_back(self):
+        """ Write all changed documents to the session. Return their number.
+        """
+
+        if not self.dirty:
+            return 0
+        mappings = []
+        for can_id in sorted(self.dirty):
+            record = Canvas()
+            record.set_full_doc(copy.copy(self.docs[can_id]), self.codec_name,
+                                self.hidden_labels)
+            mappings.append({'id': can_id,
+                             'json_string': record.json_string,
+                             'doc_blob': record.doc_blob,
+                             'doc_codec': record.doc_codec,
+                             'hidden_metadata': record.hidden_metadata})
+        db.session.bulk_update_mappings(Canvas, mappings)
+        self.written += len(mappings)
+        self.dirty.clear()
+        self._shrink()
+        return len(mappings)
+
+    def _add(self, can_id, doc):
+        self.docs[can_id] = doc
+        self.docs.move_to_end(can_id)
+        self._shrink()
+
+    def _shrink(self):
+        while len(self.docs) - len(self.dirty) > self.max_size:
+            oldest = next(can_id for can_id in self.docs
+                          if can_id not in self.dirty)
+            del self.docs[oldest]
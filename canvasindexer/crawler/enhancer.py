@@ -1,18 +1,21 @@
 import datetime
 import json
-import requests
 from flask import abort
 from canvasindexer.models import db, Term, Canvas, TermCanvasAssoc, BotState
-from canvasindexer.config import Cfg
+from canvasindexer.builds import (callback_lock, record_callback,
+                                  recorded_callbacks)
+from canvasindexer.config import get_cfg
+from canvasindexer.connections import route_request
+from canvasindexer.generation import bump_generation
 from sqlalchemy import and_
-
-cfg = Cfg()
+from werkzeug.exceptions import HTTPException
 
 
 def log(msg):
     """ Write a log message.
     """
 
+    cfg = get_cfg()
     timestamp = str(datetime.datetime.now()).split('.')[0]
     with open(cfg.crawler_log_file(), 'a') as f:
         f.write('[{}]   <ENHANCER> {}\n'.format(timestamp, msg))
@@ -32,7 +35,7 @@ def post_job(bot_url, callback_url):
         state_db = BotState(bot_url=bot_url,
                             waiting_job_id=-1,
                             finished_canvases=json.dumps(finished_canvas_uris))
-        new_canvas_dicts = [json.loads(c.json_string) for c in all_canvases_db]
+        new_canvas_dicts = [c.get_doc() for c in all_canvases_db]
         new_canvas_uris = [c.canvas_uri for c in all_canvases_db]
     else:
         if state_db.waiting_job_id != -1:
@@ -44,7 +47,7 @@ def post_job(bot_url, callback_url):
         new_canvas_uris = []
         for can_db in all_canvases_db:
             if can_db.canvas_uri not in finished_canvas_uris:
-                new_canvas_dicts.append(json.loads(can_db.json_string))
+                new_canvas_dicts.append(can_db.get_doc())
                 new_canvas_uris.append(can_db.canvas_uri)
     if len(new_canvas_uris) == 0:
         log('No new canvases to send.')
@@ -62,6 +65,7 @@ def post_job(bot_url, callback_url):
         job['imgs'].append(img)
 
     # send job and process response
+    import requests
     resp = requests.post(bot_url,
                          headers={'Accept': 'application/json',
                                   'Content-Type': 'application/json'},
@@ -99,6 +103,7 @@ def enhance(request):
         results.
     """
 
+    cfg = get_cfg()
     json_bytes = request.data
     try:
         json_string = json_bytes.decode('utf-8')
@@ -111,13 +116,52 @@ def enhance(request):
         return abort(400, 'No valid job results provided.')
 
     job_id = job_result['job_id']
-    results = job_result['results']
 
     log('Received callback for job {}.'.format(job_id))
 
+    with callback_lock(cfg):
+        # ↓ a build might have been switched to while waiting for the lock
+        route_request()
+        record_callback(cfg, job_result)
+        if not apply_job_results(cfg, job_id, job_result['results']):
+            return abort(400, 'No bot is waiting for this job.')
+        if len(job_result['results']) > 0:
+            # ↓ writing a snapshot (if used) takes too long for a request, the
+            #   crawler writes one when it sees that the snapshot is outdated
+            bump_generation(cfg.generation_file())
+
+
+def replay_callbacks():
+    """ Write the bot results recorded during a build into the build (see
+        canvasindexer.builds). Call with callback_lock held. Return the
+        number of jobs whose results were written.
+    """
+
+    cfg = get_cfg()
+    replayed = 0
+    for job_result in recorded_callbacks(cfg):
+        log('Replaying results of job {}.'.format(job_result['job_id']))
+        try:
+            if apply_job_results(cfg, job_result['job_id'],
+                                 job_result['results']):
+                replayed += 1
+        except HTTPException as e:
+            db.session.rollback()
+            log('Could not replay results. {}'.format(e.description))
+    return replayed
+
+
+def apply_job_results(cfg, job_id, results):
+    """ Add the tags a bot returned to the Canvases. Return False if no bot
+        is waiting for the job (e.g. because its results were written
+        already).
+    """
+
     # TODO: ideally check HTTP referrer against bot url
     #       or make Canvas Indexer dictate job id in request
     state_db = BotState.query.filter(BotState.waiting_job_id == job_id).first()
+    if not state_db:
+        return False
     state_db.waiting_job_id = -1
     db.session.add(state_db)
     db.session.commit()
@@ -131,7 +175,8 @@ def enhance(request):
                                      ).first()
             if not term:
                 # add term if new
-                term = Term(term=tag, qualifier='tag')
+                term = Term(term=tag, qualifier='tag',
+                            hidden='tag' in cfg.facet_label_hide())
                 db.session.add(term)
                 db.session.flush()
 
@@ -141,12 +186,13 @@ def enhance(request):
                 return abort(400, 'Result for inexistent canvas.')
 
             # add new metadata to Canvas search result representation
-            can_dict = json.loads(canvas.json_string)
+            can_dict = canvas.get_full_doc()
             if not can_dict.get('metadata'):
                 can_dict['metadata'] = []
             can_dict['metadata'].append({'label': 'tag',
                                          'value': tag})
-            canvas.json_string = json.dumps(can_dict)
+            canvas.set_full_doc(can_dict, cfg.doc_codec(),
+                                cfg.facet_label_hide())
             db.session.add(canvas)
 
             # add term canvas assoc
@@ -158,3 +204,4 @@ def enhance(request):
     if len(results) > 0:
         db.session.commit()
         log('generating facet list')
+    return True
@@ -0,0 +1,128 @@
+""" Retrieval of image information after a crawl.
+
+    To build the thumbnail URL of a Canvas, the info.json of its image is
+    needed. With `defer_thumbnails = true` in the crawler section of the
+    config, the crawler doesn't wait for it: new Canvases are indexed with a
+    provisional thumbnail (see canvasindexer.crawler.crawler.
+    provisional_thumbnail) and marked as pending enrichment. Once the crawl is
+    published, enrich_canvases() retrieves the info.json documents of the
+    pending Canvases in batches, a number of them at a time, and replaces the
+    provisional thumbnail in the Canvas documents, the Curation hits and the
+    Curation documents. Canvases for which the info.json could not be
+    retrieved stay pending and are tried again after the next crawl, up to
+    MAX_ATTEMPTS times.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from canvasindexer.config import get_cfg
+from canvasindexer.crawler.crawler import (get_img_compliance_level,
+                                           get_info_json, get_referenced,
+                                           image_url, log, thumbnail_url)
+from canvasindexer.models import db, Canvas, Curation, CurationHit
+
+MAX_ATTEMPTS = 5
+BATCH_SIZE = 50
+CONCURRENT_REQUESTS = 8
+
+
+def manifest_canvas(man, canvas_id):
+    """ Return the Canvas with the given ID from a Manifest (an empty dict if
+        it isn't in there).
+    """
+
+    if type(man) != dict:
+        return {}
+    for seq in man.get('sequences', []):
+        for man_can in seq.get('canvases', []):
+            if man_can['@id'] == canvas_id:
+                return man_can
+    return {}
+
+
+def replace_thumbnail(cp_map, can_uri, doc, old_thumb, new_thumb):
+    """ Replace the thumbnail of a Canvas in the Curation hits and Curation
+        documents it was used in.
+    """
+
+    cfg = get_cfg()
+    cur_uris = cp_map['upward'].get(can_uri, [])
+    if not cur_uris:
+        return
+    cur_ids = [cur_id for (cur_id,) in db.session.query(Curation.id).filter(
+                                        Curation.curation_uri.in_(cur_uris))]
+    hits = db.session.query(CurationHit).filter(
+                CurationHit.curation_id.in_(cur_ids),
+                CurationHit.hit_type == 'canvas',
+                CurationHit.canvas_id == doc['canvasId'],
+                CurationHit.fragment == doc['fragment'],
+                CurationHit.thumbnail == old_thumb)
+    for hit in hits:
+        hit.thumbnail = new_thumb
+    for cur_db in db.session.query(Curation).filter(Curation.id.in_(cur_ids)):
+        cur_doc = cur_db.get_doc(object_pairs_hook=OrderedDict)
+        if cur_doc.get('curationThumbnail') == old_thumb:
+            cur_doc['curationThumbnail'] = new_thumb
+            cur_db.set_doc(cur_doc, cfg.doc_codec())
+
+
+def enrich_canvases(cp_map):
+    """ Replace the provisional thumbnails of all Canvases pending
+        enrichment. Return the number of Canvases whose thumbnail was set.
+    """
+
+    cfg = get_cfg()
+    enriched = 0
+    failed = 0
+    last_id = 0
+    while True:
+        batch = db.session.query(Canvas).filter(
+                    Canvas.pending_enrichment.isnot(None),
+                    Canvas.id > last_id).order_by(Canvas.id).limit(
+                    BATCH_SIZE).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+        docs = [can_db.get_full_doc() for can_db in batch]
+        info_urls = list(OrderedDict.fromkeys(doc['canvas'] for doc in docs
+                                              if doc.get('canvas')))
+        log('retrieving {} info.json documents'.format(len(info_urls)))
+        with ThreadPoolExecutor(CONCURRENT_REQUESTS) as pool:
+            # ↓ error responses count as failed attempts, to try again later
+            infos = dict(zip(info_urls, pool.map(
+                            lambda url: get_info_json(url, require_ok=True),
+                            info_urls)))
+        manifests = {}
+        for can_db, doc in zip(batch, docs):
+            info_dict = infos.get(doc.get('canvas'))
+            if info_dict is None:
+                can_db.pending_enrichment += 1
+                failed += 1
+                if can_db.pending_enrichment >= MAX_ATTEMPTS:
+                    log(('giving up on retrieving the image information of '
+                         'canvas {}').format(can_db.canvas_uri))
+                    can_db.pending_enrichment = None
+                continue
+            comp_lvl = get_img_compliance_level(info_dict.get('profile'))
+            man_can = {}
+            if comp_lvl == 0:
+                # the Manifest might give a thumbnail (see thumbnail_url)
+                man_url = doc['manifestUrl']
+                if man_url not in manifests:
+                    manifests[man_url] = get_referenced({'@id': man_url},
+                                                        '@id')
+                man_can = manifest_canvas(manifests[man_url], doc['canvasId'])
+            old_thumb = doc['canvasThumbnail']
+            new_thumb = thumbnail_url(image_url(info_dict), can_db.canvas_uri,
+                                      200, 200, comp_lvl, man_can)
+            if new_thumb != old_thumb:
+                doc['canvasThumbnail'] = new_thumb
+                can_db.set_full_doc(doc, cfg.doc_codec(),
+                                    cfg.facet_label_hide())
+                replace_thumbnail(cp_map, can_db.canvas_uri, doc, old_thumb,
+                                  new_thumb)
+            can_db.pending_enrichment = None
+            enriched += 1
+        db.session.commit()
+    log('enriched {} canvases ({} failed attempts)'.format(enriched, failed))
+    return enriched
@@ -0,0 +1,327 @@
+""" Pipelined processing of Activity Streams.
+
+    With `pipeline_workers` > 0 in the crawler section of the config, going
+    through an Activity Stream is split into stages connected by bounded
+    queues:
+
+        page reader → activity planner → fetcher pool → writer
+
+    The page reader (a thread) follows the pages of the Activity Stream (see
+    read_pages), the planner (a thread) selects the Activities to process (see
+    plan_activities) and submits them to a pool of fetcher threads, which
+    retrieve the Curation, Manifests and info.json documents needed for an
+    Activity and build its Canvas documents (see fetch_activity). The writer
+    is the thread that called run_pipeline. It receives the Activities in
+    their original order together with what was fetched for them and writes
+    them to the DB (see crawl_single). It is the only stage using the DB
+    session. When a queue is full, the stage before it waits, so only a
+    limited number of Activities are in flight at any time.
+
+    With `pipeline_executor = process`, the fetchers are processes instead of
+    threads, so that decoding large Manifests and building the Canvas
+    documents from them uses several cores. They return the Curation,
+    Manifests and documents as plain data, which is what the writer also
+    gets from fetcher threads. Process fetchers can't see the lookup dict of
+    the writer, they start with a copy of which Curations and Canvases are
+    indexed (see fetch_activity).
+"""
+
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from canvasindexer.config import get_cfg
+from canvasindexer.crawler.crawler import (build_canvas_doc, canvas_uri,
+                                           content_hash, get_attrib_uri,
+                                           get_referenced, log,
+                                           plan_activities, read_pages)
+from canvasindexer.models import db, Curation
+
+PAGE_QUEUE_SIZE = 2
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+# what is indexed, as seen by a fetcher process (see _init_process)
+_known = None
+
+
+class Fetched():
+    """ What was retrieved and built ahead for an Activity: the Curation, its
+        content hash (see content_hash), its Manifests by URL and Canvas
+        documents by range and index in the range
+        ({<range index>: {<canvas index>: <document>}}).
+    """
+
+    def __init__(self, curation):
+        self.curation = curation
+        self.content_hash = None
+        self.manifests = {}
+        self.canvas_docs = {}
+
+
+class StageStats():
+    """ Number of items a stage processed, time spent on them (busy) and time
+        spent waiting for input or for room in the next queue (waiting).
+    """
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items=0, busy=0.0, waiting=0.0):
+        with self._lock:
+            self.items += items
+            self.busy += busy
+            self.waiting += waiting
+
+    def report(self, elapsed):
+        return '{:<8} {:>6} {:<10} {:>8.2f} s busy {:>8.2f} s waiting ' \
+               '{:>8.1f} /s'.format(self.name, self.items, self.unit,
+                                    self.busy, self.waiting,
+                                    self.items / elapsed if elapsed else 0)
+
+
+class _Failed():
+    """ Passes an exception raised in a stage on to the next one.
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(q, item, stop):
+    """ Put an item into a queue, waiting for room unless the pipeline is
+        stopped. Return False if it was.
+    """
+
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    """ Get an item from a queue, waiting for one unless the pipeline is
+        stopped. Return _DONE if it was.
+    """
+
+    while not stop.is_set():
+        try:
+            return q.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def _init_process(known):
+    global _known
+    _known = known
+
+
+def _fetch(activity, curation_uris, canvas_uris, hashes):
+    cfg = get_cfg()
+    cur_uri = get_attrib_uri(activity, 'object')
+    fetched = Fetched(get_referenced(activity, 'object'))
+    cur = fetched.curation
+    if type(cur) != dict:
+        return fetched
+    fetched.content_hash = content_hash(cur)
+    # for Curations that are indexed already, process_curation_update only
+    # needs documents of the Canvases that aren't (and only if the Curation
+    # changed). the DB might differ by the time the Activity is written, in
+    # which case the writer uses what it needs or fetches what is missing
+    indexed = activity['type'] == 'Update' and cur_uri in curation_uris
+    if indexed and hashes.get(cur_uri) == fetched.content_hash:
+        return fetched
+    seen_uris = set()
+    for ran_idx, ran in enumerate(cur.get('selections', [])):
+        cur_cans = ran.get('members', []) + ran.get('canvases', [])
+        todo = {}
+        for cur_can_idx, cur_can in enumerate(cur_cans):
+            can_uri = canvas_uri(cur_can)
+            if indexed and (can_uri in canvas_uris or
+                            can_uri in seen_uris):
+                continue
+            seen_uris.add(can_uri)
+            todo[cur_can_idx] = cur_can
+        if not todo:
+            continue
+        man_url = get_attrib_uri(ran, 'within')
+        if man_url not in fetched.manifests:
+            fetched.manifests[man_url] = get_referenced(ran, 'within')
+        man = fetched.manifests[man_url]
+        if man == '{}':
+            continue
+        fetched.canvas_docs[ran_idx] = {
+            cur_can_idx: build_canvas_doc(man, cur_can,
+                                          cfg.defer_thumbnails())
+            for cur_can_idx, cur_can in todo.items()}
+    return fetched
+
+
+def fetch_activity(activity, known=None):
+    """ Retrieve and build what processing an Activity will need (see
+        process_curation_create and process_curation_update). Return a
+        Fetched, or None if there is nothing to fetch for the Activity or
+        something went wrong (the writer then does it all itself), together
+        with the time it took.
+
+        known is a tuple of the URIs of the indexed Curations, the URIs of the
+        indexed Canvases and the content hashes of the indexed Curations by
+        URI. It is only read. In fetcher processes, the one given when the
+        process was started is used.
+    """
+
+    if activity['type'] not in ['Create', 'Update']:
+        return None, 0.0
+    t = time.perf_counter()
+    try:
+        fetched = _fetch(activity, *(known or _known))
+    except Exception as e:
+        log('could not prepare {} ahead. Error {}.'.format(
+            activity['id'], e.__class__.__name__))
+        fetched = None
+    return fetched, time.perf_counter() - t
+
+
+def _read(as_ocp, pages, stop, stats):
+    """ Page reader stage.
+    """
+
+    page_iter = read_pages(as_ocp)
+    try:
+        while True:
+            t = time.perf_counter()
+            page = next(page_iter, _DONE)
+            stats.add(busy=time.perf_counter() - t)
+            if page is _DONE:
+                break
+            t = time.perf_counter()
+            if not _put(pages, page, stop):
+                return
+            stats.add(items=1, waiting=time.perf_counter() - t)
+    except Exception as e:
+        _put(pages, _Failed(e), stop)
+        return
+    _put(pages, _DONE, stop)
+
+
+def _plan(pages, planned, pool, last_crawl_time, known, stop, stats):
+    """ Activity planner stage.
+    """
+
+    start = time.perf_counter()
+
+    def page_iter():
+        while True:
+            t = time.perf_counter()
+            page = _get(pages, stop)
+            stats.add(waiting=time.perf_counter() - t)
+            if page is _DONE:
+                return
+            if isinstance(page, _Failed):
+                raise page.error
+            yield page
+
+    try:
+        for activity in plan_activities(page_iter(), last_crawl_time):
+            future = pool.submit(fetch_activity, activity, known)
+            t = time.perf_counter()
+            if not _put(planned, (activity, future), stop):
+                future.cancel()
+                return
+            stats.add(items=1, waiting=time.perf_counter() - t)
+        _put(planned, _DONE, stop)
+    except Exception as e:
+        _put(planned, _Failed(e), stop)
+    finally:
+        stats.add(busy=time.perf_counter() - start - stats.waiting)
+
+
+def run_pipeline(as_ocp, last_crawl_time, lo, workers, executor='thread'):
+    """ Go through an Activity Stream, starting from its given (last) page,
+        in stages (see above). Yield the Activities to process, in the same
+        order as plan_activities(read_pages(as_ocp), last_crawl_time), each
+        paired with what was fetched for it (see fetch_activity). The lookup
+        dict lo must only be changed by the caller between the iterations.
+
+        The fetchers are threads or (if executor is 'process')
+        processes. At most 2 * workers Activities are fetched ahead. Closing
+        the generator stops all stages.
+    """
+
+    hashes = dict(db.session.query(Curation.curation_uri,
+                                   Curation.content_hash))
+    stop = threading.Event()
+    pages = queue.Queue(PAGE_QUEUE_SIZE)
+    planned = queue.Queue(2 * workers)
+    if executor == 'process':
+        known = None
+        # ↓ spawn b/c forking a process with threads and DB connections isn't
+        #   safe
+        pool = ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_process,
+                    initargs=((set(lo['curation_uri_dict']),
+                               set(lo['canvas_uri_dict']), hashes),))
+    else:
+        known = (lo['curation_uri_dict'], lo['canvas_uri_dict'], hashes)
+        pool = ThreadPoolExecutor(workers)
+    stats = [StageStats('reader', 'pages'),
+             StageStats('planner', 'activities'),
+             StageStats('fetcher', 'activities'),
+             StageStats('writer', 'activities')]
+    reader_stats, planner_stats, fetch_stats, writer_stats = stats
+    threads = [threading.Thread(target=_read,
+                                args=(as_ocp, pages, stop, reader_stats)),
+               threading.Thread(target=_plan,
+                                args=(pages, planned, pool, last_crawl_time,
+                                      known, stop, planner_stats))]
+    log('pipelining crawl with {} {} fetchers'.format(workers, executor))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            t = time.perf_counter()
+            item = planned.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failed):
+                raise item.error
+            activity, future = item
+            try:
+                fetched, fetch_time = future.result()
+                fetch_stats.add(items=1, busy=fetch_time)
+            except Exception as e:
+                # e.g. a fetcher process died
+                log('could not prepare {} ahead. Error {}.'.format(
+                    activity['id'], e.__class__.__name__))
+                fetched = None
+            writer_stats.add(waiting=time.perf_counter() - t)
+            t = time.perf_counter()
+            yield activity, fetched
+            writer_stats.add(items=1, busy=time.perf_counter() - t)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        while not planned.empty():
+            item = planned.get()
+            if type(item) == tuple:
+                item[1].cancel()
+        pool.shutdown()
+        elapsed = time.perf_counter() - start
+        # fetchers are waiting whenever they are not busy
+        fetch_stats.waiting = max(0, workers * elapsed - fetch_stats.busy)
+        log('pipeline stages ({:.2f} s):'.format(elapsed))
+        for stage_stats in stats:
+            log('  {}'.format(stage_stats.report(elapsed)))
@@ -0,0 +1,86 @@
+""" Tracking of the index generation.
+
+    Whenever the crawler or the enhancer changes the index, a generation
+    number kept in a small JSON file is increased. Checking it only costs a
+    stat call, which lets API workers (possibly in other processes) find out
+    whether the index changed without querying the DB.
+"""
+
+import datetime
+import fcntl
+import json
+import os
+
+_cache = {'key': None, 'generation': None}
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (path, st.st_mtime_ns, st.st_size)
+
+
+def read_generation(path):
+    """ Return a dict of the form
+
+            {'generation': <int>, 'datetime': '<isoformat UTC timestamp>'}
+
+        (plus 'db_uri' and 'base_db_uri' after a blue-green build)
+
+        describing the current index generation, or None if no generation
+        has been recorded yet. The file is only parsed again if it changed
+        since the last call.
+    """
+
+    try:
+        key = _stat_key(path)
+    except OSError:
+        return None
+    if _cache['key'] != key:
+        try:
+            with open(path) as f:
+                gen = json.load(f)
+        except (OSError, ValueError):
+            return None
+        _cache['key'] = key
+        _cache['generation'] = gen
+    return _cache['generation']
+
+
+def bump_generation(path, timestamp=None, db_uri=None, base_db_uri=None,
+                    prepare=None):
+    """ Increase the index generation by one and return the new generation
+        dict. The file is replaced atomically so that readers never see a
+        partially written state.
+
+        If db_uri is given, the new generation is served from that DB (see
+        canvasindexer.builds), otherwise the DB of the previous generation is
+        kept.
+
+        If prepare is given, it is called with the new generation number
+        before the file is replaced, while no one else can bump the
+        generation (e.g. to write a snapshot of it).
+    """
+
+    with open('{}.lock'.format(path), 'w') as lock_file:
+        # the crawler and the enhancer may bump at the same time
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        old = read_generation(path)
+        if timestamp is None:
+            timestamp = datetime.datetime.utcnow().isoformat()
+        new = {'generation': old['generation'] + 1 if old else 1,
+               'datetime': timestamp}
+        if prepare is not None:
+            prepare(new['generation'])
+        if db_uri is not None:
+            new['db_uri'] = db_uri
+            new['base_db_uri'] = base_db_uri
+        elif old and 'db_uri' in old:
+            new['db_uri'] = old['db_uri']
+            new['base_db_uri'] = old['base_db_uri']
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(new, f)
+        os.replace(tmp_path, path)
+        _cache['key'] = _stat_key(path)
+        _cache['generation'] = new
+    return new
@@ -0,0 +1,377 @@
+""" Bringing existing databases up to date with the current models.
+
+    upgrade_schema() creates missing tables and then runs the versioned
+    migrations in MIGRATIONS that were not yet applied to the DB, recording
+    each in the schema_version table. New columns, indexes and conversions of
+    stored data are all added as migrations (db.create_all() only creates
+    missing tables). Migrations are run on new DBs as well, so they have to
+    do nothing if there is nothing to migrate (e.g. only add columns and
+    create indexes that are missing).
+
+    Each migration has a fixed list of the columns and indexes it adds. A
+    migration can only rely on the columns added by the ones before it, so
+    migrations converting stored data only load the columns they need.
+
+    Every process of the app upgrades the DB when it starts, so upgrading is
+    serialized with a file lock (see schema_lock).
+
+    Progress is written to the crawler log (see canvasindexer.crawler.crawler.
+    log), as migrations run in the background when the app starts.
+"""
+
+import datetime
+import fcntl
+from collections import OrderedDict
+from contextlib import contextmanager
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only
+from canvasindexer.api.snapshot import publish_index
+from canvasindexer.builds import switch_to_build
+from canvasindexer.config import get_cfg
+from canvasindexer.crawler.crawler import log as crawler_log, store_facet_list
+from canvasindexer.models import (db, Term, Canvas, Curation, CurationHit,
+                                  SchemaVersion, TermCurationAssoc)
+
+
+@contextmanager
+def schema_lock():
+    """ Context manager for changing the schema of the DB, so that processes
+        started at the same time don't migrate it concurrently.
+    """
+
+    with open('{}.schema.lock'.format(get_cfg().generation_file()),
+              'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def upgrade_schema():
+    """ Create missing tables and run the migrations not yet applied to the
+        DB. If any of them changed stored documents, publish the index.
+    """
+
+    with schema_lock():
+        db.create_all()
+        # ↓ the schema version is read with the lock held, so migrations a
+        #   process waiting for the lock ran are not run again
+        changed = run_migrations()
+    if changed:
+        publish_index(get_cfg())
+
+
+def get_schema_version():
+    """ Return the version of the latest migration applied to the DB (0 if
+        none was).
+    """
+
+    version = db.session.query(db.func.max(SchemaVersion.version)).scalar()
+    return version or 0
+
+
+def run_migrations(log=crawler_log):
+    """ Run all migrations with a version higher than the DB's. Return True
+        if any of them changed stored documents.
+    """
+
+    current = get_schema_version()
+    pending = [m for m in MIGRATIONS if m[0] > current]
+    changed = False
+    for version, description, migration in pending:
+        log('migration {}: {}'.format(version, description))
+        if migration(log=log):
+            changed = True
+        db.session.add(SchemaVersion(
+            version=version,
+            applied_at=datetime.datetime.now().isoformat()))
+        db.session.commit()
+    return changed
+
+
+def add_columns(columns, log=crawler_log):
+    """ Add the given columns ((<table name>, <column name>), as declared in
+        the models) to the tables that don't have them yet. New columns are
+        nullable, so existing records stay valid. Return the columns added.
+    """
+
+    inspector = inspect(db.engine)
+    existing_tables = inspector.get_table_names()
+    added = []
+    for table_name, col_name in columns:
+        if table_name not in existing_tables:
+            continue
+        existing_cols = [c['name'] for c in inspector.get_columns(table_name)]
+        if col_name in existing_cols:
+            continue
+        col = db.metadata.tables[table_name].columns[col_name]
+        col_type = col.type.compile(dialect=db.engine.dialect)
+        log('adding column {}.{}'.format(table_name, col_name))
+        db.engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+            table_name, col_name, col_type))
+        added.append((table_name, col_name))
+    return added
+
+
+def create_indexes(names, log=crawler_log):
+    """ Create the given indexes (by name, as declared in the models) that
+        don't exist in the DB (db.create_all() only creates them along with
+        new tables).
+    """
+
+    inspector = inspect(db.engine)
+    created = 0
+    for table in db.metadata.sorted_tables:
+        existing = [ix['name'] for ix in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in names or index.name in existing:
+                continue
+            log('creating index {}'.format(index.name))
+            index.create(bind=db.engine)
+            created += 1
+    if created and db.engine.dialect.name == 'sqlite':
+        # let the query planner know the new indexes' selectivity
+        db.engine.execute('ANALYZE')
+
+
+def create_missing_indexes(log=crawler_log):
+    """ Create all indexes declared in the models that don't exist in the DB.
+    """
+
+    create_indexes([index.name for table in db.metadata.sorted_tables
+                    for index in table.indexes], log=log)
+
+
+def add_codec_columns(log=crawler_log):
+    """ Migration 1: columns for documents stored through codecs (see
+        canvasindexer.codec).
+    """
+
+    add_columns([('canvas', 'doc_blob'), ('canvas', 'doc_codec'),
+                 ('curation', 'doc_blob'), ('curation', 'doc_codec')],
+                log=log)
+
+
+def migrate_curation_storage(log=crawler_log):
+    """ Migration 2: Curations used to be stored once per associated term,
+        with the full search result document (including the term dependent
+        canvasHit) in each record, and associated to terms through the table
+        term_curation_assoc. Convert them to one Curation record per Curation
+        plus CurationHit records, and drop the old association table.
+    """
+
+    if 'term_curation_assoc' not in inspect(db.engine).get_table_names():
+        return False
+    codec_name = get_cfg().doc_codec()
+    old_assocs = db.engine.execute('SELECT term_id, curation_id, '
+                                   'metadata_type, actor '
+                                   'FROM term_curation_assoc').fetchall()
+    old_docs = OrderedDict()
+    old_curs = Curation.query.options(load_only('json_string', 'doc_blob',
+                                                'doc_codec'))
+    for old_cur in old_curs.order_by(Curation.id):
+        old_docs[old_cur.id] = old_cur.get_doc(object_pairs_hook=OrderedDict)
+    log('migrating {} curation records'.format(len(old_docs)))
+    Curation.query.delete()
+    db.session.flush()
+    # group by Curation
+    grouped = OrderedDict()
+    for old_id, doc in old_docs.items():
+        grouped.setdefault(doc['curationUrl'], []).append((old_id, doc))
+    hit_id_by_old_id = {}
+    for cur_uri, old_group in grouped.items():
+        base_doc = OrderedDict()
+        for key in ['curationUrl', 'curationLabel', 'curationThumbnail',
+                    'totalImages', 'crawledAt']:
+            base_doc[key] = old_group[0][1][key]
+        # the thumbnail of the first Canvas in the order the crawler indexed
+        # them in (record ID order, curationCanvasIndex starts over in each
+        # range). top level metadata hits were (not always) enhanced with the
+        # thumbnail of some Canvas, which is only used if there is no other
+        thumbnails = [doc['curationThumbnail'] for _, doc in old_group
+                      if doc.get('canvasHit')]
+        thumbnails += [doc['curationThumbnail'] for _, doc in old_group
+                       if doc.get('curationHit') and doc['curationThumbnail']]
+        if thumbnails:
+            base_doc['curationThumbnail'] = thumbnails[0]
+        # ↓ not added through the session, which would also write the
+        #   columns added by later migrations
+        cur_db = Curation(curation_uri=cur_uri)
+        cur_db.set_doc(base_doc, codec_name)
+        cur_id = db.session.execute(Curation.__table__.insert().values(
+            curation_uri=cur_uri, json_string=cur_db.json_string,
+            doc_blob=cur_db.doc_blob, doc_codec=cur_db.doc_codec)
+            ).inserted_primary_key[0]
+        hits = {}
+        for old_id, doc in old_group:
+            if doc.get('canvasHit'):
+                can_hit = doc['canvasHit']
+                hit_key = (can_hit['canvasId'], can_hit['fragment'],
+                           can_hit['curationCanvasIndex'])
+                if hit_key not in hits:
+                    hits[hit_key] = CurationHit(
+                        curation_id=cur_id,
+                        hit_type='canvas',
+                        canvas_id=can_hit['canvasId'],
+                        fragment=can_hit['fragment'],
+                        canvas_index=can_hit['curationCanvasIndex'],
+                        thumbnail=doc['curationThumbnail'])
+            else:
+                hit_key = 'curation'
+                if hit_key not in hits:
+                    hits[hit_key] = CurationHit(curation_id=cur_id,
+                                                hit_type='curation')
+            db.session.add(hits[hit_key])
+            db.session.flush()
+            hit_id_by_old_id[old_id] = hits[hit_key].id
+    seen = set()
+    for term_id, old_id, metadata_type, actor in old_assocs:
+        if old_id not in hit_id_by_old_id:
+            continue
+        assoc_key = (term_id, hit_id_by_old_id[old_id])
+        if assoc_key in seen:
+            continue
+        seen.add(assoc_key)
+        db.session.add(TermCurationAssoc(term_id=term_id,
+                                         curation_hit_id=assoc_key[1],
+                                         metadata_type=metadata_type,
+                                         actor=actor))
+    db.session.commit()
+    db.engine.execute('DROP TABLE term_curation_assoc')
+    log('migrated to {} curation records with {} hits'.format(
+        len(grouped), len(set(hit_id_by_old_id.values()))))
+    return True
+
+
+def migrate_hidden_labels(log=crawler_log):
+    """ Migration 3: columns for hidden metadata labels. If they were added,
+        apply the hidden labels set in the config to the indexed terms and
+        Canvases.
+    """
+
+    added = add_columns([('term', 'hidden'), ('canvas', 'hidden_metadata')],
+                        log=log)
+    if ('term', 'hidden') not in added:
+        return False
+    filter_hidden_labels(get_cfg().facet_label_hide(), log=log)
+    return True
+
+
+def filter_hidden_labels(hidden_labels, batch_size=500, log=crawler_log):
+    """ Set the visibility flag of all terms, move metadata with the given
+        hidden labels out of (or back into) the stored Canvas documents and
+        rebuild the facet list.
+    """
+
+    Term.query.update({Term.hidden: False}, synchronize_session=False)
+    if hidden_labels:
+        Term.query.filter(Term.qualifier.in_(hidden_labels)).update(
+                                {Term.hidden: True}, synchronize_session=False)
+    db.session.commit()
+    log('term: set visibility for hidden labels {}'.format(hidden_labels))
+    canvases = Canvas.query.options(load_only('json_string', 'doc_blob',
+                                              'doc_codec', 'hidden_metadata'))
+    last_id = 0
+    while True:
+        batch = canvases.filter(Canvas.id > last_id).order_by(Canvas.id
+                                ).limit(batch_size).all()
+        if not batch:
+            break
+        for canvas in batch:
+            canvas.set_full_doc(
+                    canvas.get_full_doc(object_pairs_hook=OrderedDict),
+                    canvas.doc_codec or 'json', hidden_labels)
+        last_id = batch[-1].id
+        db.session.commit()
+        log('canvas: filtered records up to ID {}'.format(last_id))
+    store_facet_list()
+    log('facetlist: rebuilt')
+
+
+def apply_hidden_labels(hidden_labels, batch_size=500, log=crawler_log,
+                        db_uri=None):
+    """ Bring the index in line with the given list of hidden metadata labels
+        (see filter_hidden_labels). Needs to be run when facet_label_hide is
+        changed. If db_uri is given (a blue-green build), the API is switched
+        to it once done.
+    """
+
+    filter_hidden_labels(hidden_labels, batch_size, log)
+    if db_uri is not None:
+        switch_to_build(get_cfg(), db_uri)
+    else:
+        publish_index(get_cfg())
+
+
+def create_query_indexes(log=crawler_log):
+    """ Migration 4: indexes for search, facet and delete queries.
+    """
+
+    create_indexes(['ix_term_canvas_assoc_term', 'ix_term_canvas_assoc_canvas',
+                    'ix_term_curation_hit_assoc_term',
+                    'ix_term_curation_hit_assoc_hit', 'ix_term_qualifier',
+                    'ix_curation_hit_curation'], log=log)
+
+
+def add_change_detection_columns(log=crawler_log):
+    """ Migration 5: columns for skipping Updates of unchanged Curations.
+    """
+
+    add_columns([('curation', 'content_hash'),
+                 ('crawllog', 'unchanged_curations')], log=log)
+
+
+def add_enrichment_columns(log=crawler_log):
+    """ Migration 6: column and index for Canvases pending enrichment (see
+        canvasindexer.crawler.enrichment).
+    """
+
+    add_columns([('canvas', 'pending_enrichment')], log=log)
+    create_indexes(['ix_canvas_pending_enrichment'], log=log)
+
+
+def recode_docs(codec_name, batch_size=500, log=crawler_log):
+    """ Re-encode all stored Canvas and Curation documents not yet stored
+        using the given codec. Return the number of records changed.
+    """
+
+    changed = 0
+    for Doc in [Canvas, Curation]:
+        last_id = 0
+        while True:
+            batch = Doc.query.filter(Doc.id > last_id).order_by(Doc.id
+                                     ).limit(batch_size).all()
+            if not batch:
+                break
+            for record in batch:
+                if record.doc_codec != codec_name:
+                    record.set_doc(record.get_doc(), codec_name)
+                    changed += 1
+            last_id = batch[-1].id
+            db.session.commit()
+            log('{}: re-encoded records up to ID {}'.format(Doc.__tablename__,
+                                                           last_id))
+    return changed
+
+
+def vacuum():
+    """ Give space freed by recode_docs back to the file system (only
+        applicable for SQLite).
+    """
+
+    if db.engine.dialect.name == 'sqlite':
+        db.engine.execute('VACUUM')
+
+
+# versioned migrations in the form (<version>, <description>, <function>).
+# a function returns True if it changed stored documents. add new ones at the
+# end, with increasing version numbers
+MIGRATIONS = [
+    (1, 'columns for documents stored through codecs', add_codec_columns),
+    (2, 'store each curation once', migrate_curation_storage),
+    (3, 'hidden metadata labels', migrate_hidden_labels),
+    (4, 'indexes for search, facet and delete queries',
+     create_query_indexes),
+    (5, 'columns for skipping unchanged curations',
+     add_change_detection_columns),
+    (6, 'column and index for canvases pending enrichment',
+     add_enrichment_columns),
+    ]
@@ -1,15 +1,79 @@
-from flask_sqlalchemy import SQLAlchemy
+import json
+from flask import g, has_app_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
 from sqlalchemy.sql import func
+from canvasindexer.codec import get_codec
+from canvasindexer.timing import phase
 
-db = SQLAlchemy()
+
+class RoutingSession(SignallingSession):
+    """ Session that uses the engine set for the current request (see
+        canvasindexer.connections.route_request and read_only) if there is
+        one.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context() and g.get('db_engine') is not None:
+            return g.db_engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+class StoredDocMixin():
+    """ Columns and accessors for a search result document stored using one
+        of the codecs in canvasindexer.codec. Text codecs write to
+        json_string, binary codecs to doc_blob.
+    """
+
+    json_string = db.Column(db.UnicodeText())
+    doc_blob = db.Column(db.LargeBinary())
+    doc_codec = db.Column(db.String(16))  # NULL for records from before
+                                          # codecs were introduced → json
+
+    def get_doc(self, object_pairs_hook=None):
+        codec = get_codec(self.doc_codec or 'json')
+        if codec.binary:
+            data = self.doc_blob
+        else:
+            data = self.json_string
+        with phase('decode'):
+            return codec.decode(data, object_pairs_hook=object_pairs_hook)
+
+    def set_doc(self, doc, codec_name):
+        codec = get_codec(codec_name)
+        data = codec.encode(doc)
+        if codec.binary:
+            self.doc_blob = data
+            self.json_string = None
+        else:
+            self.json_string = data
+            self.doc_blob = None
+        self.doc_codec = codec.name
 
 
 class TermCurationAssoc(db.Model):
-    __tablename__ = 'term_curation_assoc'
+    __tablename__ = 'term_curation_hit_assoc'
+    # ↓ covering indexes for searching by term (API, facets) and for finding
+    #   the associations of a document (deletion, facet drill-down)
+    __table_args__ = (db.Index('ix_term_curation_hit_assoc_term', 'term_id',
+                               'metadata_type', 'actor', 'curation_hit_id'),
+                      db.Index('ix_term_curation_hit_assoc_hit',
+                               'curation_hit_id', 'metadata_type', 'actor',
+                               'term_id'))
     term_id = db.Column('term_id', db.Integer, db.ForeignKey('term.id'),
                         primary_key=True)
-    curation_id = db.Column('curation_id', db.Integer,
-                            db.ForeignKey('curation.id'), primary_key=True)
+    curation_hit_id = db.Column('curation_hit_id', db.Integer,
+                                db.ForeignKey('curation_hit.id'),
+                                primary_key=True)
     # FIXME: allow for multiple assocs for a term curation pair if metadata
     #        type or actor is different (i.e. extend primary key)
     #        (currently no prob b/c only canvas metadata and language split
@@ -18,11 +82,16 @@ class TermCurationAssoc(db.Model):
     metadata_type = db.Column('metadata_type', db.String(255))
     actor = db.Column('actor', db.String(255))
     term = db.relationship('Term')
-    curation = db.relationship('Curation')
+    curation_hit = db.relationship('CurationHit')
 
 
 class TermCanvasAssoc(db.Model):
     __tablename__ = 'term_canvas_assoc'
+    # ↓ see TermCurationAssoc
+    __table_args__ = (db.Index('ix_term_canvas_assoc_term', 'term_id',
+                               'metadata_type', 'actor', 'canvas_id'),
+                      db.Index('ix_term_canvas_assoc_canvas', 'canvas_id',
+                               'metadata_type', 'actor', 'term_id'))
     term_id = db.Column('term_id', db.Integer, db.ForeignKey('term.id'),
                         primary_key=True)
     canvas_id = db.Column('canvas_id', db.Integer, db.ForeignKey('canvas.id'),
@@ -43,31 +112,133 @@ class Term(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     term = db.Column(db.String(255))
     qualifier = db.Column(db.String(255))
-    __table_args__ = (db.UniqueConstraint('term', 'qualifier'), )
+    hidden = db.Column(db.Boolean(), default=False)  # qualifier is a hidden
+                                                     # label (facet_label_hide)
+    __table_args__ = (db.UniqueConstraint('term', 'qualifier'),
+                      db.Index('ix_term_qualifier', 'qualifier', 'term'))
     canvases = db.relationship('TermCanvasAssoc')
     curations = db.relationship('TermCurationAssoc')
 
 
-class Canvas(db.Model):
+class Canvas(StoredDocMixin, db.Model):
     __tablename__ = 'canvas'
+    __table_args__ = (db.Index('ix_canvas_pending_enrichment',
+                               'pending_enrichment'), )
     id = db.Column(db.Integer, primary_key=True)
     canvas_uri = db.Column(db.String(2048), unique=True)  # ID + # [+ fragment]
-    json_string = db.Column(db.UnicodeText())
+    # ↓ number of failed attempts to retrieve the image information if the
+    #   Canvas still has a provisional thumbnail, NULL otherwise (see
+    #   canvasindexer.crawler.enrichment)
+    pending_enrichment = db.Column(db.Integer())
+    # ↓ JSON list of the metadata entries with hidden labels. they are not
+    #   part of the stored search result document but kept so that the
+    #   document can be rebuilt when the hidden labels change
+    hidden_metadata = db.Column(db.UnicodeText())
     terms = db.relationship('TermCanvasAssoc')
 
+    def get_full_doc(self, object_pairs_hook=None):
+        """ Get the document including metadata with hidden labels.
+        """
+
+        doc = self.get_doc(object_pairs_hook=object_pairs_hook)
+        if self.hidden_metadata:
+            doc['metadata'] = doc.get('metadata', []) + json.loads(
+                    self.hidden_metadata, object_pairs_hook=object_pairs_hook)
+        return doc
 
-class Curation(db.Model):
+    def set_full_doc(self, doc, codec_name, hidden_labels):
+        """ Store a document, moving metadata with hidden labels out of the
+            search result document.
+        """
+
+        metadata = doc.get('metadata', [])
+        if type(metadata) != list:
+            metadata = []
+        visible = []
+        hidden = []
+        for meta in metadata:
+            if isinstance(meta, dict) and meta.get('label') in hidden_labels:
+                hidden.append(meta)
+            else:
+                visible.append(meta)
+        if hidden:
+            doc['metadata'] = visible
+            self.hidden_metadata = json.dumps(hidden)
+        else:
+            self.hidden_metadata = None
+        self.set_doc(doc, codec_name)
+
+
+class Curation(StoredDocMixin, db.Model):
     __tablename__ = 'curation'
     id = db.Column(db.Integer, primary_key=True)
     curation_uri = db.Column(db.String(2048), unique=True)
-    # ↑ ID + term + m.d.typ.[1]
-    json_string = db.Column(db.UnicodeText())
+    # ↑ the Curation's @id. the document stored is the part of its search
+    #   result representation that is the same for all search terms
+    content_hash = db.Column(db.String(64))
+    # ↑ hash of the Curation JSON it was last completely indexed from (see
+    #   canvasindexer.crawler.crawler.content_hash)
+    hits = db.relationship('CurationHit')
+
+
+class CurationHit(db.Model):
+    """ The part of a Curation search result that depends on the search term
+        matched (i.e. the associated term).
+
+        There is one hit of type 'curation' per Curation, which is associated
+        with the terms of its top level metadata, and one hit of type 'canvas'
+        per Canvas in the Curation. A term in Canvas level metadata is
+        associated with the hit of the first Canvas it appears on.
+    """
+
+    __tablename__ = 'curation_hit'
+    __table_args__ = (db.Index('ix_curation_hit_curation', 'curation_id',
+                               'hit_type'), )
+    id = db.Column(db.Integer, primary_key=True)
+    curation_id = db.Column(db.Integer, db.ForeignKey('curation.id'))
+    hit_type = db.Column(db.String(255))  # 'curation' or 'canvas'
+    canvas_id = db.Column(db.String(2048))
+    fragment = db.Column(db.String(255))
+    canvas_index = db.Column(db.Integer)
+    thumbnail = db.Column(db.String(2048))
+    curation = db.relationship('Curation')
     terms = db.relationship('TermCurationAssoc')
-    # [1] the reason for storing each curation once per associated term is that
-    #     depending on the search term their representation as a search result
-    #     (e.g. thumbnail) is different
-    #     furthermore the type of metadata (curation top level vs. canvas) is
-    #     used to distinguish between those two kinds of search results
+
+    def get_doc(self, object_pairs_hook=None, curation_doc=None):
+        """ Assemble the search result document. If the document of the
+            associated Curation was already loaded, it can be given as
+            curation_doc.
+        """
+
+        if curation_doc is None:
+            curation_doc = self.curation.get_doc(
+                                        object_pairs_hook=object_pairs_hook)
+        make_dict = object_pairs_hook or dict
+        doc = make_dict(curation_doc.items())
+        if self.thumbnail is not None:
+            doc['curationThumbnail'] = self.thumbnail
+        if self.hit_type == 'canvas':
+            canvas_hit = make_dict([])
+            canvas_hit['canvasId'] = self.canvas_id
+            canvas_hit['fragment'] = self.fragment
+            canvas_hit['curationCanvasIndex'] = self.canvas_index
+            doc['curationHit'] = None
+            doc['canvasHit'] = canvas_hit
+        else:
+            doc['curationHit'] = True
+            doc['canvasHit'] = None
+        return doc
+
+
+class SchemaVersion(db.Model):
+    """ Versioned migrations (see canvasindexer.migrations) applied to the
+        DB.
+    """
+
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer(), primary_key=True)
+    # ↓ saved as isoformat string like CrawlLog.datetime
+    applied_at = db.Column(db.UnicodeText())
 
 
 class CrawlLog(db.Model):
@@ -78,6 +249,7 @@ class CrawlLog(db.Model):
     # ↓ saved as isoformat string to ease integration with JSONkeeper AS
     datetime = db.Column(db.UnicodeText())
     new_canvases = db.Column(db.Integer())
+    unchanged_curations = db.Column(db.Integer())  # Updates skipped
 
 
 class FacetList(db.Model):
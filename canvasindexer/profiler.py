@@ -0,0 +1,225 @@
+""" Profiling of SQL statements.
+
+    A SQLProfiler counts the statements run by the thread it was started in
+    and the time they take, grouped by the place in Canvas Indexer's code that
+    issued them (for statements run by lazy loads of ORM relationships, that
+    is the line accessing the relationship). Statements taking longer than a
+    threshold are logged right away together with their query plan.
+
+    Profiling can be turned on for crawls (`profile_sql = true` in the
+    crawler section of the config or `run_crawler.py --profile-sql`) and, if
+    allowed by `profile_sql = true` in the api section, for single API
+    requests by adding the parameter debug=sql.
+"""
+
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(PACKAGE_DIR)
+
+# thread ident → SQLProfiler
+_active = {}
+_listening = {'value': False}
+_listen_lock = threading.Lock()
+
+
+def _call_site():
+    """ Return the innermost frame in Canvas Indexer's code (other than this
+        module) as "<path>:<line> <function>".
+    """
+
+    frame = sys._getframe(2)
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if path.startswith(PACKAGE_DIR) and path != __file__:
+            return '{}:{} {}'.format(os.path.relpath(path, ROOT_DIR),
+                                     frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return '(outside canvasindexer)'
+
+
+def _shorten(statement, length=80):
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    if len(statement) > length:
+        statement = statement[:length - 3] + '...'
+    return statement
+
+
+def query_plan(conn, statement, parameters):
+    """ Return the lines of the query plan of statement. Runs the EXPLAIN on
+        the DBAPI connection, so that it isn't profiled itself.
+    """
+
+    sqlite = conn.dialect.name == 'sqlite'
+    prefix = 'EXPLAIN QUERY PLAN ' if sqlite else 'EXPLAIN '
+    try:
+        cursor = conn.connection.cursor()
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+        cursor.close()
+    except Exception as e:
+        return ['(no query plan: {})'.format(e)]
+    if not sqlite:
+        return [' | '.join(str(col) for col in row) for row in rows]
+    # SQLite: (id, parent, notused, detail), indented by depth in the tree
+    depth = {0: 0}
+    lines = []
+    for row in rows:
+        depth[row[0]] = depth.get(row[1], 0) + 1
+        lines.append('{}{}'.format('  ' * (depth[row[0]] - 1), row[-1]))
+    return lines
+
+
+class SQLProfiler():
+    """ Profile the SQL statements of the current thread between start() and
+        stop(). Slow statements are passed to log (a function taking a
+        message) right away.
+    """
+
+    def __init__(self, slow_ms=100, log=print):
+        self.slow_ms = slow_ms
+        self.log = log
+        # call site → [<count>, <seconds>, <first statement>]
+        self.sites = OrderedDict()
+        self.count = 0
+        self.seconds = 0.0
+        self.slow = 0
+        self.thread = None
+
+    def start(self):
+        _listen()
+        self.thread = threading.get_ident()
+        _active[self.thread] = self
+        return self
+
+    def stop(self):
+        if _active.get(self.thread) is self:
+            del _active[self.thread]
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add(self, site, statement, seconds):
+        if site not in self.sites:
+            self.sites[site] = [0, 0.0, statement]
+        entry = self.sites[site]
+        entry[0] += 1
+        entry[1] += seconds
+        self.count += 1
+        self.seconds += seconds
+
+    def log_slow(self, conn, site, statement, parameters, seconds):
+        self.slow += 1
+        lines = ['slow SQL statement ({:.1f} ms) at {}:'.format(
+                                                    seconds * 1000, site),
+                 '    {}'.format(re.sub(r'\s+', ' ', statement).strip()),
+                 '    parameters: {}'.format(parameters),
+                 '    query plan:']
+        lines.extend('        {}'.format(line) for line in
+                     query_plan(conn, statement, parameters))
+        self.log('\n'.join(lines))
+
+    def report(self, limit=20):
+        """ Return a summary as a list of lines, call sites ordered by the
+            total time spent in their statements.
+        """
+
+        lines = ['{} SQL statements in {:.1f} ms from {} call sites ({} slow)'
+                 .format(self.count, self.seconds * 1000, len(self.sites),
+                         self.slow),
+                 '{:>7} {:>10} {:>8}  call site / first statement'.format(
+                                                    'count', 'total ms',
+                                                    'mean ms')]
+        sites = sorted(self.sites.items(), key=lambda s: s[1][1],
+                       reverse=True)
+        for site, (count, seconds, statement) in sites[:limit]:
+            lines.append('{:7d} {:10.1f} {:8.2f}  {}'.format(
+                            count, seconds * 1000, seconds * 1000 / count,
+                            site))
+            lines.append('{:28}{}'.format('', _shorten(statement)))
+        if len(sites) > limit:
+            lines.append('({} more call sites)'.format(len(sites) - limit))
+        return lines
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    profiler = _active.get(threading.get_ident())
+    if profiler is not None and context is not None:
+        context._ci_profile = (profiler, _call_site(), time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    profile = getattr(context, '_ci_profile', None)
+    if profile is None:
+        return
+    context._ci_profile = None
+    profiler, site, start = profile
+    seconds = time.perf_counter() - start
+    profiler.add(site, statement, seconds)
+    if seconds * 1000 >= profiler.slow_ms and not executemany:
+        profiler.log_slow(conn, site, statement, parameters, seconds)
+
+
+def _handle_error(exception_context):
+    context = exception_context.execution_context
+    if context is not None:
+        context._ci_profile = None
+
+
+def _listen():
+    """ Register the event listeners (once, on first use).
+    """
+
+    with _listen_lock:
+        if _listening['value']:
+            return
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        _listening['value'] = True
+
+
+def start_request_profile():
+    """ Before request hook starting a profiler for requests with debug=sql
+        (if enabled in the config).
+    """
+
+    cfg = current_app.cfg
+    if cfg.api_profile_sql() and request.args.get('debug') == 'sql':
+        g.sql_profiler = SQLProfiler(cfg.slow_query_ms(),
+                                     current_app.logger.warning).start()
+
+
+def finish_request_profile(resp):
+    """ After request hook logging the profile of the request and adding a
+        summary header. Streamed responses are generated here, so that their
+        statements are included.
+    """
+
+    profiler = g.get('sql_profiler')
+    if profiler is None:
+        return resp
+    if resp.is_streamed:
+        resp.get_data()
+    profiler.stop()
+    g.sql_profiler = None
+    resp.headers['X-SQL-Profile'] = '{} statements; {:.2f} ms'.format(
+                                        profiler.count, profiler.seconds * 1000)
+    current_app.logger.warning('\n'.join(
+        ['{} {}'.format(request.method, request.full_path)] +
+        profiler.report()))
+    return resp
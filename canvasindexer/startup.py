@@ -0,0 +1,90 @@
+""" Background tasks started with the app.
+
+    Creating missing tables, running migrations and the first crawl can take
+    a while, so create_app leaves them to a background thread instead of
+    doing them before it returns. Requests arriving before the DB is ready
+    wait for it (see wait_for_db), the first crawl and the periodic ones run
+    after that in the background. If preparing the DB fails, the error is
+    logged and requests are answered with 503. Crawls are scheduled
+    nevertheless (each crawl prepares the DB again).
+"""
+
+import atexit
+import datetime
+import threading
+from flask import abort, current_app, has_request_context
+
+DB_READY = 'canvasindexer_db_ready'
+DB_ERROR = 'canvasindexer_db_error'
+
+_prepare_lock = threading.Lock()
+
+
+def prepare_db(app):
+    """ Create missing tables and bring the schema up to date (see
+        upgrade_schema, which does so for one process at a time). Apps in the
+        same process (the API and a crawl) do this one after the other.
+    """
+
+    from canvasindexer.migrations import upgrade_schema
+    with _prepare_lock, app.app_context():
+        upgrade_schema()
+
+
+def schedule_crawls(interval):
+    """ Crawl now and then every interval seconds.
+    """
+
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.triggers.interval import IntervalTrigger
+    from canvasindexer.crawler.crawler import crawl
+    scheduler = BackgroundScheduler()
+    scheduler.start()
+    scheduler.add_job(
+        func=crawl,
+        trigger=IntervalTrigger(seconds=interval),
+        next_run_time=datetime.datetime.now(),
+        id='crawl_job',
+        name='crawl AS with interval set in config',
+        replace_existing=True)
+    atexit.register(lambda: scheduler.shutdown())
+
+
+def start_background_tasks(app):
+    """ Prepare the DB of app and, if configured, schedule crawls in a
+        background thread.
+    """
+
+    ready = threading.Event()
+    app.extensions[DB_READY] = ready
+
+    def run():
+        try:
+            prepare_db(app)
+        except Exception as e:
+            app.extensions[DB_ERROR] = e
+            app.logger.exception('Preparing the DB failed.')
+        ready.set()
+        if app.cfg.crawler_interval() > 0:
+            schedule_crawls(app.cfg.crawler_interval())
+
+    threading.Thread(target=run, name='canvasindexer_startup',
+                     daemon=True).start()
+
+
+def wait_for_db(app=None, timeout=None):
+    """ Block until the DB of app (default: the current app) is prepared.
+        Also used as a before request hook, which answers with 503 if
+        preparing the DB failed (outside of requests, RuntimeError is raised).
+    """
+
+    if app is None:
+        app = current_app
+    ready = app.extensions.get(DB_READY)
+    if ready is not None:
+        ready.wait(timeout)
+    error = app.extensions.get(DB_ERROR)
+    if error is not None:
+        if has_request_context():
+            return abort(503, 'The database could not be prepared.')
+        raise RuntimeError('Preparing the DB failed.') from error
@@ -0,0 +1,289 @@
+""" Timing of API requests.
+
+    With `timing = true` in the api section of the config, the time spent in
+    each request to the pd blueprint is broken down into phases (SQL
+    statements and loading their results, in-memory search, merging of
+    Curation hits, decoding of stored documents, parent lookups, facet
+    counting and serialization). The phases are reported in a Server-Timing
+    header and added up per endpoint and query shape for the /metrics
+    endpoint, which exposes them in the Prometheus text format. The body of a
+    streamed response is generated after its headers are sent, so for those
+    the header only covers the time until then, and the request is added to
+    the metrics once the response is closed.
+
+    Phases are exclusive: entering a phase (e.g. an SQL statement run while
+    looking up parents) pauses the enclosing one. Time not spent in any phase
+    is reported as "other".
+
+    When timing is disabled, phase() returns a shared no-op context manager
+    after checking a single flag.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PHASES = ['sql', 'search', 'merge', 'decode', 'parents', 'facets',
+          'serialize', 'other']
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# parameters whose values are part of the query shape, and the values that
+# are (any other value is reported as "?" to keep the number of shapes low)
+SHAPE_VALUES = {
+    'select': ['curation', 'canvas'],
+    'from': ['curation,canvas', 'canvas,curation', 'curation', 'canvas'],
+    'where_agent': ['human,machine', 'machine,human', 'human', 'machine'],
+    'where_op': ['and', 'or'],
+    'total': ['exact', 'none'],
+    'facets': ['true', 'false'],
+    'output': ['curation'],
+    'pretty': ['true', 'false'],
+    }
+# parameters of which only the presence is part of the query shape
+SHAPE_NAMES = ['where', 'where_metadata_label', 'where_metadata_value',
+               'start', 'limit', 'cursor', 'q', 'qualifier', 'canvas', 'xywh']
+
+_enabled = {'value': False}
+_metrics_lock = threading.Lock()
+# (endpoint, shape) → [<count per bucket>..., <count>, <sum>]
+_durations = OrderedDict()
+# (endpoint, phase) → seconds
+_phase_sums = OrderedDict()
+
+
+class RequestTiming():
+    """ Phase durations of one request.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.mark = self.start
+        self.stack = ['other']
+        self.totals = OrderedDict((p, 0.0) for p in PHASES)
+
+    def enter(self, name):
+        now = time.perf_counter()
+        self.totals[self.stack[-1]] += now - self.mark
+        self.stack.append(name)
+        self.mark = now
+
+    def exit(self):
+        now = time.perf_counter()
+        self.totals[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    def so_far(self):
+        """ Return the phase durations and the total duration up to now,
+            without closing any phases.
+        """
+
+        now = time.perf_counter()
+        totals = OrderedDict(self.totals)
+        totals[self.stack[-1]] += now - self.mark
+        return totals, now - self.start
+
+    def finish(self):
+        """ Close all phases and return the total duration.
+        """
+
+        while len(self.stack) > 1:
+            self.exit()
+        now = time.perf_counter()
+        self.totals['other'] += now - self.mark
+        self.mark = now
+        return now - self.start
+
+
+class _Phase():
+
+    __slots__ = ('timing', 'name')
+
+    def __init__(self, timing, name):
+        self.timing = timing
+        self.name = name
+
+    def __enter__(self):
+        self.timing.enter(self.name)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timing.exit()
+
+
+class _NoPhase():
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+def current_timing():
+    if not _enabled['value'] or not has_request_context():
+        return None
+    return g.get('timing')
+
+
+def phase(name):
+    """ Return a context manager measuring the time spent in it as phase
+        name of the current request.
+    """
+
+    timing = current_timing()
+    if timing is None:
+        return _NO_PHASE
+    return _Phase(timing, name)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    timing = current_timing()
+    if timing is not None:
+        timing.enter('sql')
+        context._ci_timed = True
+
+
+def _end_statement(context):
+    if context is not None and getattr(context, '_ci_timed', False):
+        context._ci_timed = False
+        timing = current_timing()
+        if timing is not None:
+            timing.exit()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    _end_statement(context)
+
+
+def _handle_error(exception_context):
+    _end_statement(exception_context.execution_context)
+
+
+def enable_timing():
+    """ Turn timing on for this process.
+    """
+
+    if _enabled['value']:
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+    _enabled['value'] = True
+
+
+def query_shape(args):
+    """ Describe the kind of search a request makes, e.g.
+
+            select=canvas&where_metadata_label&where_metadata_value
+    """
+
+    parts = []
+    for key in sorted(args.keys()):
+        if key in SHAPE_VALUES:
+            value = args.get(key)
+            if value not in SHAPE_VALUES[key]:
+                value = '?'
+            parts.append('{}={}'.format(key, value))
+        elif key in SHAPE_NAMES:
+            parts.append(key)
+    return '&'.join(parts)
+
+
+def start_timing():
+    """ Before request hook.
+    """
+
+    if _enabled['value']:
+        g.timing = RequestTiming()
+
+
+def server_timing(phase_totals, total):
+    return ', '.join(
+        ['{};dur={:.2f}'.format(name, seconds * 1000)
+         for name, seconds in phase_totals.items() if seconds > 0] +
+        ['total;dur={:.2f}'.format(total * 1000)])
+
+
+def finish_timing(resp):
+    """ After request hook. Streamed responses are recorded when they are
+        closed, i.e. after their body was generated and sent.
+    """
+
+    timing = current_timing()
+    if timing is None or request.endpoint == 'pd.metrics':
+        return resp
+    endpoint = request.endpoint
+    shape = query_shape(request.args)
+
+    def finish():
+        total = timing.finish()
+        record(endpoint, shape, total, timing.totals)
+        return total
+
+    if resp.is_streamed:
+        resp.headers['Server-Timing'] = server_timing(*timing.so_far())
+        resp.call_on_close(finish)
+        return resp
+    total = finish()
+    resp.headers['Server-Timing'] = server_timing(timing.totals, total)
+    g.timing = None
+    return resp
+
+
+def record(endpoint, shape, total, phase_totals):
+    with _metrics_lock:
+        key = (endpoint, shape)
+        if key not in _durations:
+            _durations[key] = [0] * (len(BUCKETS) + 2)
+        counts = _durations[key]
+        for i, bound in enumerate(BUCKETS):
+            if total <= bound:
+                counts[i] += 1
+        counts[-2] += 1
+        counts[-1] += total
+        for name, seconds in phase_totals.items():
+            _phase_sums[(endpoint, name)] = _phase_sums.get(
+                                            (endpoint, name), 0.0) + seconds
+
+
+def _label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+                                                                   '\\n')
+
+
+def render_metrics():
+    """ Return the collected metrics of this process in the Prometheus text
+        exposition format.
+    """
+
+    lines = ['# HELP canvasindexer_request_duration_seconds Duration of API '
+             'requests by endpoint and query shape.',
+             '# TYPE canvasindexer_request_duration_seconds histogram']
+    with _metrics_lock:
+        for (endpoint, shape), counts in _durations.items():
+            labels = 'endpoint="{}",shape="{}"'.format(_label_value(endpoint),
+                                                       _label_value(shape))
+            for bound, count in zip(BUCKETS, counts):
+                lines.append('canvasindexer_request_duration_seconds_bucket'
+                             '{{{},le="{}"}} {}'.format(labels, bound, count))
+            lines.append('canvasindexer_request_duration_seconds_bucket'
+                         '{{{},le="+Inf"}} {}'.format(labels, counts[-2]))
+            lines.append('canvasindexer_request_duration_seconds_sum'
+                         '{{{}}} {}'.format(labels, counts[-1]))
+            lines.append('canvasindexer_request_duration_seconds_count'
+                         '{{{}}} {}'.format(labels, counts[-2]))
+        lines.append('# HELP canvasindexer_request_phase_seconds_total Time '
+                     'spent in each phase of API requests by endpoint.')
+        lines.append('# TYPE canvasindexer_request_phase_seconds_total '
+                     'counter')
+        for (endpoint, name), seconds in _phase_sums.items():
+            lines.append('canvasindexer_request_phase_seconds_total'
+                         '{{endpoint="{}",phase="{}"}} {}'.format(
+                            _label_value(endpoint), name, seconds))
+    return '\n'.join(lines) + '\n'
@@ -1,4 +1,11 @@
+""" Crawl all Activity Streams set in the config. In blue-green mode, run with
+    --fresh to build the index from scratch. With --profile-sql, a profile of
+    the SQL statements run is written to the crawler log.
+"""
+
+import sys
 from canvasindexer.crawler.crawler import crawl
 
 if __name__ == '__main__':
-    crawl()
+    crawl(fresh='--fresh' in sys.argv[1:],
+          profile_sql='--profile-sql' in sys.argv[1:])
@@ -0,0 +1,42 @@
+""" Bring an existing index up to date: add missing DB columns and re-encode
+    all stored documents using the codec set in the config (or the codec
+    given as the first argument). In blue-green mode the changes are made to a
+    copy of the index which the API switches to once done.
+"""
+
+import sys
+from flask import Flask
+from canvasindexer.builds import active_db_uri, start_build, switch_to_build
+from canvasindexer.codec import CODECS
+from canvasindexer.config import get_cfg
+from canvasindexer.connections import setup_engine
+from canvasindexer.models import db
+from canvasindexer.migrations import recode_docs, upgrade_schema, vacuum
+
+if __name__ == '__main__':
+    cfg = get_cfg()
+    codec_name = cfg.doc_codec()
+    if len(sys.argv) > 1:
+        codec_name = sys.argv[1]
+    if codec_name not in CODECS:
+        print('Unknown codec "{}". Available: {}'.format(
+            codec_name, ', '.join(sorted(CODECS))))
+        sys.exit(1)
+
+    app = Flask(__name__)
+    build_uri = None
+    if cfg.blue_green():
+        build_uri = start_build(cfg)
+    app.config['SQLALCHEMY_DATABASE_URI'] = build_uri or active_db_uri(cfg)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        setup_engine(app, cfg)
+        upgrade_schema()
+        changed = recode_docs(codec_name)
+        print('Re-encoded {} records using codec "{}".'.format(changed,
+                                                               codec_name))
+        vacuum()
+        if build_uri:
+            switch_to_build(cfg, build_uri)
+            print('API switched to {}'.format(build_uri))
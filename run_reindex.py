@@ -0,0 +1,26 @@
+""" Apply the hidden metadata labels (facet_label_hide) set in the config to
+    an existing index. Run this after changing facet_label_hide. In blue-green
+    mode the changes are made to a copy of the index which the API switches
+    to once done.
+"""
+
+from flask import Flask
+from canvasindexer.builds import active_db_uri, start_build
+from canvasindexer.config import get_cfg
+from canvasindexer.connections import setup_engine
+from canvasindexer.models import db
+from canvasindexer.migrations import apply_hidden_labels, upgrade_schema
+
+if __name__ == '__main__':
+    cfg = get_cfg()
+    app = Flask(__name__)
+    build_uri = None
+    if cfg.blue_green():
+        build_uri = start_build(cfg)
+    app.config['SQLALCHEMY_DATABASE_URI'] = build_uri or active_db_uri(cfg)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        setup_engine(app, cfg)
+        upgrade_schema()
+        apply_hidden_labels(cfg.facet_label_hide(), db_uri=build_uri)
@@ -0,0 +1,243 @@
+""" Helpers for tests running the crawler against IIIF documents and
+    Activity Streams served from a temporary directory.
+"""
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer():
+    """ Serves the files in a temporary directory over HTTP.
+    """
+
+    def __init__(self):
+        self.dir = tempfile.mkdtemp()
+        self.httpd = ThreadingHTTPServer(
+                            ('localhost', 0),
+                            partial(QuietHandler, directory=self.dir))
+        self.base_url = 'http://localhost:{}'.format(self.httpd.server_port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def url(self, name):
+        return '{}/{}'.format(self.base_url, name)
+
+    def write(self, name, obj):
+        path = os.path.join(self.dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(obj, f, ensure_ascii=False)
+
+    def remove(self, name):
+        os.remove(os.path.join(self.dir, name))
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class Fixtures(FixtureServer):
+    """ A FixtureServer with builders for Manifests, Curations and an
+        Activity Stream.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pages = 0
+
+    def manifest(self, m, num_canvases=8):
+        """ Serve Manifest m with Canvases c1..c<num_canvases>, each with an
+            image and its info.json.
+        """
+
+        canvases = []
+        for c in range(1, num_canvases + 1):
+            img_url = self.url('img/m{}c{}'.format(m, c))
+            self.write('img/m{}c{}/info.json'.format(m, c), {
+                '@id': img_url,
+                'profile': ['http://iiif.io/api/image/2/level2.json'],
+                'qualities': ['default'],
+                'formats': ['jpg']})
+            canvases.append({
+                '@id': self.canvas_uri(m, c),
+                'label': 'p{}'.format(c),
+                'images': [{'resource': {
+                    '@id': '{}/full/full/0/default.jpg'.format(img_url),
+                    'service': {'@id': img_url}}}]})
+        self.write('man{}.json'.format(m), {
+            '@id': self.url('man{}.json'.format(m)),
+            'label': 'Manifest {}'.format(m),
+            'sequences': [{'canvases': canvases}]})
+
+    def canvas_uri(self, m, c):
+        return self.url('m{}/can/{}'.format(m, c))
+
+    def canvas(self, m, c, xywh=None, *metadata):
+        """ A Canvas of a Curation range, with metadata given as (label,
+            value) or (label, value, agent) tuples.
+        """
+
+        can = {'@id': self.canvas_uri(m, c)}
+        if xywh:
+            can['@id'] += '#xywh={}'.format(xywh)
+        if metadata:
+            can['metadata'] = [dict(zip(('label', 'value', 'agent'), md))
+                               for md in metadata]
+        return can
+
+    def curation(self, n, label, metadata, ranges):
+        """ Serve Curation n. ranges is a list of (<Manifest number>,
+            [<Canvas>, ...]).
+        """
+
+        self.write('cur{}.json'.format(n), {
+            '@id': self.url('cur{}.json'.format(n)),
+            '@type': 'cr:Curation',
+            'label': label,
+            'metadata': [dict(zip(('label', 'value', 'agent'), md))
+                         for md in metadata],
+            'selections': [{
+                '@id': self.url('r{}_{}'.format(n, i)),
+                'within': {'@id': self.url('man{}.json'.format(m)),
+                           '@type': 'sc:Manifest'},
+                'members': members}
+                for i, (m, members) in enumerate(ranges)]})
+
+    def publish(self, *activities):
+        """ Add a page with the given (<type>, <Curation number>)
+            activities to the Activity Stream, dated now (so that a crawl
+            after this one only processes the activities published after
+            it).
+        """
+
+        page = self.pages + 1
+        self.pages = page
+        now = datetime.datetime.utcnow()
+        items = []
+        for i, (typ, n) in enumerate(activities):
+            items.append({
+                'id': self.url('act/{}_{}'.format(page, i)),
+                'type': typ,
+                'endTime': (now + datetime.timedelta(milliseconds=i)
+                            ).isoformat(),
+                'object': {'@id': self.url('cur{}.json'.format(n)),
+                           '@type': 'cr:Curation'}})
+        page_json = {'id': self.url('as/page{}.json'.format(page)),
+                     'orderedItems': items}
+        if page > 1:
+            page_json['prev'] = {'id': self.url('as/page{}.json'.format(
+                                                                page - 1))}
+        self.write('as/page{}.json'.format(page), page_json)
+        self.write('as/collection.json', {
+            'type': 'OrderedCollection',
+            'last': {'id': self.url('as/page{}.json'.format(page))}})
+
+
+class IndexDir():
+    """ A temporary working directory with a config.ini for an index in it.
+        The crawler and the API read the config from the current directory,
+        so it is changed to while the IndexDir is used as a context manager.
+    """
+
+    def __init__(self, **crawler_options):
+        self.dir = tempfile.mkdtemp()
+        self.crawler_options = crawler_options
+
+    def __enter__(self):
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def write_config(self, as_source, **api_options):
+        lines = ['[shared]',
+                 'db_uri = sqlite:///{}/index.db'.format(self.dir),
+                 'generation_file = {}/gen.json'.format(self.dir),
+                 'snapshot_file = {}/snapshot.bin'.format(self.dir),
+                 '[crawler]',
+                 'as_sources = {}'.format(as_source),
+                 'log_file = {}/crawler.log'.format(self.dir)]
+        crawler_options = dict({'interval': -1}, **self.crawler_options)
+        lines += ['{} = {}'.format(key, value)
+                  for key, value in crawler_options.items()]
+        lines += ['[api]', 'facet_label_hide = hidden']
+        lines += ['{} = {}'.format(key, value)
+                  for key, value in api_options.items()]
+        with open(os.path.join(self.dir, 'config.ini'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def dump_index(db_uri):
+    """ Return the contents of an index without what depends on the order
+        records were written in (DB IDs, the order of the parents of a Canvas
+        and of facet values with the same count), crawl times and crawl log.
+    """
+
+    from flask import Flask
+    from canvasindexer.models import (db, Canvas, CanvasParentMap, Curation,
+                                      CurationHit, FacetList, Term,
+                                      TermCanvasAssoc, TermCurationAssoc)
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    dump = {}
+    with app.app_context():
+        terms = {t.id: (t.qualifier, t.term, t.hidden) for t in Term.query}
+        canvases = {c.id: c.canvas_uri for c in Canvas.query}
+        curations = {c.id: c.curation_uri for c in Curation.query}
+        hits = {h.id: (curations[h.curation_id], h.hit_type, h.canvas_id,
+                       h.fragment, h.canvas_index, h.thumbnail)
+                for h in CurationHit.query}
+
+        def without_crawl_time(doc):
+            doc.pop('crawledAt', None)
+            return doc
+
+        dump['curations'] = sorted(
+            [(c.curation_uri, without_crawl_time(c.get_doc()))
+             for c in Curation.query], key=repr)
+        dump['hits'] = sorted(hits.values(), key=repr)
+        dump['canvases'] = sorted(
+            [(c.canvas_uri, c.get_doc(), c.hidden_metadata)
+             for c in Canvas.query], key=repr)
+        dump['terms'] = sorted(terms.values(), key=repr)
+        dump['term_canvas'] = sorted(
+            [(terms[a.term_id], canvases[a.canvas_id], a.metadata_type,
+              a.actor)
+             for a in TermCanvasAssoc.query], key=repr)
+        dump['term_curation'] = sorted(
+            [(terms[a.term_id], hits[a.curation_hit_id], a.metadata_type,
+              a.actor)
+             for a in TermCurationAssoc.query], key=repr)
+        cp_map = json.loads(CanvasParentMap.query.first().json_string)
+        dump['canvas_parents'] = {
+            direction: {uri: sorted(related) for uri, related
+                        in cp_map[direction].items()}
+            for direction in ['upward', 'downward']}
+        facets = json.loads(FacetList.query.first().json_string)['facets']
+        dump['facets'] = sorted(
+            (facet['label'], sorted((entry['value'], entry['label'],
+                                     entry['agent'])
+                                    for entry in facet['value']))
+            for facet in facets)
+        db.session.remove()
+    return dump
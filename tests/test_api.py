@@ -0,0 +1,165 @@
+import os
+import shutil
+import tempfile
+import unittest
+from itertools import product
+from unittest import mock
+from tests.fixtures import Fixtures, IndexDir
+
+ENGINES = ['db', 'memory', 'snapshot']
+
+
+class EngineTest(unittest.TestCase):
+    """ All search engines (see search_engine in the api section of the
+        config) have to respond the same to a request.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        from canvasindexer.crawler.crawler import crawl
+
+        cls.fx = fx = Fixtures()
+        fx.manifest(1)
+        fx.manifest(2)
+        fx.curation(1, 'Cur One', [('theme', 'cats'), ('author', 'A', 'human')], [
+            (1, [fx.canvas(1, 1, '0,0,10,10', ('gender', 'm'), ('hidden', 'x1'), ('tag', 'face', 'machine')),
+                 fx.canvas(1, 2, '5,5,10,10', ('gender', 'f')),
+                 fx.canvas(1, 3, None, ('direction', 'left'))]),
+            (2, [fx.canvas(2, 1, None, ('place', 'Kyoto')),
+                 fx.canvas(2, 5, None, ('gender', 'm'))]),
+            (1, [fx.canvas(1, 4, '1,1,1,1', ('direction', 'right'), ('gender', 'f'))])])
+        fx.curation(2, 'Cur Two', [('theme', 'dogs'), ('tag', 'dog', 'machine')], [
+            (2, [fx.canvas(2, 2),
+                 fx.canvas(2, 3, '2,2,2,2', ('color', 'red'), ('tag', 'bird', 'machine'))]),
+            (1, [fx.canvas(1, 1, '0,0,10,10', ('gender', 'm'), ('direction', 'left'))])])
+        fx.curation(3, 'Cur Three', [], [(2, [fx.canvas(2, 8)])])
+        fx.curation(4, 'Cur Four', [('theme', 'fish')], [])
+        fx.publish(('Create', 1), ('Create', 2), ('Create', 3),
+                   ('Create', 4))
+        # crawled once, so that all engines use the same documents (crawl
+        # times are part of them)
+        cls.db_dir = tempfile.mkdtemp()
+        with IndexDir() as index_dir:
+            index_dir.write_config(fx.url('as/collection.json'))
+            crawl()
+            shutil.copy(os.path.join(index_dir.dir, 'index.db'), cls.db_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fx.close()
+        shutil.rmtree(cls.db_dir, ignore_errors=True)
+
+    def responses(self, engine, requests):
+        """ Return what requests (a function making requests with a test
+            client) returns when the app uses the given search engine.
+        """
+
+        from canvasindexer import create_app
+        from canvasindexer.api import engine as engine_module, snapshot
+        from canvasindexer.api.snapshot import publish_index
+        from canvasindexer.startup import wait_for_db
+
+        with IndexDir() as index_dir, \
+                mock.patch.dict(engine_module._engine, instance=None), \
+                mock.patch.dict(snapshot._snapshot, instance=None, key=None):
+            shutil.copy(os.path.join(self.db_dir, 'index.db'), index_dir.dir)
+            index_dir.write_config(self.fx.url('as/collection.json'),
+                                   search_engine=engine)
+            app = create_app()
+            wait_for_db(app)
+            if engine == 'snapshot':
+                with app.app_context():
+                    publish_index(app.cfg)
+            return requests(app.test_client())
+
+    def assert_same_responses(self, requests):
+        responses = {engine: self.responses(engine, requests)
+                     for engine in ENGINES}
+        for engine in ENGINES[1:]:
+            self.assertEqual(responses[engine], responses['db'], engine)
+        return responses['db']
+
+    def test_queries(self):
+        selects = ['select=canvas', 'select=curation']
+        froms = ['', '&from=canvas', '&from=curation']
+        wheres = ['', '&where=m', '&where=M&where=left',
+                  '&where=f&where=left&where_op=or', '&where=nothing',
+                  '&where_metadata_label=gender&where_metadata_value=m']
+        agents = ['', '&where_agent=human', '&where_agent=machine']
+        pages = ['', '&start=1&limit=2', '&start=3', '&limit=0',
+                 '&start=100&limit=1']
+        # every page goes with each select and facets setting
+        urls = ['/api?{}{}{}'.format(''.join(parts), pages[i % len(pages)],
+                                     facets)
+                for facets in ['', '&facets=true']
+                for i, parts in enumerate(product(selects, froms, wheres,
+                                                  agents))]
+        urls += ['/api?select=canvas&output=curation',
+                 '/api?select=canvas&where=m&output=curation&start=1']
+
+        def requests(client):
+            return [(url, resp.status_code, resp.get_json())
+                    for url, resp in ((url, client.get(url))
+                                      for url in urls)]
+
+        responses = self.assert_same_responses(requests)
+        for url, status, _ in responses:
+            self.assertEqual(status, 200, url)
+
+    def test_batch(self):
+        searches = [
+            ({'select': 'canvas', 'limit': 1, 'facets': True},
+             'select=canvas&limit=1&facets=true'),
+            ({'select': 'curation', 'where': ['m', 'left'], 'where_op': 'or',
+              'start': 1, 'facets': False},
+             'select=curation&where=m&where=left&where_op=or&start=1'
+             '&facets=false'),
+            ({'select': 'canvas', 'cursor': '*', 'limit': 2},
+             'select=canvas&cursor=*&limit=2')]
+
+        def requests(client):
+            batch = client.post('/api/batch', json=[search for search, _
+                                                    in searches] + [
+                                                    {'limit': 1.5}])
+            return batch.status_code, batch.get_json(), [
+                client.get('/api?' + query).get_json()
+                for _, query in searches]
+
+        status, batch, responses = self.assert_same_responses(requests)
+        self.assertEqual(status, 200)
+        self.assertEqual(batch['responses'][:-1], responses)
+        self.assertEqual(batch['responses'][-1]['status'], 400)
+
+    def test_cursor(self):
+        def requests(client):
+            pages = []
+            for query in ['select=canvas', 'select=canvas&where=m',
+                          'select=canvas&where=m&where=left&where_op=or']:
+                for limit in [0, 1, 2, 3, 100]:
+                    cursor = '*'
+                    while cursor is not None:
+                        resp = client.get('/api?{}&cursor={}&limit={}'.format(
+                                                        query, cursor, limit))
+                        pages.append((query, limit, resp.status_code,
+                                      resp.get_json()))
+                        if resp.status_code != 200:
+                            break
+                        cursor = resp.get_json()['next_cursor']
+            return pages
+
+        pages = self.assert_same_responses(requests)
+        for query, limit, status, _ in pages:
+            self.assertEqual(status, 200, (query, limit))
+        paged = {}
+        for query, limit, _, page in pages:
+            paged.setdefault((query, limit), []).extend(page['results'])
+        for (query, limit), results in paged.items():
+            if limit == 0:
+                self.assertEqual(results, [])
+            else:
+                self.assertEqual(results, paged[(query, 100)])
+        self.assertEqual(len(paged[('select=canvas', 100)]), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
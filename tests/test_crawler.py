@@ -0,0 +1,102 @@
+import unittest
+from unittest import mock
+from tests.fixtures import Fixtures, IndexDir, dump_index
+
+
+class UpdateTest(unittest.TestCase):
+    """ Processing an Update in place has to result in the same index as
+        deleting the Curation and creating it again.
+    """
+
+    def setUp(self):
+        self.fx = Fixtures()
+        self.addCleanup(self.fx.close)
+        self.fx.manifest(1)
+        self.fx.manifest(2)
+
+    def create_phase(self):
+        fx = self.fx
+        fx.curation(1, 'Cur One', [('theme', 'cats'), ('author', 'A', 'human')], [
+            (1, [fx.canvas(1, 1, '0,0,10,10', ('gender', 'm'), ('hidden', 'x1'), ('tag', 'face', 'machine')),
+                 fx.canvas(1, 2, '5,5,10,10', ('gender', 'f')),
+                 fx.canvas(1, 3, None, ('direction', 'left')),
+                 fx.canvas(1, 4, '1,1,1,1', ('direction', 'right'), ('gender', 'f'))]),
+            (2, [fx.canvas(2, 1, None, ('place', 'Kyoto')),
+                 fx.canvas(2, 5, None, ('gender', 'm'))])])
+        fx.curation(2, 'Cur Two', [('theme', 'dogs')], [
+            (1, [fx.canvas(1, 1, '0,0,10,10', ('gender', 'm'), ('direction', 'left')),
+                 fx.canvas(1, 5, None, ('color', 'red'))])])
+        fx.curation(3, 'Cur Three', [('theme', 'birds')], [
+            (2, [fx.canvas(2, 2, None, ('color', 'blue')),
+                 fx.canvas(2, 3, '2,2,2,2', ('color', 'red'), ('tag', 'bird', 'machine'))])])
+        fx.curation(5, 'Cur Five', [], [(2, [fx.canvas(2, 8)])])
+        fx.publish(('Create', 1), ('Create', 2), ('Create', 3), ('Create', 5))
+
+    def update_phase(self):
+        fx = self.fx
+        fx.curation(1, 'Cur One (edited)', [('theme', 'cats'), ('theme', 'mice'), ('author', 'A', 'machine')], [
+            # metadata added, reordered, metadata removed, new Canvas and a
+            # Canvas twice in one range
+            (1, [fx.canvas(1, 2, '5,5,10,10', ('gender', 'f'), ('year', '1900')),
+                 fx.canvas(1, 1, '0,0,10,10', ('gender', 'm'), ('tag', 'face', 'machine')),
+                 fx.canvas(1, 4, '1,1,1,1', ('direction', 'right')),
+                 fx.canvas(1, 6, None, ('direction', 'up')),
+                 fx.canvas(1, 2, '5,5,10,10', ('gender', 'f'))]),
+            (2, [fx.canvas(2, 3, '2,2,2,2', ('color', 'green')),
+                 fx.canvas(2, 4, None, ('color', 'black'))])])
+        # all Canvases removed
+        fx.curation(3, 'Cur Three', [('theme', 'birds')], [])
+        # not indexed yet
+        fx.curation(4, 'Cur Four', [('theme', 'fish')], [
+            (1, [fx.canvas(1, 7, None, ('color', 'white'))])])
+        fx.curation(6, 'Cur Six', [('theme', 'mice')], [
+            (1, [fx.canvas(1, 2, '5,5,10,10', ('year', '1900'), ('gender', 'm')),
+                 fx.canvas(1, 6, None, ('direction', 'down'))]),
+            (2, [fx.canvas(2, 4, None, ('color', 'black')),
+                 fx.canvas(2, 1, None, ('place', 'Osaka'))])])
+        # Curation 2 is updated without changes
+        fx.publish(('Update', 1), ('Update', 2), ('Update', 3),
+                   ('Update', 4), ('Delete', 5), ('Create', 6))
+
+    def crawl_phases(self, **crawler_options):
+        from canvasindexer.crawler.crawler import crawl
+
+        with IndexDir(**crawler_options) as index_dir:
+            index_dir.write_config(self.fx.url('as/collection.json'))
+            self.create_phase()
+            crawl()
+            self.update_phase()
+            crawl()
+            return dump_index('sqlite:///{}/index.db'.format(index_dir.dir))
+
+    def delete_and_create(self, lo, cp_map, activity, fetched=None):
+        from canvasindexer.crawler import crawler
+        from canvasindexer.models import db
+
+        crawler.process_curation_delete(cp_map, activity, lo)
+        lo['canvas_docs'].write_back()
+        db.session.commit()
+        lo.update(crawler.get_lookup_dict())
+        return crawler.process_curation_create(lo, cp_map, activity)
+
+    def assert_same_as_delete_and_create(self, **crawler_options):
+        updated = self.crawl_phases(**crawler_options)
+        self.fx.pages = 0
+        with mock.patch('canvasindexer.crawler.crawler.'
+                        'process_curation_update', self.delete_and_create):
+            recreated = self.crawl_phases(**crawler_options)
+        for key in recreated:
+            self.assertEqual(updated[key], recreated[key], key)
+
+    def test_update(self):
+        self.assert_same_as_delete_and_create()
+
+    def test_update_with_orphans(self):
+        self.assert_same_as_delete_and_create(allow_orphan_canvases='true')
+
+    def test_update_pipelined(self):
+        self.assert_same_as_delete_and_create(pipeline_workers=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
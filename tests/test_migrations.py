@@ -0,0 +1,225 @@
+import json
+import multiprocessing
+import os
+import unittest
+from collections import OrderedDict
+from tests.fixtures import Fixtures, IndexDir, dump_index
+
+# columns added to existing tables by migrations
+MIGRATED_COLUMNS = [('canvas', 'doc_blob'), ('canvas', 'doc_codec'),
+                    ('canvas', 'hidden_metadata'),
+                    ('canvas', 'pending_enrichment'),
+                    ('curation', 'doc_blob'), ('curation', 'doc_codec'),
+                    ('curation', 'content_hash'), ('term', 'hidden'),
+                    ('crawllog', 'unchanged_curations')]
+
+
+def index_app(db_uri):
+    from flask import Flask
+    from canvasindexer.models import db
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def legacy_curation_records():
+    """ Return the records the crawler wrote for the indexed Curations before
+        Curations were stored once (see migrate_curation_storage), as
+        (<curation_uri>, <document>, [(<term ID>, <metadata type>, <actor>),
+        ...]) in the order they were created: per Curation a record for each
+        term of its top level metadata, then a record for each term of its
+        Canvas metadata, with the document of the first Canvas the term
+        appears on.
+
+        Only the top level record of the last term (the placeholder term) got
+        a thumbnail, which was that of the first Canvas of the Curation's last
+        range.
+    """
+
+    from canvasindexer.config import get_cfg
+    from canvasindexer.models import (Curation, CurationHit, Term,
+                                      TermCurationAssoc)
+
+    e_term = get_cfg().e_term()
+    terms = {t.id: t.term for t in Term.query}
+    records = []
+    for cur in Curation.query.order_by(Curation.id):
+        cur_doc = cur.get_doc(object_pairs_hook=OrderedDict)
+        cur_uri = cur_doc['curationUrl']
+        hits = CurationHit.query.filter_by(curation_id=cur.id).order_by(
+                                                        CurationHit.id).all()
+        can_hits = [hit for hit in hits if hit.hit_type == 'canvas']
+        top_doc = OrderedDict(cur_doc, curationThumbnail=None)
+        for hit in hits:
+            assocs = TermCurationAssoc.query.filter_by(
+                        curation_hit_id=hit.id).order_by(
+                        TermCurationAssoc.term_id).all()
+            for assoc in assocs:
+                term = terms[assoc.term_id]
+                if hit.hit_type == 'curation':
+                    uri = cur_uri + term + 'curation'
+                    doc = hit.get_doc(object_pairs_hook=OrderedDict,
+                                      curation_doc=top_doc)
+                    if term == e_term and can_hits:
+                        doc['curationThumbnail'] = [
+                            h for h in can_hits if h.canvas_index == 1
+                            ][-1].thumbnail
+                else:
+                    uri = cur_uri + term + 'canvas'
+                    doc = hit.get_doc(object_pairs_hook=OrderedDict,
+                                      curation_doc=cur_doc)
+                records.append((uri, doc, [(assoc.term_id,
+                                            assoc.metadata_type,
+                                            assoc.actor)]))
+    return records
+
+
+def downgrade_index():
+    """ Turn the index into one the crawler wrote before any migrations: the
+        Curations stored as legacy records (see legacy_curation_records)
+        associated to terms through the table term_curation_assoc, documents
+        stored as JSON text including metadata with hidden labels, and none
+        of the columns and indexes added by migrations.
+    """
+
+    from sqlalchemy import text
+    from canvasindexer.models import (db, Canvas, Curation, CurationHit,
+                                      TermCurationAssoc)
+
+    records = legacy_curation_records()
+    for canvas in Canvas.query:
+        canvas.json_string = json.dumps(canvas.get_full_doc(
+                                            object_pairs_hook=OrderedDict))
+    TermCurationAssoc.query.delete()
+    CurationHit.query.delete()
+    Curation.query.delete()
+    db.session.execute('CREATE TABLE term_curation_assoc ('
+                       'term_id INTEGER, curation_id INTEGER, '
+                       'metadata_type VARCHAR(255), actor VARCHAR(255))')
+    for uri, doc, assocs in records:
+        cur_db = Curation(curation_uri=uri, json_string=json.dumps(doc))
+        db.session.add(cur_db)
+        db.session.flush()
+        for term_id, metadata_type, actor in assocs:
+            db.session.execute(
+                text('INSERT INTO term_curation_assoc VALUES '
+                     '(:term_id, :curation_id, :metadata_type, :actor)'),
+                {'term_id': term_id, 'curation_id': cur_db.id,
+                 'metadata_type': metadata_type, 'actor': actor})
+    db.session.execute('DELETE FROM schema_version')
+    db.session.commit()
+    db.session.remove()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(bind=db.engine)
+    for table_name, col_name in MIGRATED_COLUMNS:
+        if (table_name, col_name) != ('term', 'hidden'):
+            db.engine.execute('ALTER TABLE {} DROP COLUMN {}'.format(
+                                                    table_name, col_name))
+    # the CHECK constraint of Term.hidden keeps it from being dropped
+    db.engine.execute('CREATE TABLE legacy_term (id INTEGER NOT NULL, '
+                      'term VARCHAR(255), qualifier VARCHAR(255), '
+                      'PRIMARY KEY (id), UNIQUE (term, qualifier))')
+    db.engine.execute('INSERT INTO legacy_term '
+                      'SELECT id, term, qualifier FROM term')
+    db.engine.execute('DROP TABLE term')
+    db.engine.execute('ALTER TABLE legacy_term RENAME TO term')
+
+
+def upgrade(index_dir):
+    """ Upgrade the index in index_dir the way an app process does when it
+        starts.
+    """
+
+    from canvasindexer.migrations import upgrade_schema
+
+    os.chdir(index_dir)
+    with index_app('sqlite:///{}/index.db'.format(index_dir)).app_context():
+        upgrade_schema()
+
+
+class MigrationTest(unittest.TestCase):
+    """ Migrating an index the crawler wrote before any migrations has to
+        result in the same index as crawling anew, except for hits and term
+        associations the legacy index did not have (records for later
+        Canvases with a term that already appeared on an earlier Canvas of
+        the Curation weren't stored).
+    """
+
+    def setUp(self):
+        self.fx = Fixtures()
+        self.addCleanup(self.fx.close)
+        self.fx.manifest(1)
+        self.fx.manifest(2)
+
+    def publish_curations(self):
+        fx = self.fx
+        # the first Canvas of the last range isn't the first Canvas
+        fx.curation(1, 'Cur One', [('theme', 'cats'), ('author', 'A', 'human')], [
+            (1, [fx.canvas(1, 1, '0,0,10,10', ('gender', 'm'), ('hidden', 'x1'), ('tag', 'face', 'machine')),
+                 fx.canvas(1, 2, '5,5,10,10', ('gender', 'f')),
+                 fx.canvas(1, 3, None, ('direction', 'left'))]),
+            (2, [fx.canvas(2, 1, None, ('place', 'Kyoto')),
+                 fx.canvas(2, 5, None, ('gender', 'm'))]),
+            (1, [fx.canvas(1, 4, '1,1,1,1', ('direction', 'right'))])])
+        # no metadata on the first Canvas
+        fx.curation(2, 'Cur Two', [('theme', 'dogs')], [
+            (2, [fx.canvas(2, 2),
+                 fx.canvas(2, 3, '2,2,2,2', ('color', 'red'), ('tag', 'bird', 'machine'))]),
+            (1, [fx.canvas(1, 1, '0,0,10,10', ('gender', 'm'))])])
+        # no top level metadata, no Canvases
+        fx.curation(3, 'Cur Three', [], [(2, [fx.canvas(2, 8)])])
+        fx.curation(4, 'Cur Four', [('theme', 'fish')], [])
+        fx.publish(('Create', 1), ('Create', 2), ('Create', 3),
+                   ('Create', 4))
+
+    def assert_same_as_crawled(self, upgrade_processes):
+        """ Crawl, downgrade the index (see downgrade_index) and upgrade it
+            in the given number of processes at the same time.
+        """
+
+        from canvasindexer.crawler.crawler import crawl
+        from canvasindexer.migrations import MIGRATIONS
+
+        with IndexDir() as index_dir:
+            index_dir.write_config(self.fx.url('as/collection.json'))
+            db_uri = 'sqlite:///{}/index.db'.format(index_dir.dir)
+            self.publish_curations()
+            crawl()
+            crawled = dump_index(db_uri)
+            with index_app(db_uri).app_context():
+                downgrade_index()
+            ctx = multiprocessing.get_context('spawn')
+            processes = [ctx.Process(target=upgrade, args=(index_dir.dir,))
+                         for _ in range(upgrade_processes)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            self.assertEqual([p.exitcode for p in processes],
+                             [0] * upgrade_processes)
+            migrated = dump_index(db_uri)
+            with index_app(db_uri).app_context():
+                from canvasindexer.models import SchemaVersion
+                versions = [v.version for v in SchemaVersion.query]
+        for key in crawled:
+            if key in ['hits', 'term_curation']:
+                self.assertLessEqual(set(migrated[key]), set(crawled[key]),
+                                     key)
+            else:
+                self.assertEqual(migrated[key], crawled[key], key)
+        self.assertEqual(len(migrated['hits']), 13)
+        self.assertEqual(sorted(versions), [m[0] for m in MIGRATIONS])
+
+    def test_migrate(self):
+        self.assert_same_as_crawled(1)
+
+    def test_concurrent_upgrades(self):
+        self.assert_same_as_crawled(4)
+
+
+if __name__ == '__main__':
+    unittest.main()
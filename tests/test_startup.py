@@ -0,0 +1,35 @@
+import threading
+import unittest
+from unittest import mock
+from tests.fixtures import IndexDir
+
+
+class StartupTest(unittest.TestCase):
+    """ An app whose DB could not be prepared has to log the error, answer
+        requests with 503 and still schedule crawls.
+    """
+
+    def test_failed_preparation(self):
+        from canvasindexer import create_app
+        from canvasindexer.startup import wait_for_db
+
+        with IndexDir(interval=60) as index_dir, \
+                mock.patch('canvasindexer.migrations.upgrade_schema',
+                           side_effect=RuntimeError('broken')), \
+                mock.patch('canvasindexer.startup.schedule_crawls') as \
+                schedule_crawls:
+            index_dir.write_config('http://localhost/as/collection.json')
+            with self.assertLogs(level='ERROR'):
+                app = create_app()
+                for thread in threading.enumerate():
+                    if thread.name == 'canvasindexer_startup':
+                        thread.join()
+            with self.assertRaises(RuntimeError):
+                wait_for_db(app)
+            resp = app.test_client().get('/api?select=canvas')
+        self.assertEqual(resp.status_code, 503)
+        schedule_crawls.assert_called_once_with(60)
+
+
+if __name__ == '__main__':
+    unittest.main()
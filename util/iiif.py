@@ -53,15 +53,24 @@ class Curation():
         ran['within']['label'] = within_label
         return ran
 
+    def create_range(self, within, canvases, within_label=None, label=None,
+                     ran_id=None):
+        """ Create a Range filled with Canvases. The Range has to be added to
+            the Curation manually afterwards.
+        """
+
+        ran = self._create_empty_range(within, within_label, label, ran_id)
+        for can in canvases:
+            ran['members'].append(can)
+        return ran
+
     def add_and_fill_range(self, within, canvases, within_label=None,
                            label=None, ran_id=None):
         """ Add Range and fill with Canvases. Return the Range's id
             (generated randomly when not given).
         """
 
-        ran = self._create_empty_range(within, within_label, label, ran_id)
-        for can in canvases:
-            ran['members'].append(can)
+        ran = self.create_range(within, canvases, within_label, label, ran_id)
         self.cur['selections'].append(ran)
         return ran['@id']
 